@@ -0,0 +1,142 @@
+"""
+Офлайн-бенчмарк памяти стадий enrich + transform: сколько байт занимают
+строки БД и документы ES на каждые 10k фильмов (tracemalloc).
+
+Сравниваются представления строк:
+  - dict_rows - psycopg2.extras.DictRow, как отдавал DictCursor: список
+    значений со ссылкой на индекс колонок, доступ по имени на каждое поле
+  - tuple_rows - кортежи etl.extractor.Rows обычного курсора, индексы
+    колонок определяются один раз на запрос
+  - lazy_rows - ленивые строки iter_data_by_ids и iter_transform
+    Трансформера (etl.py --lazy): в памяти строки одного объекта
+
+Запуск:
+    PYTHONPATH=. python -m benchmarks.bench_memory --movies 10000
+"""
+import argparse
+import gc
+import tracemalloc
+from collections import OrderedDict
+from types import SimpleNamespace
+
+from psycopg2.extras import DictRow
+
+from benchmarks import datagen
+from benchmarks.bench_pipeline import ENTITIES, FROM_DATE
+from etl.extractor import Rows
+
+ROWS = ("dict_rows", "tuple_rows", "lazy_rows")
+# объём, к которому приводятся замеры
+PER_MOVIES = 10_000
+
+
+def to_dict_rows(rows: Rows) -> list:
+    """
+    Строки в виде DictCursor: DictRow со ссылкой на общий индекс колонок.
+    Кортежи заменяются на месте - в пике нет обеих копий строк
+    """
+    cursor = SimpleNamespace(
+        index=OrderedDict(rows.columns), description=tuple(rows.columns)
+    )
+    for position, values in enumerate(rows):
+        row = DictRow(cursor)
+        row[:] = values
+        rows[position] = row
+
+    # DictCursor отдаёт обычный список - без индексов колонок
+    result = list(rows)
+    rows.clear()
+
+    return result
+
+
+def measure(dataset: datagen.Dataset, entity: str, rows_kind: str) -> dict:
+    config = ENTITIES[entity]
+    extractor = config["extractor"][0](dataset)
+    transformer = config["transformer"][0](
+        source_unique_key=config["source_unique_key"]
+    )
+    ids = tuple(
+        row[0]
+        for batch in extractor.iter_modified_ids(FROM_DATE, None, 1000)
+        for row in batch
+    )
+
+    gc.collect()
+    tracemalloc.start()
+    if rows_kind == "lazy_rows":
+        rows = extractor.iter_data_by_ids(ids)
+        rows_bytes = tracemalloc.get_traced_memory()[0]
+        documents = list(transformer.iter_transform(rows))
+    else:
+        rows = extractor.get_data_by_ids(ids)
+        if rows_kind == "dict_rows":
+            rows = to_dict_rows(rows)
+        rows_bytes = tracemalloc.get_traced_memory()[0]
+        documents = transformer.transform(rows)
+    documents_bytes = tracemalloc.get_traced_memory()[0] - rows_bytes
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    scale = PER_MOVIES / len(dataset.movies)
+    return {
+        "entity": entity,
+        "rows_kind": rows_kind,
+        "rows": len(rows) if isinstance(rows, list) else "-",
+        "documents": len(documents),
+        "rows_bytes": rows_bytes * scale,
+        "documents_bytes": documents_bytes * scale,
+        "peak_bytes": peak_bytes * scale,
+    }
+
+
+def report(results: list):
+    print(
+        f"per {PER_MOVIES} movies\n"
+        f"{'entity':>8} {'rows kind':>11} {'rows':>8} {'rows MiB':>9} "
+        f"{'docs MiB':>9} {'peak MiB':>9} {'vs dict':>8}"
+    )
+    peaks = {}
+    for result in results:
+        peaks.setdefault(result["entity"], result["peak_bytes"])
+        change = result["peak_bytes"] / peaks[result["entity"]] - 1
+        print(
+            f"{result['entity']:>8} {result['rows_kind']:>11} {result['rows']:>8} "
+            f"{result['rows_bytes'] / 2 ** 20:>9.1f} "
+            f"{result['documents_bytes'] / 2 ** 20:>9.1f} "
+            f"{result['peak_bytes'] / 2 ** 20:>9.1f} {change:>+8.0%}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="bench_memory",
+        description="Offline memory benchmark of the enrich and transform stages",
+        allow_abbrev=False,
+    )
+    parser.add_argument("--movies", type=int, default=PER_MOVIES)
+    parser.add_argument("--persons", type=int, default=10_000)
+    parser.add_argument("--genres", type=int, default=30)
+    parser.add_argument("--roles_per_movie", type=int, default=10)
+    parser.add_argument("--genres_per_movie", type=int, default=3)
+    parser.add_argument(
+        "--entities", nargs="+", choices=list(ENTITIES), default=list(ENTITIES)
+    )
+    args = parser.parse_args()
+
+    dataset = datagen.generate(
+        movies=args.movies,
+        persons=args.persons,
+        genres=args.genres,
+        roles_per_movie=args.roles_per_movie,
+        genres_per_movie=args.genres_per_movie,
+    )
+    print(dataset)
+
+    report(
+        [
+            measure(dataset, entity, rows_kind)
+            for entity in args.entities
+            for rows_kind in ROWS
+        ]
+    )
@@ -0,0 +1,436 @@
+"""
+Офлайн-бенчмарк Пайплайнов: стадии PipeEETBL по отдельности и целиком
+на синтетических данных (benchmarks/datagen.py), без PostgreSQL
+и Elasticsearch (benchmarks/fakes.py).
+
+Для каждой сущности меряются:
+  - extract - постраничное чтение id изменённых объектов (ids/s)
+  - enrich - получение строк по id (rows/s)
+  - transform - строки БД -> документы ES (docs/s)
+  - serialize - документы -> тело _bulk (docs/s)
+  - load - отправка готовых пачек в _bulk (docs/s)
+  - pipe - PipeEETBL.pump целиком (docs/s). С --asyncio - асинхронный
+        движок etl.aio.AsyncPipeEETBL с aiohttp-Загрузчиком
+
+Каждый замер идёт в отдельном процессе: peak RSS - пик памяти процесса,
+включая сгенерированные данные, rss+ - прирост пика за время замера.
+
+Запуск:
+    PYTHONPATH=. python -m benchmarks.bench_pipeline --movies 20000
+    PYTHONPATH=. python -m benchmarks.bench_pipeline --save-baseline \\
+        benchmarks/baseline.json
+    PYTHONPATH=. python -m benchmarks.bench_pipeline --baseline \\
+        benchmarks/baseline.json --tolerance 0.2
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+from benchmarks import datagen, fakes
+from etl.aio import AsyncESLoader, AsyncPipeEETBL
+from etl.loader import ESLoader
+from etl.pipes import PipeEETBL, coroutine, extract
+from etl.serializers import BulkSerializer
+from etl.state import State
+from etl.transformer import (
+    PGtoESGenresAggregatedTransformer,
+    PGtoESGenresTransformer,
+    PGtoESMoviesAggregatedTransformer,
+    PGtoESMoviesTransformer,
+    PGtoESPersonsAggregatedTransformer,
+    PGtoESPersonsTransformer,
+)
+
+# как в etl.py: Экстрактор, Трансформер, ключ строк, размеры пачек
+ENTITIES = {
+    "movies": {
+        "extractor": (fakes.FakeMovieExtractor, fakes.FakeMovieAggregatedExtractor),
+        "transformer": (PGtoESMoviesTransformer, PGtoESMoviesAggregatedTransformer),
+        "source_unique_key": "movie_id",
+        "extractor_batch_size": 1000,
+        "loader_batch_size": 5000,
+    },
+    "genres": {
+        "extractor": (fakes.FakeGenreExtractor, fakes.FakeGenreAggregatedExtractor),
+        "transformer": (PGtoESGenresTransformer, PGtoESGenresAggregatedTransformer),
+        "source_unique_key": "genre_id",
+        "extractor_batch_size": 30,
+        "loader_batch_size": 600,
+    },
+    "persons": {
+        "extractor": (fakes.FakePersonExtractor, fakes.FakePersonAggregatedExtractor),
+        "transformer": (PGtoESPersonsTransformer, PGtoESPersonsAggregatedTransformer),
+        "source_unique_key": "person_id",
+        "extractor_batch_size": 100,
+        "loader_batch_size": 1000,
+    },
+}
+STAGES = ("extract", "enrich", "transform", "serialize", "load", "pipe")
+FROM_DATE = "2000-01-01 00:00:00.000000"
+
+
+def peak_rss() -> int:
+    """Пик потребления памяти процессом, байт"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт KiB, macOS - байты
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Context:
+    """Данные и объекты одной сущности, общие для стадий"""
+
+    def __init__(self, entity: str, options: dict):
+        config = ENTITIES[entity]
+        self.entity = entity
+        self.options = options
+        self.config = config
+        aggregated = int(options["aggregated"])
+
+        self.dataset = datagen.generate(
+            movies=options["movies"],
+            persons=options["persons"],
+            genres=options["genres"],
+            roles_per_movie=options["roles_per_movie"],
+            genres_per_movie=options["genres_per_movie"],
+        )
+        self.extractor = config["extractor"][aggregated](self.dataset)
+        self.transformer = config["transformer"][aggregated](
+            source_unique_key=config["source_unique_key"]
+        )
+
+    def ids_batches(self) -> list:
+        batch_size = self.config["extractor_batch_size"]
+        return [
+            tuple(row[0] for row in batch)
+            for batch in self.extractor.iter_modified_ids(FROM_DATE, None, batch_size)
+        ]
+
+    def rows_batches(self) -> list:
+        return [self.extractor.get_data_by_ids(ids) for ids in self.ids_batches()]
+
+    def documents(self) -> list:
+        documents = []
+        for rows in self.rows_batches():
+            documents.extend(self.transformer.transform(rows))
+        return documents
+
+    def loader(self) -> ESLoader:
+        return ESLoader(
+            index_name=self.entity,
+            bulk_chunks=self.options["bulk_chunks"],
+            max_in_flight=self.options["max_in_flight"],
+            compress=self.options["compress"],
+        )
+
+
+def bench_extract(context: Context):
+    @coroutine
+    def sink(counter: list):
+        while ids := (yield):
+            counter.append(len(ids))
+
+    counter = []
+    started_at = time.perf_counter()
+    try:
+        extract(
+            sink(counter),
+            forced_modification_date=FROM_DATE,
+            batch_size=context.config["extractor_batch_size"],
+            extractor=context.extractor,
+            state=State(fakes.MemoryStorage(), key_prefix=""),
+        )
+    except StopIteration:
+        pass
+    return sum(counter), time.perf_counter() - started_at
+
+
+def bench_enrich(context: Context):
+    ids_batches = context.ids_batches()
+    started_at = time.perf_counter()
+    rows = sum(len(context.extractor.get_data_by_ids(ids)) for ids in ids_batches)
+    return rows, time.perf_counter() - started_at
+
+
+def bench_transform(context: Context):
+    rows_batches = context.rows_batches()
+    started_at = time.perf_counter()
+    documents = sum(len(context.transformer.transform(rows)) for rows in rows_batches)
+    return documents, time.perf_counter() - started_at
+
+
+def bench_serialize(context: Context):
+    documents = context.documents()
+    started_at = time.perf_counter()
+    BulkSerializer(context.entity).dump(documents)
+    return len(documents), time.perf_counter() - started_at
+
+
+def bench_load(context: Context):
+    documents = context.documents()
+    batch_size = context.config["loader_batch_size"]
+    with fakes.BulkServer() as server:
+        os.environ["ELASTICSEARCH_URL"] = server.url
+        loader = context.loader()
+
+        started_at = time.perf_counter()
+        for start in range(0, len(documents), batch_size):
+            end = start + batch_size
+            loader.load_to_es(documents[start:end])
+        elapsed = time.perf_counter() - started_at
+
+    return server.documents, elapsed
+
+
+def bench_pipe(context: Context):
+    with fakes.BulkServer() as server:
+        os.environ["ELASTICSEARCH_URL"] = server.url
+        if context.options["asyncio"]:
+            return bench_async_pipe(context, server)
+
+        pipe = PipeEETBL(
+            label=context.entity,
+            extractor=context.extractor,
+            loader=context.loader(),
+            transformer=context.transformer,
+            states_keeper=State(fakes.MemoryStorage(), key_prefix=""),
+            extractor_batch_size=context.config["extractor_batch_size"],
+            loader_batch_size=context.config["loader_batch_size"],
+            loader_batch_bytes=context.options["bulk_max_bytes"],
+            streaming=context.options["streaming"],
+            pipelined=context.options["pipelined"],
+            lazy=context.options["lazy"],
+            autotune=context.options["autotune"],
+        )
+
+        started_at = time.perf_counter()
+        pipe.pump(from_date=FROM_DATE)
+        elapsed = time.perf_counter() - started_at
+
+    return server.documents, elapsed
+
+
+def bench_async_pipe(context: Context, server: fakes.BulkServer):
+    loader = context.loader()
+    # синхронный фейковый Экстрактор: асинхронный движок вызывает его напрямую
+    pipe = AsyncPipeEETBL(
+        PipeEETBL(
+            label=context.entity,
+            extractor=context.extractor,
+            loader=loader,
+            transformer=context.transformer,
+            states_keeper=State(fakes.MemoryStorage(), key_prefix=""),
+            extractor_batch_size=context.config["extractor_batch_size"],
+            loader_batch_size=context.config["loader_batch_size"],
+            loader_batch_bytes=context.options["bulk_max_bytes"],
+            autotune=context.options["autotune"],
+        ),
+        extractor=context.extractor,
+        loader=AsyncESLoader.from_loader(loader),
+        in_flight=context.options["in_flight_batches"],
+    )
+
+    async def pump():
+        try:
+            await pipe.pump(from_date=FROM_DATE)
+        finally:
+            await pipe.loader.close()
+
+    started_at = time.perf_counter()
+    asyncio.run(pump())
+    elapsed = time.perf_counter() - started_at
+
+    return server.documents, elapsed
+
+
+def run_stage(entity: str, stage: str, options: dict, results):
+    """Замер одной стадии (выполняется в отдельном процессе)"""
+    logging.basicConfig(level=logging.ERROR)
+    context = Context(entity, options)
+    rss_before = peak_rss()
+    items, elapsed = globals()[f"bench_{stage}"](context)
+    results.put(
+        {
+            "entity": entity,
+            "stage": stage,
+            "items": items,
+            "seconds": elapsed,
+            "rate": items / elapsed if elapsed else 0,
+            "peak_rss": peak_rss(),
+            "rss_growth": peak_rss() - rss_before,
+        }
+    )
+
+
+def measure(entity: str, stage: str, options: dict, repeat: int) -> dict:
+    """Лучший из repeat замеров, каждый в чистом процессе"""
+    mp_context = multiprocessing.get_context("spawn")
+    best = None
+    for _ in range(repeat):
+        results = mp_context.Queue()
+        process = mp_context.Process(
+            target=run_stage, args=(entity, stage, options, results)
+        )
+        process.start()
+        result = results.get()
+        process.join()
+        if best is None or result["rate"] > best["rate"]:
+            best = result
+
+    return best
+
+
+def compare(results: list, baseline: dict, tolerance: float) -> list:
+    """Замеры, которые медленнее базовых больше, чем на tolerance"""
+    regressions = []
+    for result in results:
+        key = f"{result['entity']}.{result['stage']}"
+        if key not in baseline:
+            continue
+        result["baseline_rate"] = baseline[key]["rate"]
+        if result["rate"] < baseline[key]["rate"] * (1 - tolerance):
+            regressions.append(key)
+
+    return regressions
+
+
+def report(results: list):
+    print(
+        f"{'entity':>8} {'stage':>10} {'items':>9} {'rate/s':>12} "
+        f"{'seconds':>8} {'peak RSS':>9} {'rss+':>8} {'vs base':>8}"
+    )
+    for result in results:
+        change = ""
+        if result.get("baseline_rate"):
+            change = f"{result['rate'] / result['baseline_rate'] - 1:+.0%}"
+        print(
+            f"{result['entity']:>8} {result['stage']:>10} {result['items']:>9} "
+            f"{result['rate']:>12,.0f} {result['seconds']:>8.3f} "
+            f"{result['peak_rss'] / 2 ** 20:>7.0f}Mi "
+            f"{result['rss_growth'] / 2 ** 20:>6.0f}Mi {change:>8}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="bench_pipeline",
+        description="Offline benchmark of the pipeline stages",
+        allow_abbrev=False,
+    )
+    parser.add_argument("--movies", type=int, default=20_000)
+    parser.add_argument("--persons", type=int, default=10_000)
+    parser.add_argument("--genres", type=int, default=30)
+    parser.add_argument("--roles_per_movie", type=int, default=10)
+    parser.add_argument("--genres_per_movie", type=int, default=3)
+    parser.add_argument(
+        "--entities", nargs="+", choices=list(ENTITIES), default=list(ENTITIES)
+    )
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument(
+        "--aggregated",
+        action=argparse.BooleanOptionalAction,
+        help="Use pre-aggregated rows (etl.py --aggregated)",
+        default=False,
+    )
+    parser.add_argument(
+        "--streaming", action=argparse.BooleanOptionalAction, default=False
+    )
+    parser.add_argument(
+        "--pipelined", action=argparse.BooleanOptionalAction, default=False
+    )
+    parser.add_argument("--lazy", action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument(
+        "--asyncio",
+        action=argparse.BooleanOptionalAction,
+        help="Measure the pipe stage on the asyncio engine (etl.py --asyncio)",
+        default=False,
+    )
+    parser.add_argument("--in_flight_batches", type=int, default=2)
+    parser.add_argument(
+        "--autotune",
+        action=argparse.BooleanOptionalAction,
+        help="Tune batch sizes on the fly (AUTOTUNE=true)",
+        default=False,
+    )
+    parser.add_argument(
+        "--compress", action=argparse.BooleanOptionalAction, default=False
+    )
+    parser.add_argument("--bulk_chunks", type=int, default=1)
+    parser.add_argument("--max_in_flight", type=int, default=1)
+    parser.add_argument("--bulk_max_bytes", type=int, default=10 * 1024 * 1024)
+    parser.add_argument(
+        "--baseline", type=str, help="Compare the results with a stored baseline"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        help="Allowed slowdown against the baseline (0.2 - 20%%)",
+        default=0.2,
+    )
+    parser.add_argument(
+        "--save-baseline", type=str, help="Store the results as a new baseline"
+    )
+    args = parser.parse_args()
+
+    options = {
+        name: getattr(args, name)
+        for name in (
+            "movies",
+            "persons",
+            "genres",
+            "roles_per_movie",
+            "genres_per_movie",
+            "aggregated",
+            "streaming",
+            "pipelined",
+            "lazy",
+            "asyncio",
+            "in_flight_batches",
+            "autotune",
+            "compress",
+            "bulk_chunks",
+            "max_in_flight",
+            "bulk_max_bytes",
+        )
+    }
+    print(", ".join(f"{name}={value}" for name, value in options.items()))
+
+    results = [
+        measure(entity, stage, options, args.repeat)
+        for entity in args.entities
+        for stage in args.stages
+    ]
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline.get("options") != options:
+            print("Warning: the baseline was measured with other options")
+        regressions = compare(results, baseline["results"], args.tolerance)
+
+    report(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as file:
+            json.dump(
+                {
+                    "options": options,
+                    "results": {
+                        f"{result['entity']}.{result['stage']}": result
+                        for result in results
+                    },
+                },
+                file,
+                indent=2,
+            )
+
+    if regressions:
+        print("Regressions:", ", ".join(regressions))
+        sys.exit(1)
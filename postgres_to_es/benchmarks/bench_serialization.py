@@ -0,0 +1,108 @@
+"""
+Микро-бенчмарк сериализации документов в тело bulk-запроса Elasticsearch.
+
+Сравнивает прежний путь (json.dumps + EnhancedJSONEncoder + dataclasses.asdict
+на каждый документ, строка действия отдельным json.dumps, склейка строк
+и кодирование в UTF-8) с etl.serializers.BulkSerializer.
+
+Запуск:
+    PYTHONPATH=. python benchmarks/bench_serialization.py --movies 100000
+"""
+import argparse
+import json
+import random
+import time
+import uuid
+
+from etl.entities import (
+    Actor,
+    Director,
+    ElasticSearchMovie,
+    EnhancedJSONEncoder,
+    Genre,
+    Writer,
+)
+from etl.serializers import BulkSerializer
+
+
+def generate_movies(amount: int, seed: int = 0) -> list:
+    """Синтетические фильмы: 3 жанра, 8 актёров, 1 режиссёр, 2 сценариста"""
+    rnd = random.Random(seed)
+
+    def uid():
+        return str(uuid.UUID(int=rnd.getrandbits(128)))
+
+    genres = [Genre(id=uid(), name=f"Жанр {i}") for i in range(30)]
+    persons = [(uid(), f"Иванов Иван {i}") for i in range(5000)]
+
+    movies = []
+    for i in range(amount):
+        movie = ElasticSearchMovie(
+            id=uid(),
+            title=f"Фильм номер {i}",
+            type="movie",
+            modified="2021-01-01 00:00:00.000000",
+            description="Описание фильма " * 10,
+            imdb_rating=round(rnd.uniform(0, 10), 1),
+            genres=rnd.sample(genres, 3),
+            actors=[Actor(*person) for person in rnd.sample(persons, 8)],
+            directors=[Director(*rnd.choice(persons))],
+            writers=[Writer(*person) for person in rnd.sample(persons, 2)],
+        )
+        movie.actors_names = [item.name for item in movie.actors]
+        movie.directors_names = [item.name for item in movie.directors]
+        movie.writers_names = [item.name for item in movie.writers]
+        movies.append(movie)
+
+    return movies
+
+
+def serialize_legacy(movies: list, index_name: str) -> bytes:
+    prepared_query = []
+    for row in movies:
+        prepared_query.extend(
+            [
+                json.dumps({"index": {"_index": index_name, "_id": row.id}}),
+                json.dumps(row, cls=EnhancedJSONEncoder),
+            ]
+        )
+    return ("\n".join(prepared_query) + "\n").encode("utf-8")
+
+
+def serialize_fast(movies: list, index_name: str) -> bytes:
+    return BulkSerializer(index_name).dump(movies)
+
+
+def measure(func, movies: list, repeat: int):
+    best = None
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        body = func(movies, "movies")
+        elapsed = time.perf_counter() - started_at
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, len(body)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="bench_serialization",
+        description="Benchmark of the _bulk body serialization",
+        allow_abbrev=False,
+    )
+    parser.add_argument("--movies", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    movies = generate_movies(args.movies)
+
+    results = {}
+    for name, func in (("legacy", serialize_legacy), ("fast", serialize_fast)):
+        elapsed, size = measure(func, movies, args.repeat)
+        results[name] = elapsed
+        print(
+            f"{name:>8}: {args.movies / elapsed:12,.0f} docs/s "
+            f"{elapsed:8.3f} s {size / 1024 / 1024:8.1f} MiB"
+        )
+
+    print(f" speedup: {results['legacy'] / results['fast']:12.1f}x")
@@ -0,0 +1,101 @@
+"""
+Генератор синтетических данных схемы content (фильмы, персоны, жанры
+и таблицы связей) для офлайн-бенчмарков. Данные живут в памяти и отдаются
+Экстракторами из benchmarks/fakes.py строками той же формы, что и запросы
+etl.extractor.
+"""
+import random
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+
+# роли как в content.person_roles: первая - самая частая
+ROLES = ("актёр", "режисёр", "сценарист")
+
+
+@dataclass
+class Dataset:
+    # {<id>: {<колонка>: <значение>}}
+    movies: dict = field(default_factory=dict)
+    persons: dict = field(default_factory=dict)
+    genres: dict = field(default_factory=dict)
+    # [(movie_id, person_id, role)]
+    movie_person_role: list = field(default_factory=list)
+    # [(movie_id, genre_id)]
+    movie_genre: list = field(default_factory=list)
+
+    def __str__(self):
+        return (
+            f"{len(self.movies)} movies, {len(self.persons)} persons, "
+            f"{len(self.genres)} genres, {len(self.movie_person_role)} roles, "
+            f"{len(self.movie_genre)} movie genres"
+        )
+
+
+def generate(
+    movies: int = 10_000,
+    persons: int = 5_000,
+    genres: int = 30,
+    roles_per_movie: int = 10,
+    genres_per_movie: int = 3,
+    seed: int = 0,
+) -> Dataset:
+    """
+    Синтетический каталог. Даты модификации разбросаны по году с повторами,
+    чтобы постраничное чтение по (modified, id) встречало одинаковые modified
+    """
+    rnd = random.Random(seed)
+    started_at = datetime(2021, 1, 1)
+
+    def uid() -> str:
+        return str(uuid.UUID(int=rnd.getrandbits(128)))
+
+    def modified() -> datetime:
+        return started_at + timedelta(minutes=rnd.randrange(525_600))
+
+    dataset = Dataset()
+
+    for i in range(genres):
+        genre_id = uid()
+        dataset.genres[genre_id] = {
+            "id": genre_id,
+            "name": f"Жанр {i}",
+            "modified": modified(),
+        }
+
+    for i in range(persons):
+        person_id = uid()
+        dataset.persons[person_id] = {
+            "id": person_id,
+            "full_name": f"Иванов Иван Иванович {i}",
+            "modified": modified(),
+        }
+
+    genre_ids = list(dataset.genres)
+    person_ids = list(dataset.persons)
+    for i in range(movies):
+        movie_id = uid()
+        dataset.movies[movie_id] = {
+            "id": movie_id,
+            "title": f"Фильм номер {i}",
+            "description": "Описание фильма " * 10,
+            "rating": round(rnd.uniform(0, 10), 1),
+            "type": "movie",
+            "created": started_at,
+            "modified": modified(),
+        }
+
+        # у каждого фильма есть хотя бы один режиссёр, остальные - актёры
+        # и сценаристы
+        cast = rnd.sample(person_ids, min(max(roles_per_movie, 1), len(person_ids)))
+        for position, person_id in enumerate(cast):
+            if position == 0:
+                role = ROLES[1]
+            else:
+                role = ROLES[0] if rnd.random() < 0.8 else ROLES[2]
+            dataset.movie_person_role.append((movie_id, person_id, role))
+
+        for genre_id in rnd.sample(genre_ids, min(genres_per_movie, len(genre_ids))):
+            dataset.movie_genre.append((movie_id, genre_id))
+
+    return dataset
@@ -0,0 +1,341 @@
+"""
+Заменители PostgreSQL и Elasticsearch для офлайн-бенчмарков:
+  - Экстракторы с интерфейсом etl.extractor.PgExtractor поверх Dataset
+    из benchmarks/datagen.py. get_data_by_ids отдаёт строки той же формы,
+    что и SQL настоящих Экстракторов (джойны или агрегаты): кортежи
+    etl.extractor.Rows с колонками в порядке SELECT, упорядоченные по id
+    объекта. iter_data_by_ids отдаёт те же строки лениво
+  - BulkServer - HTTP-сервер в отдельном потоке, принимающий _bulk
+    (в том числе gzip) и считающий документы
+  - MemoryStorage - хранилище состояния в памяти (etl.state)
+"""
+import bisect
+import gzip
+import itertools
+import json
+import threading
+from collections import defaultdict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator, Optional
+
+from benchmarks.datagen import Dataset
+from etl.extractor import FIRST_ID, Rows, RowsStream
+from etl.state import MemoryStorage  # noqa: F401
+
+
+class FakeExtractor:
+    """
+    Экстрактор поверх таблицы Dataset. Постраничное чтение по ключу
+    (modified, id) - через бинарный поиск по отсортированному индексу
+    """
+
+    source_table = ""
+    # атрибут Dataset с объектами таблицы
+    table = ""
+    # колонки строк get_data_by_ids - как в SELECT настоящего Экстрактора
+    columns = ()
+
+    def __init__(self, dataset: Dataset):
+        self.dataset = dataset
+        self.rows = getattr(dataset, self.table)
+        self.index = sorted((row["modified"], row["id"]) for row in self.rows.values())
+
+    def get_modified_ids(self, modified: str, last_id: Optional[str], limit: int):
+        start = bisect.bisect_right(
+            self.index, (datetime.fromisoformat(modified), last_id or FIRST_ID)
+        )
+        end = start + limit
+        return [
+            (row_id, row_modified) for row_modified, row_id in self.index[start:end]
+        ]
+
+    def iter_modified_ids(
+        self, modified: str, last_id: Optional[str], batch_size: int
+    ) -> Iterator[list]:
+        start = bisect.bisect_right(
+            self.index, (datetime.fromisoformat(modified), last_id or FIRST_ID)
+        )
+        rows = ((row_id, row_modified) for row_modified, row_id in self.index[start:])
+        while batch := list(itertools.islice(rows, batch_size)):
+            yield batch
+
+    def iter_rows(self, ids: tuple) -> Iterator[tuple]:
+        """Строки объектов в порядке ids - форма строк data_by_ids_sql"""
+        raise NotImplementedError
+
+    def get_data_by_ids(self, ids: tuple) -> Rows:
+        # ORDER BY id объекта, как в data_by_ids_sql
+        return Rows(list(self.iter_rows(sorted(ids))), self.column_indexes())
+
+    def iter_data_by_ids(self, ids: tuple) -> RowsStream:
+        return RowsStream(self.iter_rows(sorted(ids)), self.column_indexes())
+
+    def column_indexes(self) -> dict:
+        return {name: index for index, name in enumerate(self.columns)}
+
+
+class FakeMovieExtractor(FakeExtractor):
+    source_table = "content.movies"
+    table = "movies"
+    columns = (
+        "movie_id",
+        "title",
+        "description",
+        "rating",
+        "type",
+        "created",
+        "modified",
+        "person_role",
+        "person_id",
+        "person_full_name",
+        "genre_id",
+        "genre_name",
+    )
+
+    def __init__(self, dataset: Dataset):
+        super().__init__(dataset)
+        self.persons = defaultdict(list)
+        for movie_id, person_id, role in dataset.movie_person_role:
+            self.persons[movie_id].append((dataset.persons[person_id], role))
+        self.genres = defaultdict(list)
+        for movie_id, genre_id in dataset.movie_genre:
+            self.genres[movie_id].append(dataset.genres[genre_id])
+
+    def iter_rows(self, ids: tuple) -> Iterator[tuple]:
+        # декартово произведение персон и жанров - как LEFT JOIN в SQL
+        for movie_id in ids:
+            movie = self.rows[movie_id]
+            for (person, role), genre in itertools.product(
+                self.persons[movie_id] or [({}, None)],
+                self.genres[movie_id] or [{}],
+            ):
+                yield (
+                    movie_id,
+                    movie["title"],
+                    movie["description"],
+                    movie["rating"],
+                    movie["type"],
+                    movie["created"],
+                    movie["modified"],
+                    role,
+                    person.get("id"),
+                    person.get("full_name"),
+                    genre.get("id"),
+                    genre.get("name"),
+                )
+
+
+class FakeMovieAggregatedExtractor(FakeMovieExtractor):
+    columns = (
+        "movie_id",
+        "title",
+        "description",
+        "rating",
+        "type",
+        "created",
+        "modified",
+        "persons",
+        "genres",
+    )
+
+    def iter_rows(self, ids: tuple) -> Iterator[tuple]:
+        for movie_id in ids:
+            movie = self.rows[movie_id]
+            persons = defaultdict(list)
+            for person, role in self.persons[movie_id]:
+                persons[role].append({"id": person["id"], "name": person["full_name"]})
+
+            yield (
+                movie_id,
+                movie["title"],
+                movie["description"],
+                movie["rating"],
+                movie["type"],
+                movie["created"],
+                movie["modified"],
+                dict(persons),
+                [
+                    {"id": genre["id"], "name": genre["name"]}
+                    for genre in self.genres[movie_id]
+                ],
+            )
+
+
+class FakeGenreExtractor(FakeExtractor):
+    source_table = "content.genres"
+    table = "genres"
+    columns = (
+        "genre_id",
+        "genre_name",
+        "modified",
+        "movie_id",
+        "movie_title",
+        "movie_rating",
+    )
+
+    def __init__(self, dataset: Dataset):
+        super().__init__(dataset)
+        self.movies = defaultdict(list)
+        for movie_id, genre_id in dataset.movie_genre:
+            self.movies[genre_id].append(dataset.movies[movie_id])
+
+    def iter_rows(self, ids: tuple) -> Iterator[tuple]:
+        for genre_id in ids:
+            genre = self.rows[genre_id]
+            for movie in self.movies[genre_id] or [{}]:
+                yield (
+                    genre_id,
+                    genre["name"],
+                    genre["modified"],
+                    movie.get("id"),
+                    movie.get("title"),
+                    movie.get("rating"),
+                )
+
+
+class FakeGenreAggregatedExtractor(FakeGenreExtractor):
+    columns = ("genre_id", "genre_name", "modified", "movies")
+
+    def iter_rows(self, ids: tuple) -> Iterator[tuple]:
+        for genre_id in ids:
+            yield (
+                genre_id,
+                self.rows[genre_id]["name"],
+                self.rows[genre_id]["modified"],
+                [
+                    {
+                        "id": movie["id"],
+                        "title": movie["title"],
+                        "imdb_rating": movie["rating"],
+                    }
+                    for movie in self.movies[genre_id]
+                ],
+            )
+
+
+class FakePersonExtractor(FakeExtractor):
+    source_table = "content.persons"
+    table = "persons"
+    columns = (
+        "person_id",
+        "person_full_name",
+        "modified",
+        "person_role_name",
+        "movie_id",
+        "movie_title",
+    )
+
+    def __init__(self, dataset: Dataset):
+        super().__init__(dataset)
+        self.movies = defaultdict(list)
+        for movie_id, person_id, role in dataset.movie_person_role:
+            self.movies[person_id].append((dataset.movies[movie_id], role))
+
+    def iter_rows(self, ids: tuple) -> Iterator[tuple]:
+        for person_id in ids:
+            person = self.rows[person_id]
+            for movie, role in self.movies[person_id] or [({}, None)]:
+                yield (
+                    person_id,
+                    person["full_name"],
+                    person["modified"],
+                    role,
+                    movie.get("id"),
+                    movie.get("title"),
+                )
+
+
+class FakePersonAggregatedExtractor(FakePersonExtractor):
+    columns = ("person_id", "person_full_name", "modified", "movies")
+
+    def iter_rows(self, ids: tuple) -> Iterator[tuple]:
+        for person_id in ids:
+            person = self.rows[person_id]
+            # DISTINCT ON (m.id) - одна роль на фильм
+            movies = {}
+            for movie, role in self.movies[person_id]:
+                movies.setdefault(
+                    movie["id"],
+                    {"id": movie["id"], "title": movie["title"], "person_role": role},
+                )
+
+            yield (
+                person_id,
+                person["full_name"],
+                person["modified"],
+                list(movies.values()),
+            )
+
+
+class BulkServer:
+    """
+    Заменитель Elasticsearch: принимает _bulk и отвечает успехом без ошибок.
+    Индексы "существуют" с постоянным uuid, _mget документов не находит.
+
+        with BulkServer() as server:
+            os.environ["ELASTICSEARCH_URL"] = server.url
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.requests = 0
+        self.documents = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def __enter__(self) -> "BulkServer":
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="bulk_server", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.path.split("?")[0].endswith("_mget"):
+                    return self._reply({"docs": []})
+
+                size = len(body)
+                if self.headers.get("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+                with server._lock:
+                    server.requests += 1
+                    server.documents += body.count(b"\n") // 2
+                    server.bytes += size
+
+                self._reply({"took": 1, "errors": False})
+
+            def do_GET(self):
+                index_name = self.path.strip("/").split("/")[0]
+                self._reply({index_name: {"settings": {"index.uuid": "benchmark"}}})
+
+            def _reply(self, data: dict):
+                content = json.dumps(data).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -1,69 +1,299 @@
 import argparse
+import asyncio
+import functools
 import logging
+import os
 import signal
 import sys
-import time
+import threading
+from typing import Optional
 
-from etl.extractor import PgGenreExtractor, PgMovieExtractor, PgPersonExtractor
-from etl.loader import ESLoader
+from etl import aio, metrics
+from etl.backfill import backfill
+from etl.cache import DocumentHashCache
+from etl.extractor import (
+    PgGenreAggregatedExtractor,
+    PgGenreExtractor,
+    PgMovieAggregatedExtractor,
+    PgMovieExtractor,
+    PgPersonAggregatedExtractor,
+    PgPersonExtractor,
+)
+from etl.indexes import rebuild_indexes
+from etl.listener import PgChangesListener
+from etl.loader import DeadLetterFile, ESLoader
 from etl.pipes import PipeEETBL
+from etl.scheduler import PipesScheduler
 from etl.settings import settings
-from etl.state import JsonFileStorage, State
+from etl.state import CachedState, JsonFileStorage
 from etl.transformer import (
+    PGtoESGenresAggregatedTransformer,
     PGtoESGenresTransformer,
+    PGtoESMoviesAggregatedTransformer,
     PGtoESMoviesTransformer,
+    PGtoESPersonsAggregatedTransformer,
     PGtoESPersonsTransformer,
 )
 
 
-def main(from_date: str):
+def get_pipes_config(
+    streaming: bool = False,
+    aggregated: bool = False,
+    pipelined: bool = False,
+    lazy: bool = False,
+) -> list:
+    """
+    Конфигурации Пайплайнов. У каждого Пайплайна свои Экстрактор (соединение
+    с PG), Загрузчик и состояние, поэтому они могут работать параллельно
+    """
+    # один кеш хешей документов на все Загрузчики
+    hash_cache = (
+        DocumentHashCache(settings.es_hash_cache_path)
+        if settings.es_hash_cache_path
+        else None
+    )
+    dead_letters = (
+        DeadLetterFile(settings.es_dead_letters_path)
+        if settings.es_dead_letters_path
+        else None
+    )
+
+    # aggregated - PostgreSQL отдаёт одну строку на объект с уже собранными
+    # вложенными сущностями вместо декартова произведения джойнов
     pipes_config = [
         {
             "label": "Movies. Export from PG to ES",
-            "extractor": PgMovieExtractor(),
-            "loader": ESLoader(index_name="movies"),
-            "states_keeper": State(JsonFileStorage(), key_prefix="movies.pg_to_es."),
-            "transformer": PGtoESMoviesTransformer(source_unique_key="movie_id"),
+            "extractor": (
+                PgMovieAggregatedExtractor if aggregated else PgMovieExtractor
+            )(),
+            "loader": ESLoader(
+                index_name="movies",
+                bulk_chunks=settings.es_bulk_chunks,
+                max_in_flight=settings.es_max_in_flight,
+                pool_size=settings.es_pool_size,
+                timeout=(settings.es_connect_timeout, settings.es_read_timeout),
+                compress=settings.es_compress,
+                partial_updates=settings.es_partial_updates,
+                hash_cache=hash_cache,
+                retry_attempts=settings.es_retry_attempts,
+                retry_start_sleep=settings.es_retry_start_sleep,
+                retry_border_sleep=settings.es_retry_border_sleep,
+                dead_letters=dead_letters,
+            ),
+            "states_keeper": CachedState(
+                JsonFileStorage(),
+                key_prefix="movies.pg_to_es.",
+            ),
+            "transformer": (
+                PGtoESMoviesAggregatedTransformer
+                if aggregated
+                else PGtoESMoviesTransformer
+            )(source_unique_key="movie_id"),
             "extractor_batch_size": 1000,
             "loader_batch_size": 5000,
+            "extractor_batch_bounds": (100, 10000),
+            "loader_batch_bounds": (500, 20000),
+            "autotune": settings.autotune,
+            "loader_batch_bytes": settings.es_bulk_max_bytes,
+            "loader_batch_max_age": settings.es_bulk_max_age,
+            "streaming": streaming,
+            "pipelined": pipelined,
+            "lazy": lazy,
+            "fan_out_relations": (
+                ("persons", "genres") if settings.movies_fan_out else ()
+            ),
         },
         {
             "label": "Genres. Export from PG to ES",
-            "extractor": PgGenreExtractor(),
-            "loader": ESLoader(index_name="genres"),
-            "states_keeper": State(JsonFileStorage(), key_prefix="genres.pg_to_es."),
-            "transformer": PGtoESGenresTransformer(source_unique_key="genre_id"),
+            "extractor": (
+                PgGenreAggregatedExtractor if aggregated else PgGenreExtractor
+            )(),
+            "loader": ESLoader(
+                index_name="genres",
+                bulk_chunks=settings.es_bulk_chunks,
+                max_in_flight=settings.es_max_in_flight,
+                pool_size=settings.es_pool_size,
+                timeout=(settings.es_connect_timeout, settings.es_read_timeout),
+                compress=settings.es_compress,
+                partial_updates=settings.es_partial_updates,
+                hash_cache=hash_cache,
+                retry_attempts=settings.es_retry_attempts,
+                retry_start_sleep=settings.es_retry_start_sleep,
+                retry_border_sleep=settings.es_retry_border_sleep,
+                dead_letters=dead_letters,
+            ),
+            "states_keeper": CachedState(
+                JsonFileStorage(),
+                key_prefix="genres.pg_to_es.",
+            ),
+            "transformer": (
+                PGtoESGenresAggregatedTransformer
+                if aggregated
+                else PGtoESGenresTransformer
+            )(source_unique_key="genre_id"),
             "extractor_batch_size": 30,
             "loader_batch_size": 600,
+            "extractor_batch_bounds": (10, 300),
+            "loader_batch_bounds": (60, 6000),
+            "autotune": settings.autotune,
+            "loader_batch_bytes": settings.es_bulk_max_bytes,
+            "loader_batch_max_age": settings.es_bulk_max_age,
+            "streaming": streaming,
+            "pipelined": pipelined,
+            "lazy": lazy,
         },
         {
             "label": "Persons. Export from PG to ES",
-            "extractor": PgPersonExtractor(),
-            "loader": ESLoader(index_name="persons"),
-            "states_keeper": State(JsonFileStorage(), key_prefix="persons.pg_to_es."),
-            "transformer": PGtoESPersonsTransformer(source_unique_key="person_id"),
+            "extractor": (
+                PgPersonAggregatedExtractor if aggregated else PgPersonExtractor
+            )(),
+            "loader": ESLoader(
+                index_name="persons",
+                bulk_chunks=settings.es_bulk_chunks,
+                max_in_flight=settings.es_max_in_flight,
+                pool_size=settings.es_pool_size,
+                timeout=(settings.es_connect_timeout, settings.es_read_timeout),
+                compress=settings.es_compress,
+                partial_updates=settings.es_partial_updates,
+                hash_cache=hash_cache,
+                retry_attempts=settings.es_retry_attempts,
+                retry_start_sleep=settings.es_retry_start_sleep,
+                retry_border_sleep=settings.es_retry_border_sleep,
+                dead_letters=dead_letters,
+            ),
+            "states_keeper": CachedState(
+                JsonFileStorage(),
+                key_prefix="persons.pg_to_es.",
+            ),
+            "transformer": (
+                PGtoESPersonsAggregatedTransformer
+                if aggregated
+                else PGtoESPersonsTransformer
+            )(source_unique_key="person_id"),
             "extractor_batch_size": 100,
             "loader_batch_size": 1000,
+            "extractor_batch_bounds": (20, 2000),
+            "loader_batch_bounds": (100, 10000),
+            "autotune": settings.autotune,
+            "loader_batch_bytes": settings.es_bulk_max_bytes,
+            "loader_batch_max_age": settings.es_bulk_max_age,
+            "streaming": streaming,
+            "pipelined": pipelined,
+            "lazy": lazy,
         },
     ]
 
-    for pipe_conf in pipes_config:
-        pipe = PipeEETBL(**pipe_conf)
+    return pipes_config
+
+
+scheduler = PipesScheduler(
+    sleep_time=settings.sleep_time,
+    max_parallel=settings.pipes_max_parallel,
+    coalesce_time=settings.listen_coalesce_time,
+)
+
+
+def main(
+    from_date: str,
+    streaming: bool = False,
+    aggregated: bool = False,
+    pipelined: bool = False,
+    listen: bool = False,
+    lazy: bool = False,
+    rebuild: bool = False,
+    backfill_partitions: Optional[int] = None,
+    log_config: Optional[dict] = None,
+    asyncio_engine: bool = False,
+):
+    pipes = [
+        PipeEETBL(**pipe_conf)
+        for pipe_conf in get_pipes_config(
+            streaming=streaming, aggregated=aggregated, pipelined=pipelined, lazy=lazy
+        )
+    ]
+
+    listener = None
+    if listen:
+        # изменения приходят уведомлениями PG, опрос - только страховочный
+        listener = PgChangesListener(channel=settings.pg_notify_channel)
+        scheduler.sleep_time = settings.listen_sweep_interval
+
+    if settings.metrics_port is not None:
+        metrics.MetricsServer(settings.metrics_host, settings.metrics_port).start()
+    if settings.metrics_log_interval:
+        threading.Thread(
+            target=metrics.SummaryReporter(settings.metrics_log_interval).run,
+            args=(scheduler.stop_event,),
+            name="metrics_summary",
+            daemon=True,
+        ).start()
+
+    if rebuild:
+        # рабочий цикл начинается с позиций пересборки после переключения
+        # алиасов на новые версии индексов
+        rebuilt = rebuild_indexes(
+            pipes,
+            settings.es_indexes_path,
+            max_parallel=settings.pipes_max_parallel,
+            keep_old=settings.es_keep_old_indexes,
+            stop_event=scheduler.stop_event,
+        )
+        if not rebuilt:
+            logging.info("The rebuild has been interrupted")
+            return False
+
+    if backfill_partitions:
+        # процессы-исполнители собирают Пайплайны заново по тем же параметрам
+        pipes_factory = functools.partial(
+            get_pipes_config,
+            streaming=streaming,
+            aggregated=aggregated,
+            pipelined=pipelined,
+            lazy=lazy,
+        )
+        finished = backfill(
+            pipes,
+            pipes_factory,
+            partitions=backfill_partitions,
+            processes=settings.backfill_processes,
+            stop_event=scheduler.stop_event,
+            log_config=log_config,
+        )
+        if not finished:
+            logging.info("The backfill has been interrupted")
+            return False
 
-        logging.info("Launching a new pipeline: %s", pipe_conf["label"])
-        pipe.pump(from_date=from_date)
-        logging.info("Pipeline data pumping completed")
+    if asyncio_engine:
+        # у цикла событий свои Экстракторы и Загрузчики, а настройки,
+        # состояние и кеш хешей - те же, что у Пайплайнов выше
+        asyncio.run(
+            aio.run_pipes(
+                aio.build_pipes(pipes, in_flight=settings.aio_in_flight_batches),
+                from_date=from_date,
+                sleep_time=scheduler.sleep_time,
+                max_parallel=settings.pipes_max_parallel,
+                stop_event=scheduler.stop_event,
+            )
+        )
+        return True
+
+    # Пайплайны работают параллельно до сигнала остановки
+    scheduler.run(pipes, from_date=from_date, listener=listener)
 
     return True
 
 
 def sigcatch(signum, frame):
+    if scheduler.stop_event.is_set():
+        logging.info("A repeated shutdown signal (%s) was caught. Exit", signum)
+        sys.exit()
+
     logging.info(
         "A shutdown signal (%s) was caught in frame (%s). Shutting down...",
         signum,
         frame,
     )
-    sys.exit()
+    scheduler.stop()
 
 
 if __name__ == "__main__":
@@ -87,14 +317,88 @@ if __name__ == "__main__":
         type=str,
         help="Forces the export of data to start from the specified modification date",
     )
-    args = parser.parse_args()
-
-    logging.basicConfig(
-        filename="logs/etl.log", level=logging.getLevelName(args.log_level)
+    parser.add_argument(
+        "--stream",
+        action=argparse.BooleanOptionalAction,
+        help="Read modified ids with a single server-side cursor query "
+        "(recommended for a full reindex)",
+        default=False,
+    )
+    parser.add_argument(
+        "--aggregated",
+        action=argparse.BooleanOptionalAction,
+        help="Fetch one pre-aggregated row per object instead of joined rows",
+        default=False,
+    )
+    parser.add_argument(
+        "--pipelined",
+        action=argparse.BooleanOptionalAction,
+        help="Run extract, enrich/transform and load stages in parallel threads",
+        default=False,
+    )
+    parser.add_argument(
+        "--lazy",
+        action=argparse.BooleanOptionalAction,
+        help="Stream enrichment rows ordered by object id through a server-side "
+        "cursor and transform them one object at a time",
+        default=False,
+    )
+    parser.add_argument(
+        "--backfill",
+        type=int,
+        nargs="?",
+        const=os.cpu_count(),
+        metavar="PARTITIONS",
+        help="Reindex everything from START_DATE before the regular run: split "
+        "each table into PARTITIONS ranges of (modified, id) (default: CPU count) "
+        "and load them in parallel worker processes. An interrupted backfill "
+        "resumes its unfinished partitions",
+        default=None,
     )
+    parser.add_argument(
+        "--rebuild",
+        action=argparse.BooleanOptionalAction,
+        help="Rebuild the indexes from scratch into new versions (<index>_v<N>) "
+        "and atomically switch the index aliases to them before the regular run",
+        default=False,
+    )
+    parser.add_argument(
+        "--listen",
+        action=argparse.BooleanOptionalAction,
+        help="Wake up on PostgreSQL change notifications (LISTEN/NOTIFY) "
+        "instead of polling. Requires triggers from pg_triggers (init_pg.py)",
+        default=False,
+    )
+    parser.add_argument(
+        "--asyncio",
+        action=argparse.BooleanOptionalAction,
+        help="Run all pipelines on one asyncio event loop with asynchronous "
+        "PostgreSQL and ElasticSearch clients and several batches in flight",
+        default=False,
+    )
+    args = parser.parse_args()
+    if args.asyncio and (args.stream or args.pipelined or args.lazy or args.listen):
+        parser.error(
+            "--asyncio cannot be combined with --stream, --pipelined, --lazy "
+            "or --listen"
+        )
 
-    while True:
-        main(from_date=args.from_date)
+    log_config = {
+        "filename": "logs/etl.log",
+        "level": logging.getLevelName(args.log_level),
+        "format": "%(levelname)s:%(name)s:%(processName)s:%(threadName)s:%(message)s",
+    }
+    logging.basicConfig(**log_config)
 
-        logging.debug("Fall asleep for %d seconds ", settings.sleep_time)
-        time.sleep(settings.sleep_time)
+    main(
+        from_date=args.from_date,
+        streaming=args.stream,
+        aggregated=args.aggregated,
+        pipelined=args.pipelined,
+        listen=args.listen,
+        lazy=args.lazy,
+        rebuild=args.rebuild,
+        backfill_partitions=args.backfill,
+        log_config=log_config,
+        asyncio_engine=args.asyncio,
+    )
@@ -0,0 +1,806 @@
+import asyncio
+import collections
+import inspect
+import json
+import logging
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from urllib.parse import urljoin
+
+import aiohttp
+import psycopg2
+import psycopg2.extensions
+
+import etl.backoff
+from etl import metrics
+from etl.db import Connection, PoolTimeout, Query, get_pg_dns, prepared_statement
+from etl.extractor import PgExtractor, Rows, fetch_rows
+from etl.loader import BULK_PARAMS, RETRY_STATUSES, ESLoader
+from etl.pipes import (
+    IDLE_CHECK_INTERVAL,
+    PipeEETBL,
+    build_buffer,
+    coroutine,
+    init_extractor_state,
+    save_checkpoint,
+    transform,
+)
+from etl.settings import settings
+
+logger = logging.getLogger()
+
+# маркер конца потока данных в очередях между стадиями
+_END_OF_DATA = object()
+
+
+async def wait_ready(conn):
+    """
+    Дождаться, пока асинхронное соединение psycopg2 закончит операцию
+    (подключение, запрос), не блокируя цикл событий
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        if state == psycopg2.extensions.POLL_READ:
+            add, remove = loop.add_reader, loop.remove_reader
+        elif state == psycopg2.extensions.POLL_WRITE:
+            add, remove = loop.add_writer, loop.remove_writer
+        else:
+            raise psycopg2.OperationalError(f"Unexpected poll state: {state}")
+
+        ready = loop.create_future()
+        fd = conn.fileno()
+        add(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            remove(fd)
+
+
+async def execute_prepared(cur, query: Query):
+    """Асинхронный вариант etl.db.execute_prepared"""
+    types = tuple(query.types) or (None,) * len(query.params)
+    name, prepare, execute = prepared_statement(query.sql, types)
+    if name not in cur.connection.prepared:
+        cur.execute(prepare)
+        await wait_ready(cur.connection)
+        cur.connection.prepared.add(name)
+
+    cur.execute(execute, query.params)
+    await wait_ready(cur.connection)
+
+
+class AsyncConnectionPool:
+    """
+    Пул асинхронных соединений psycopg2 (async_=True) для цикла событий:
+    пока PostgreSQL выполняет запрос, цикл обслуживает другие Пайплайны.
+    Ограничение размера, ожидание свободного соединения и проверка
+    простаивавших соединений - как у etl.db.ConnectionPool.
+
+    Асинхронные соединения работают в autocommit: каждый запрос - отдельная
+    транзакция, только для чтения (default_transaction_read_only). Соединение,
+    на котором запрос прервался ошибкой или отменой, закрывается
+    """
+
+    def __init__(
+        self,
+        dsn: dict,
+        max_size: int = 10,
+        timeout: float = 30,
+        check_interval: float = 30,
+    ):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        # свободные соединения с моментом возврата: [(<conn>, <monotonic>), ...]
+        self._idle: List[Tuple[Connection, float]] = []
+        # семафор создаётся в цикле событий, в котором пул используется
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    async def _connect(self) -> Connection:
+        conn = psycopg2.connect(async_=True, connection_factory=Connection, **self.dsn)
+        try:
+            await wait_ready(conn)
+        except BaseException:
+            conn.close()
+            raise
+
+        return conn
+
+    async def _is_alive(self, conn: Connection, idle_since: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.check_interval:
+            return True
+
+        try:
+            conn.cursor().execute("SELECT 1")
+            await wait_ready(conn)
+        except psycopg2.Error:
+            return False
+
+        return True
+
+    async def _getconn(self) -> Connection:
+        while self._idle:
+            conn, idle_since = self._idle.pop()
+            if await self._is_alive(conn, idle_since):
+                return conn
+
+            logger.warning("A dead PostgreSQL connection is replaced")
+            metrics.PG_RECONNECTS.inc()
+            conn.close()
+
+        return await self._connect()
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[Connection]:
+        """Соединение из пула на время блока async with"""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_size)
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeout(
+                f"No free PostgreSQL connection in {self.timeout} s "
+                f"(pool size {self.max_size})"
+            ) from None
+
+        conn = None
+        try:
+            conn = await self._getconn()
+            yield conn
+        except BaseException:
+            # посреди запроса соединение не вернуть в рабочее состояние
+            if conn is not None:
+                conn.close()
+                conn = None
+            raise
+        finally:
+            if conn is not None and not conn.closed:
+                self._idle.append((conn, time.monotonic()))
+            self._slots.release()
+
+    def close(self):
+        """Закрыть свободные соединения пула"""
+        idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
+
+
+class AsyncPgExtractor:
+    """
+    Асинхронный Экстрактор поверх обычного (etl.extractor.PgExtractor):
+    те же запросы (методы *_query) и та же форма строк, но выполняются
+    через AsyncConnectionPool
+    """
+
+    def __init__(self, extractor: PgExtractor, pool: AsyncConnectionPool):
+        self.extractor = extractor
+        self.pool = pool
+        self.source_table = extractor.source_table
+
+    async def _fetch(self, query: Query, fetch):
+        async with self.pool.connection() as conn:
+            cur = conn.cursor()
+            await execute_prepared(cur, query)
+            return fetch(cur)
+
+    @etl.backoff.on_exception()
+    async def get_modified_ids(self, modified: str, last_id: Optional[str], limit: int):
+        query = self.extractor.modified_ids_query(modified, last_id, limit)
+        return await self._fetch(query, lambda cur: cur.fetchall())
+
+    @etl.backoff.on_exception(border_sleep_time=1)
+    async def get_data_by_ids(self, ids: tuple) -> Rows:
+        return await self._fetch(self.extractor.data_by_ids_query(ids), fetch_rows)
+
+    @etl.backoff.on_exception()
+    async def get_last_related_key(self, relation: str) -> Optional[tuple]:
+        query = self.extractor.last_related_key_query(relation)
+        return await self._fetch(query, lambda cur: cur.fetchone())
+
+    @etl.backoff.on_exception()
+    async def get_modified_related_ids(
+        self, relation: str, modified: str, last_id: Optional[str], limit: int
+    ):
+        query = self.extractor.modified_related_ids_query(
+            relation, modified, last_id, limit
+        )
+        return await self._fetch(query, lambda cur: cur.fetchall())
+
+    @etl.backoff.on_exception()
+    async def get_movie_ids_by_related_ids(
+        self,
+        relation: str,
+        related_ids: tuple,
+        last_movie_id: Optional[str],
+        limit: int,
+    ) -> list:
+        query = self.extractor.movie_ids_by_related_ids_query(
+            relation, related_ids, last_movie_id, limit
+        )
+        return await self._fetch(query, lambda cur: [row[0] for row in cur.fetchall()])
+
+
+class AsyncESLoader(ESLoader):
+    """
+    Загрузчик с асинхронным HTTP-клиентом (aiohttp): load_to_es - корутина.
+    Части пачки (bulk_chunks) отправляются конкурентно, а max_in_flight
+    ограничивает число _bulk запросов Загрузчика сразу для всех пачек,
+    которые загружаются одновременно. Разбор ответов, повторы документов,
+    отклонённых из-за перегрузки, dead_letters, кеш хешей и частичные
+    обновления - как у ESLoader
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # клиент и семафор создаются в цикле событий, в котором работает
+        # Загрузчик
+        self._client: Optional[aiohttp.ClientSession] = None
+        self._requests: Optional[asyncio.Semaphore] = None
+
+    @classmethod
+    def from_loader(cls, loader: ESLoader) -> "AsyncESLoader":
+        """Асинхронный Загрузчик с настройками обычного"""
+        return cls(
+            index_name=loader.index_name,
+            bulk_chunks=loader.bulk_chunks,
+            max_in_flight=loader.max_in_flight,
+            pool_size=loader.pool_size,
+            timeout=loader.timeout,
+            compress=loader.compress,
+            partial_updates=loader.partial_updates,
+            hash_cache=loader.hash_cache,
+            retry_attempts=loader.retry_attempts,
+            retry_start_sleep=loader.retry_start_sleep,
+            retry_border_sleep=loader.retry_border_sleep,
+            dead_letters=loader.dead_letters,
+        )
+
+    @property
+    def client(self) -> aiohttp.ClientSession:
+        if self._client is None:
+            self._client = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=max(self.pool_size, self.max_in_flight)
+                ),
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=self.timeout[0], sock_read=self.timeout[1]
+                ),
+            )
+            self._requests = asyncio.Semaphore(self.max_in_flight)
+
+        return self._client
+
+    async def close(self):
+        """Закрыть соединения с ES"""
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    async def load_to_es(self, records: list) -> bool:
+        if not records:
+            return True
+
+        payloads = self._get_payloads(records)
+
+        index_key, hashes = None, None
+        if self.hash_cache is not None:
+            index_key = await self._get_index_key()
+        if index_key is not None:
+            hashes = [self.hash_cache.hash(payload) for payload in payloads]
+            # запросы к SQLite кеша хешей - в потоке, не в цикле событий
+            records, payloads, hashes = await asyncio.to_thread(
+                self._skip_unchanged, index_key, records, payloads, hashes
+            )
+            if not records:
+                return True
+
+        documents = None
+        if self.partial_updates:
+            documents = [self._serializer.to_dict(record) for record in records]
+            sources = await asyncio.to_thread(
+                self._get_cached_sources, index_key, records
+            )
+            missing = [record.id for record in records if record.id not in sources]
+            if missing:
+                sources.update(await self._get_sources(missing))
+            payloads = self._get_update_payloads(records, documents, sources)
+
+        # пачки загружаются одновременно - у каждой свой набор отложенных id
+        dead_lettered = set()
+        if not await self._load_payloads(payloads, dead_lettered):
+            return False
+
+        if hashes is not None:
+            await asyncio.to_thread(
+                self._stage_hashes, index_key, records, hashes, documents, dead_lettered
+            )
+
+        return True
+
+    async def _load_payloads(self, payloads: List[bytes], dead_lettered: set) -> bool:
+        if not payloads:
+            return True
+
+        chunks = self._split(payloads, self.bulk_chunks)
+        # ждём все части: даже если одна из них не загрузилась, остальные
+        # не должны остаться висеть в цикле событий
+        loaded = await asyncio.gather(
+            *(self._load_chunk(chunk, dead_lettered) for chunk in chunks)
+        )
+        return all(loaded)
+
+    @etl.backoff.on_exception()
+    async def _get_index_key(self) -> Optional[str]:
+        if self._index_key is not None:
+            return self._index_key
+
+        async with self.client.get(
+            urljoin(self.url, f"{self.index_name}/_settings/index.uuid"),
+            params={"flat_settings": "true"},
+        ) as response:
+            if response.status == 404:
+                return None
+            response.raise_for_status()
+            content = await response.read()
+
+        return await asyncio.to_thread(self._remember_index_key, json.loads(content))
+
+    @etl.backoff.on_exception()
+    async def _get_sources(self, ids: List[str]) -> Dict[str, dict]:
+        async with self.client.post(
+            urljoin(self.url, f"{self.index_name}/_mget"),
+            params={"filter_path": "docs._id,docs._source"},
+            json={"ids": ids},
+        ) as response:
+            if response.status == 404:
+                return {}
+            response.raise_for_status()
+            content = await response.read()
+
+        return {
+            doc["_id"]: doc["_source"]
+            for doc in json.loads(content).get("docs", [])
+            if "_source" in doc
+        }
+
+    async def _load_chunk(self, payloads: List[bytes], dead_lettered: set) -> bool:
+        for tries in range(self.retry_attempts + 1):
+            if tries:
+                metrics.ES_RETRIES.inc(len(payloads), index=self.index_name)
+                await asyncio.sleep(
+                    etl.backoff.jittered_sleep_time(
+                        tries - 1,
+                        start_sleep_time=self.retry_start_sleep,
+                        border_sleep_time=self.retry_border_sleep,
+                    )
+                )
+
+            payloads, success = await self._send_bulk(payloads, dead_lettered)
+            if not success:
+                return False
+            if not payloads:
+                return True
+
+        logger.error(
+            "%d documents have not been accepted by ES after %d retries",
+            len(payloads),
+            self.retry_attempts,
+        )
+
+        return False
+
+    @etl.backoff.on_exception()
+    async def _send_bulk(
+        self, payloads: List[bytes], dead_lettered: set
+    ) -> Tuple[List[bytes], bool]:
+        body, headers = self._get_bulk_request(payloads)
+        client = self.client
+        async with self._requests, client.post(
+            urljoin(self.url, "_bulk"), params=BULK_PARAMS, headers=headers, data=body
+        ) as response:
+            if response.status >= 400 and response.status not in RETRY_STATUSES:
+                response.raise_for_status()
+            content = await response.read()
+
+        retry, success, rejected_ids = self._handle_bulk_response(
+            payloads, response.status, content
+        )
+        dead_lettered.update(rejected_ids)
+
+        return retry, success
+
+
+async def _call(func, *args, **kwargs):
+    """
+    Вызвать метод Экстрактора или Загрузчика: корутину или обычную функцию
+    """
+    result = func(*args, **kwargs)
+    if inspect.isawaitable(result):
+        result = await result
+
+    return result
+
+
+class LoadFailed(Exception):
+    """Пачка не загрузилась в ES: перекачка останавливается"""
+
+
+class AsyncPipeEETBL:
+    """
+    Пайплайн на asyncio: те же стадии, что и у PipeEETBL, но это задачи
+    одного цикла событий, связанные ограниченными очередями (queue_size
+    пачек):
+      - extract, затем fan_out
+      - enrich -> transform -> buffer
+      - load: до in_flight пачек загружаются одновременно, а точка
+            восстановления сдвигается в порядке извлечения - после того, как
+            ES подтвердил все предыдущие пачки
+
+    Настройки, Трансформер, состояние и подбор размеров пачек берутся
+    у обычного Пайплайна pipe, а Экстрактор и Загрузчик - свои, асинхронные:
+    AsyncPgExtractor и AsyncESLoader (их методы могут быть и обычными
+    функциями, но тогда они блокируют цикл событий). Режимы streaming,
+    lazy, pipelined и уведомления PG (push) есть только у PipeEETBL
+    """
+
+    def __init__(
+        self, pipe: PipeEETBL, extractor: object, loader: object, in_flight: int = 2
+    ):
+        if pipe.streaming or pipe.lazy or pipe.pipelined:
+            raise ValueError(
+                "The streaming, lazy and pipelined modes are not supported "
+                "by the asyncio engine"
+            )
+        self.pipe = pipe
+        self.extractor = extractor
+        self.loader = loader
+        self.in_flight = max(in_flight, 1)
+        self.serializer = getattr(loader, "serialize", None)
+
+    @property
+    def label(self) -> str:
+        return self.pipe.label
+
+    @property
+    def states_keeper(self):
+        return self.pipe.states_keeper
+
+    async def pump(self, from_date: str, stop_event=None) -> bool:
+        """
+        Перекачать все изменившиеся данные. stop_event (threading.Event)
+        позволяет прервать перекачку между пачками. Если пачка не загрузилась,
+        перекачка останавливается и возвращается False
+        """
+        ids_queue = asyncio.Queue(maxsize=self.pipe.queue_size)
+        batches_queue = asyncio.Queue(maxsize=self.pipe.queue_size)
+        stages = [
+            asyncio.ensure_future(self._extract(ids_queue, from_date, stop_event)),
+            asyncio.ensure_future(self._transform(ids_queue, batches_queue)),
+            asyncio.ensure_future(self._load(batches_queue)),
+        ]
+
+        try:
+            await asyncio.wait(stages, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            # стадия упала (или перекачку отменили) - остальные останавливаются
+            for stage in stages:
+                stage.cancel()
+            results = await asyncio.gather(*stages, return_exceptions=True)
+            self.states_keeper.checkpoint()
+            metrics.set_lag(self.label, self.states_keeper.get_state("loader.modified"))
+
+        for result in results:
+            if isinstance(result, LoadFailed):
+                logging.warning("%s: the batch has not been loaded", self.label)
+                return False
+            if isinstance(result, Exception):
+                raise result
+
+        logging.debug("Done. The pipeline has run out of data.")
+
+        return True
+
+    async def _extract(self, ids_queue: asyncio.Queue, from_date: str, stop_event):
+        state = self.states_keeper
+        init_extractor_state(from_date, state=state)
+
+        while not (stop_event and stop_event.is_set()):
+            modified = state.get_state("extractor.modified")
+            last_id = state.get_state("extractor.id")
+            limit = self.pipe.get_extractor_batch_size()
+
+            with metrics.observe_stage(self.label, "extract"):
+                data = await _call(
+                    self.extractor.get_modified_ids,
+                    modified=modified,
+                    last_id=last_id,
+                    limit=limit,
+                )
+            metrics.count_items(self.label, "extract", len(data))
+
+            logging.info(
+                "The data has been extracted. Params: (modified, id) > (%s, %s) "
+                + "LIMIT %d. Amount %d",
+                modified,
+                last_id,
+                limit,
+                len(data),
+            )
+            if not data:
+                break
+
+            state.set_state(
+                "extractor.modified",
+                str(data[-1][1].strftime("%Y-%m-%d %H:%M:%S.%f")),
+            )
+            state.set_state("extractor.id", str(data[-1][0]))
+            await ids_queue.put(tuple(item[0] for item in data))
+
+        if self.pipe.fan_out_relations:
+            await self._fan_out(ids_queue, from_date, stop_event)
+
+        await ids_queue.put(_END_OF_DATA)
+
+    async def _fan_out(self, ids_queue: asyncio.Queue, from_date: str, stop_event):
+        """Асинхронный вариант etl.pipes.fan_out"""
+        state = self.states_keeper
+        batch_size = self.pipe.get_extractor_batch_size()
+
+        for relation in self.pipe.fan_out_relations:
+            prefix = f"fan_out.{relation}."
+
+            if from_date:
+                state.set_state(prefix + "modified", from_date)
+                state.set_state(prefix + "id", None)
+            if not state.get_state(prefix + "modified"):
+                last_key = await _call(self.extractor.get_last_related_key, relation)
+                if not last_key:
+                    continue
+                state.set_state(
+                    prefix + "modified",
+                    str(last_key[1].strftime("%Y-%m-%d %H:%M:%S.%f")),
+                )
+                state.set_state(prefix + "id", str(last_key[0]))
+
+            while not (stop_event and stop_event.is_set()):
+                modified = state.get_state(prefix + "modified")
+                last_id = state.get_state(prefix + "id")
+
+                with metrics.observe_stage(self.label, "fan_out"):
+                    related = await _call(
+                        self.extractor.get_modified_related_ids,
+                        relation,
+                        modified=modified,
+                        last_id=last_id,
+                        limit=batch_size,
+                    )
+                if not related:
+                    break
+
+                related_ids = tuple(item[0] for item in related)
+
+                amount, last_target_id = 0, None
+                while True:
+                    with metrics.observe_stage(self.label, "fan_out"):
+                        target_ids = await _call(
+                            self.extractor.get_movie_ids_by_related_ids,
+                            relation,
+                            related_ids,
+                            last_movie_id=last_target_id,
+                            limit=batch_size,
+                        )
+                    if not target_ids:
+                        break
+                    metrics.count_items(self.label, "fan_out", len(target_ids))
+
+                    await ids_queue.put(tuple(target_ids))
+                    amount += len(target_ids)
+                    last_target_id = target_ids[-1]
+
+                logging.info(
+                    "Changes of %d %s have been fanned out to %d objects",
+                    len(related),
+                    relation,
+                    amount,
+                )
+
+                state.set_state(
+                    prefix + "modified",
+                    str(related[-1][1].strftime("%Y-%m-%d %H:%M:%S.%f")),
+                )
+                state.set_state(prefix + "id", str(related[-1][0]))
+
+    async def _transform(self, ids_queue: asyncio.Queue, batches_queue: asyncio.Queue):
+        # transform и buffer - те же корутины, что у PipeEETBL: сформированные
+        # пачки собираются в список и передаются в очередь load
+        batches = []
+
+        @coroutine
+        def collect():
+            while batch := (yield):
+                batches.append(batch)
+
+        buffer = build_buffer()
+        buffer_stage = buffer(
+            collect(),
+            batch_size=self.pipe.get_loader_batch_size,
+            max_bytes=self.pipe.loader_batch_bytes,
+            max_age=self.pipe.loader_batch_max_age,
+            serializer=self.serializer,
+            label=self.label,
+        )
+        pipe_head = transform(
+            buffer_stage, transformer=self.pipe.transformer, label=self.label
+        )
+        # пока extract ждёт ответа PG, буфер проверяет возраст пачки
+        idle_timeout = (
+            None if self.pipe.loader_batch_max_age is None else IDLE_CHECK_INTERVAL
+        )
+
+        while True:
+            try:
+                ids = await asyncio.wait_for(ids_queue.get(), idle_timeout)
+            except asyncio.TimeoutError:
+                buffer_stage.send([])
+                while batches:
+                    await batches_queue.put(batches.pop(0))
+                continue
+            if ids is _END_OF_DATA:
+                break
+
+            with metrics.observe_stage(self.label, "enrich"):
+                data = await _call(self.extractor.get_data_by_ids, ids)
+            metrics.count_items(self.label, "enrich", len(data))
+
+            logging.info(
+                "The data has been enriched. Number of rows received %d", len(data)
+            )
+
+            # пустой список остановил бы корутину transform
+            if data:
+                pipe_head.send(data)
+            while batches:
+                await batches_queue.put(batches.pop(0))
+
+        # проталкиваем дальше то, что осталось в буфере
+        buffer(collect(), batch_size=1).send(None)
+        while batches:
+            await batches_queue.put(batches.pop(0))
+
+        await batches_queue.put(_END_OF_DATA)
+
+    async def _load_batch(self, batch: list) -> bool:
+        with metrics.observe_stage(self.label, "load"):
+            return await _call(self.loader.load_to_es, batch)
+
+    async def _load(self, batches_queue: asyncio.Queue):
+        # [(<пачка>, <задача загрузки>), ...] в порядке извлечения
+        in_flight = collections.deque()
+
+        async def confirm():
+            batch, loading = in_flight.popleft()
+            loaded = await loading
+            if self.pipe.tuner is not None:
+                self.pipe.tuner.update()
+            if not loaded:
+                raise LoadFailed()
+
+            # запись состояния и хешей документов (SQLite) - в потоке
+            await asyncio.to_thread(
+                save_checkpoint,
+                batch,
+                loader=self.loader,
+                state=self.states_keeper,
+                label=self.label,
+            )
+
+        try:
+            while (batch := await batches_queue.get()) is not _END_OF_DATA:
+                logging.info("%d records will be uploaded to ElasticSearch", len(batch))
+                in_flight.append(
+                    (batch, asyncio.ensure_future(self._load_batch(batch)))
+                )
+
+                # точка восстановления сдвигается только по порядку пачек
+                while in_flight and (
+                    len(in_flight) >= self.in_flight or in_flight[0][1].done()
+                ):
+                    await confirm()
+
+            while in_flight:
+                await confirm()
+        finally:
+            for _, loading in in_flight:
+                loading.cancel()
+
+
+async def _sleep(stop_event: threading.Event, timeout: float):
+    """Уснуть на timeout секунд или до stop_event"""
+    deadline = time.monotonic() + timeout
+    while not stop_event.is_set() and (remaining := deadline - time.monotonic()) > 0:
+        await asyncio.sleep(min(remaining, 0.1))
+
+
+async def run_pipes(
+    pipes: List[AsyncPipeEETBL],
+    from_date: Optional[str] = None,
+    sleep_time: float = 1,
+    max_parallel: Optional[int] = None,
+    stop_event: Optional[threading.Event] = None,
+):
+    """
+    Запустить Пайплайны в текущем цикле событий, как PipesScheduler потоки:
+    каждый перекачивает изменения и засыпает на sleep_time секунд, не больше
+    max_parallel перекачек одновременно. stop_event (его выставляет
+    обработчик сигналов) останавливает всё между пачками
+    """
+    stop_event = stop_event or threading.Event()
+    slots = asyncio.Semaphore(max_parallel or len(pipes))
+
+    async def run_pipe(pipe: AsyncPipeEETBL):
+        pipe_from_date = from_date
+        while not stop_event.is_set():
+            async with slots:
+                try:
+                    logging.info("Launching a new pipeline: %s", pipe.label)
+                    await pipe.pump(from_date=pipe_from_date, stop_event=stop_event)
+                    logging.info("Pipeline data pumping completed")
+                except Exception:
+                    logging.exception("Pipeline '%s' has failed", pipe.label)
+            # дата принудительного старта - только для первой перекачки
+            pipe_from_date = None
+            await _sleep(stop_event, sleep_time)
+
+    try:
+        await asyncio.gather(*(run_pipe(pipe) for pipe in pipes))
+    finally:
+        pools = []
+        for pipe in pipes:
+            close = getattr(pipe.loader, "close", None)
+            if close is not None:
+                await _call(close)
+            pool = getattr(pipe.extractor, "pool", None)
+            if pool is not None and pool not in pools:
+                pools.append(pool)
+        for pool in pools:
+            pool.close()
+
+    logging.info("All pipelines have been stopped")
+
+
+def build_pipes(pipes: List[PipeEETBL], in_flight: int = 2) -> List[AsyncPipeEETBL]:
+    """
+    Асинхронные Пайплайны поверх обычных: Экстракторы делят один
+    AsyncConnectionPool, Загрузчики переходят на aiohttp с теми же
+    настройками и тем же кешем хешей документов
+    """
+    dsn = get_pg_dns()
+    pool = AsyncConnectionPool(
+        dict(
+            dsn,
+            options=dsn["options"] + " -c default_transaction_read_only=on",
+            keepalives=1,
+            keepalives_idle=30,
+        ),
+        max_size=settings.pg_pool_size,
+        timeout=settings.pg_pool_timeout,
+        check_interval=settings.pg_pool_check_interval,
+    )
+
+    return [
+        AsyncPipeEETBL(
+            pipe,
+            extractor=AsyncPgExtractor(pipe.extractor, pool),
+            loader=AsyncESLoader.from_loader(pipe.loader),
+            in_flight=in_flight,
+        )
+        for pipe in pipes
+    ]
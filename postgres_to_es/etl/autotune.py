@@ -0,0 +1,142 @@
+import logging
+from typing import Dict, Optional, Tuple
+
+from etl import metrics
+
+logger = logging.getLogger()
+
+
+class BatchSizeTuner:
+    """
+    Подбор размеров пачек Пайплайна на ходу по принципу AIMD (как окно TCP):
+    пока стадия укладывается в целевое время, размер её пачки растёт на
+    постоянный шаг (increase от начального размера), как только не
+    укладывается - уменьшается в 1 / decrease раз. Размеры не выходят
+    за границы (min, max).
+      - extractor_batch_size - по среднему времени запроса строк объектов
+            (стадия enrich) и цели enrich_seconds
+      - loader_batch_size - по среднему времени _bulk запросов (стадия load)
+            и цели load_seconds. Отказы ES из-за перегрузки (429,
+            es_rejected_execution_exception) уменьшают пачку сразу. Индекс
+            читается у Загрузчика loader на каждой подстройке: пересборка
+            переключает его через set_index
+
+    Замеры берутся из etl.metrics: средние с прошлой подстройки (update),
+    которая выполняется после каждой загруженной пачки
+    """
+
+    def __init__(
+        self,
+        label: str,
+        loader: object,
+        extractor_batch_size: int,
+        loader_batch_size: int,
+        extractor_bounds: Optional[Tuple[int, int]] = None,
+        loader_bounds: Optional[Tuple[int, int]] = None,
+        enrich_seconds: float = 1.0,
+        load_seconds: float = 5.0,
+        increase: float = 0.1,
+        decrease: float = 0.5,
+    ):
+        self.label = label
+        self.loader = loader
+        self.extractor_batch_size = extractor_batch_size
+        self.loader_batch_size = loader_batch_size
+        # по умолчанию - на порядок в обе стороны от начального размера
+        self.extractor_bounds = extractor_bounds or (
+            max(extractor_batch_size // 10, 1),
+            extractor_batch_size * 10,
+        )
+        self.loader_bounds = loader_bounds or (
+            max(loader_batch_size // 10, 1),
+            loader_batch_size * 10,
+        )
+        self.enrich_seconds = enrich_seconds
+        self.load_seconds = load_seconds
+        self.decrease = decrease
+        self._extractor_step = max(round(extractor_batch_size * increase), 1)
+        self._loader_step = max(round(loader_batch_size * increase), 1)
+
+        self._totals = {
+            stage: metrics.STAGE_SECONDS.total(pipe=label, stage=stage)
+            for stage in ("enrich", "load")
+        }
+        # отказы ES по индексам на момент прошлой подстройки
+        self._rejections: Dict[str, int] = {
+            self.index_name: metrics.ES_REJECTIONS.value(index=self.index_name)
+        }
+        self._publish()
+
+    @property
+    def index_name(self) -> str:
+        """Индекс, в который сейчас загружает Загрузчик"""
+        return getattr(self.loader, "index_name", "")
+
+    def _average(self, stage: str) -> Optional[float]:
+        """Среднее время вызова стадии с прошлой подстройки"""
+        total, count = metrics.STAGE_SECONDS.total(pipe=self.label, stage=stage)
+        previous_total, previous_count = self._totals[stage]
+        self._totals[stage] = (total, count)
+        if count == previous_count:
+            return None
+
+        return (total - previous_total) / (count - previous_count)
+
+    def _adjust(
+        self, size: int, step: int, bounds: Tuple[int, int], overloaded: bool
+    ) -> int:
+        if overloaded:
+            size = int(size * self.decrease)
+        else:
+            size += step
+
+        return min(max(size, bounds[0]), bounds[1])
+
+    def _publish(self):
+        metrics.TUNED_BATCH_SIZE.set(
+            self.extractor_batch_size, pipe=self.label, stage="extract"
+        )
+        metrics.TUNED_BATCH_SIZE.set(
+            self.loader_batch_size, pipe=self.label, stage="load"
+        )
+
+    def update(self):
+        """Подстроить размеры пачек по замерам с прошлой подстройки"""
+        index_name = self.index_name
+        rejections = metrics.ES_REJECTIONS.value(index=index_name)
+        # у нового индекса отказы считаются с нуля
+        rejected = rejections > self._rejections.get(index_name, 0)
+        self._rejections[index_name] = rejections
+
+        sizes = (self.extractor_batch_size, self.loader_batch_size)
+
+        enrich = self._average("enrich")
+        if enrich is not None:
+            self.extractor_batch_size = self._adjust(
+                self.extractor_batch_size,
+                self._extractor_step,
+                self.extractor_bounds,
+                overloaded=enrich > self.enrich_seconds,
+            )
+
+        load = self._average("load")
+        if load is not None or rejected:
+            self.loader_batch_size = self._adjust(
+                self.loader_batch_size,
+                self._loader_step,
+                self.loader_bounds,
+                overloaded=rejected or load > self.load_seconds,
+            )
+
+        if (self.extractor_batch_size, self.loader_batch_size) != sizes:
+            logger.debug(
+                "%s: batch sizes are tuned to %d (extract), %d (load). "
+                "Average enrich %s s, load %s s, ES rejections: %s",
+                self.label,
+                self.extractor_batch_size,
+                self.loader_batch_size,
+                enrich,
+                load,
+                rejected,
+            )
+            self._publish()
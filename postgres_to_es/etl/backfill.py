@@ -0,0 +1,234 @@
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+from typing import Callable, List, Optional
+
+from etl.pipes import PipeEETBL
+from etl.settings import settings
+from etl.state import CachedState
+
+logger = logging.getLogger()
+
+# ключ плана в состоянии Пайплайна: [[from_modified, from_id, until_modified,
+# until_id], ...] - границы частей (modified, id), нижняя не включительно
+PLAN_KEY = "backfill.partitions"
+
+# сигнал остановки процессам-исполнителям и конфигурации Пайплайнов
+# по label, собранные один раз на процесс (см. _init_worker)
+_stop_event = None
+_pipes_configs = {}
+
+
+def _format_modified(modified) -> str:
+    return modified.strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+def partition_state(state: CachedState, partition: int) -> CachedState:
+    """
+    Состояние части: в том же хранилище, что и состояние Пайплайна,
+    с префиксом <префикс Пайплайна>backfill.<номер части>.
+    """
+    return CachedState(
+        state.storage,
+        key_prefix=f"{state.key_prefix}backfill.{partition}.",
+    )
+
+
+def plan_partitions(pipe: PipeEETBL, partitions: int) -> list:
+    """
+    План полной переиндексации Пайплайна: таблица делится на partitions
+    частей с равным числом строк по ключу (modified, id). Незавершённый план
+    из состояния используется как есть - части продолжаются со своих
+    контрольных точек
+    """
+    state = pipe.states_keeper
+    plan = state.get_state(PLAN_KEY)
+    if plan:
+        if len(plan) != partitions:
+            logger.warning(
+                "%s: resuming the unfinished backfill of %d partitions",
+                pipe.label,
+                len(plan),
+            )
+        return plan
+
+    bounds = pipe.extractor.get_partition_bounds(
+        modified=settings.start_date, last_id=None, partitions=partitions
+    )
+
+    plan = []
+    lower = [settings.start_date, None]
+    for until_id, until_modified in bounds:
+        upper = [_format_modified(until_modified), str(until_id)]
+        plan.append(lower + upper)
+        lower = upper
+
+    for partition, (from_modified, from_id, _, _) in enumerate(plan):
+        part_state = partition_state(state, partition)
+        # нижняя граница - точка восстановления части: с неё продолжает
+        # Экстрактор (init_extractor_state)
+        part_state.set_state("extractor.modified", from_modified)
+        part_state.set_state("extractor.id", from_id)
+        part_state.set_state("loader.modified", from_modified)
+        part_state.set_state("loader.id", from_id)
+        part_state.set_state("done", False)
+        part_state.checkpoint()
+
+    state.set_state(PLAN_KEY, plan)
+    state.checkpoint()
+    logger.info("%s: the backfill is split into %d partitions", pipe.label, len(plan))
+
+    return plan
+
+
+def _init_worker(stop_event, log_config: dict, pipes_factory: Callable[[], list]):
+    global _stop_event, _pipes_configs
+    _stop_event = stop_event
+    # остановкой управляет основной процесс через stop_event: Ctrl+C
+    # в терминале не должен обрывать части посреди пачки
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(**log_config)
+    # Пайплайны собираются заново в каждом процессе (соединения с PG и ES
+    # не переживают передачу между процессами), но один раз на все его части
+    _pipes_configs = {config["label"]: config for config in pipes_factory()}
+
+
+def run_partition(label: str, partition: int):
+    """Перекачать одну часть плана (в процессе-исполнителе)"""
+    config = _pipes_configs[label]
+    state = partition_state(config["states_keeper"], partition)
+    if state.get_state("done"):
+        return True
+
+    plan = CachedState(
+        config["states_keeper"].storage, config["states_keeper"].key_prefix
+    ).get_state(PLAN_KEY)
+    _, _, until_modified, until_id = plan[partition]
+
+    extractor = config["extractor"]
+    extractor.until = (until_modified, until_id)
+    pipe = PipeEETBL(
+        **{
+            **config,
+            "label": f"{label} [{partition + 1}/{len(plan)}]",
+            "states_keeper": state,
+            # полная переиндексация и так перекачивает все объекты
+            "fan_out_relations": (),
+        }
+    )
+    logger.info(
+        "%s: backfill up to (%s, %s) started", pipe.label, until_modified, until_id
+    )
+
+    pipe.pump(from_date=None, stop_event=_stop_event)
+    if _stop_event is not None and _stop_event.is_set():
+        return False
+
+    state.set_state("done", True)
+    state.checkpoint()
+    logger.info("%s: backfill finished", pipe.label)
+
+    return True
+
+
+def finish_backfill(pipe: PipeEETBL, plan: list) -> bool:
+    """
+    Если все части плана перекачаны - обычный Пайплайн продолжает с верхней
+    границы последней части, план удаляется
+    """
+    if not all(
+        partition_state(pipe.states_keeper, partition).get_state("done")
+        for partition in range(len(plan))
+    ):
+        return False
+
+    state = pipe.states_keeper
+    if plan:
+        until = tuple(plan[-1][2:])
+        checkpoint = (
+            state.get_state("loader.modified") or "",
+            state.get_state("loader.id") or "",
+        )
+        if until > checkpoint:
+            state.set_state("loader.modified", until[0])
+            state.set_state("loader.id", until[1])
+            state.set_state("extractor.modified", until[0])
+            state.set_state("extractor.id", until[1])
+    state.set_state(PLAN_KEY, None)
+    state.checkpoint()
+    logger.info("%s: the backfill is complete", pipe.label)
+
+    return True
+
+
+def backfill(
+    pipes: List[PipeEETBL],
+    pipes_factory: Callable[[], list],
+    partitions: int,
+    processes: Optional[int] = None,
+    stop_event: Optional[threading.Event] = None,
+    log_config: Optional[dict] = None,
+    mp_context=None,
+) -> bool:
+    """
+    Параллельная полная переиндексация: таблица каждого Пайплайна делится
+    на partitions частей по (modified, id), части перекачиваются независимо
+    в пуле из processes процессов (по умолчанию - по числу ядер). У каждой
+    части своя контрольная точка - после падения продолжаются только
+    незавершённые части.
+
+    pipes_factory - конфигурации Пайплайнов (как etl.py get_pipes_config),
+    должна передаваться между процессами (pickle) и вызывается один раз
+    в каждом процессе-исполнителе. Возвращает True, если
+    все части всех Пайплайнов перекачаны
+    """
+    plans = {pipe.label: plan_partitions(pipe, partitions) for pipe in pipes}
+    tasks = [
+        (pipe.label, partition)
+        for pipe in pipes
+        for partition in range(len(plans[pipe.label]))
+        if not partition_state(pipe.states_keeper, partition).get_state("done")
+    ]
+
+    mp_context = mp_context or multiprocessing.get_context("spawn")
+    workers_stop_event = mp_context.Event()
+    errors = []
+    if tasks:
+        logger.info("Backfill of %d partitions started", len(tasks))
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(processes or os.cpu_count() or 1, len(tasks)),
+            mp_context=mp_context,
+            initializer=_init_worker,
+            initargs=(workers_stop_event, log_config or {}, pipes_factory),
+        ) as executor:
+            pending = {
+                executor.submit(run_partition, label, partition)
+                for label, partition in tasks
+            }
+            while pending:
+                done, pending = concurrent.futures.wait(pending, timeout=1)
+                errors.extend(
+                    future.exception()
+                    for future in done
+                    if not future.cancelled() and future.exception()
+                )
+                if errors or (stop_event is not None and stop_event.is_set()):
+                    # исполнители догружают текущие пачки, новые части
+                    # не начинаются
+                    workers_stop_event.set()
+                    for future in pending:
+                        future.cancel()
+
+    if errors:
+        raise errors[0]
+
+    # состояние частей читается из хранилища заново (partition_state):
+    # его записывали другие процессы
+    finished = True
+    for pipe in pipes:
+        finished &= finish_backfill(pipe, plans[pipe.label])
+
+    return finished
@@ -1,11 +1,26 @@
+import asyncio
 import functools
 import logging
+import random
 import time
 
+from etl import metrics
+
 _logger = logging.getLogger("backoff")
 _logger.addHandler(logging.NullHandler())
 
 
+def jittered_sleep_time(
+    tries: int, start_sleep_time=0.1, factor=2, border_sleep_time=10
+) -> float:
+    """
+    Время ожидания перед повтором номер tries (с нуля): случайное от нуля
+    до экспоненциального (full jitter). Клиенты, получившие отказ
+    одновременно, повторяют запросы вразнобой, а не той же волной
+    """
+    return random.uniform(0, min(start_sleep_time * factor ** tries, border_sleep_time))
+
+
 def on_exception(start_sleep_time=0.1, factor=2, border_sleep_time=10, logger=_logger):
     """
     Функция для повторного выполнения функции через некоторое время,
@@ -23,6 +38,41 @@ def on_exception(start_sleep_time=0.1, factor=2, border_sleep_time=10, logger=_l
     """
 
     def func_wrapper(func):
+        def get_sleep_time(tries: int, exception: Exception) -> float:
+            sleep_time = start_sleep_time * (factor ** tries)
+            if sleep_time > border_sleep_time:
+                logger.warning(
+                    "The exception is caught. '%s' function call limit reached",
+                    func.__name__,
+                )
+                raise exception
+
+            metrics.BACKOFF_RETRIES.inc(function=func.__qualname__)
+            logger.info(
+                "The exception is caught. Repeated execution "
+                "of the '%s' function"
+                "will be backed off by %f seconds.",
+                func.__name__,
+                sleep_time,
+            )
+            return sleep_time
+
+        # корутины (etl.aio) ждут повтора, не блокируя цикл событий
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_inner(*args, **kwargs):
+                tries = 0
+                while True:
+                    try:
+                        return await func(*args, **kwargs)
+                    except Exception as exception:
+                        await asyncio.sleep(get_sleep_time(tries, exception))
+
+                    tries += 1
+
+            return async_inner
+
         @functools.wraps(func)
         def inner(*args, **kwargs):
             tries = 0
@@ -30,22 +80,7 @@ def on_exception(start_sleep_time=0.1, factor=2, border_sleep_time=10, logger=_l
                 try:
                     return func(*args, **kwargs)
                 except Exception as exception:
-                    sleep_time = start_sleep_time * (factor ** tries)
-                    if sleep_time > border_sleep_time:
-                        logger.warning(
-                            "The exception is caught. '%s' function call limit reached",
-                            func.__name__,
-                        )
-                        raise exception
-
-                    logger.info(
-                        "The exception is caught. Repeated execution "
-                        "of the '%s' function"
-                        "will be backed off by %f seconds.",
-                        func.__name__,
-                        sleep_time,
-                    )
-                    time.sleep(sleep_time)
+                    time.sleep(get_sleep_time(tries, exception))
 
                 tries += 1
 
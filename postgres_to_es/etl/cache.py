@@ -0,0 +1,168 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import zlib
+from typing import Dict, Iterable, List, Tuple
+
+_encode = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+# сколько id в одном запросе IN (...) - ограничение SQLite на число параметров
+_SELECT_CHUNK = 500
+
+
+class DocumentHashCache:
+    """
+    Постоянный кеш хешей документов, загруженных в ES (SQLite). Позволяет
+    не отправлять документы, которые ES уже хранит в точности такими же:
+    при принудительной переиндексации и на перекрытии границ пачек.
+
+    Ключ индекса - "<имя>/<uuid индекса>": пересозданный индекс получает
+    новый uuid, и старые хеши перестают действовать.
+
+    Хеши попадают в кеш только после подтверждения загрузки от ES (stage)
+    и записываются в файл вместе с контрольной точкой состояния (commit),
+    поэтому кеш никогда не содержит документов, которых нет в ES.
+
+    Для частичных обновлений (ESLoader.partial_updates) рядом с хешами
+    хранятся сжатые копии загруженных документов: изменения вычисляются
+    относительно них, без _mget к ES
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._pending: Dict[Tuple[str, str], bytes] = {}
+        self._pending_sources: Dict[Tuple[str, str], bytes] = {}
+
+        # Загрузчики разных Пайплайнов делят один кеш, процессы etl.backfill -
+        # один файл: запись ждёт освобождения блокировки до timeout секунд
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS document_hashes (
+                index_key TEXT NOT NULL,
+                id TEXT NOT NULL,
+                hash BLOB NOT NULL,
+                PRIMARY KEY (index_key, id)
+            ) WITHOUT ROWID
+            """
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS document_sources (
+                index_key TEXT NOT NULL,
+                id TEXT NOT NULL,
+                source BLOB NOT NULL,
+                PRIMARY KEY (index_key, id)
+            ) WITHOUT ROWID
+            """
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def hash(payload: bytes) -> bytes:
+        """
+        Хеш документа по строкам bulk-запроса (действие и документ). Строка
+        действия не учитывается: она зависит от имени индекса, а не от
+        содержимого документа
+        """
+        start = payload.find(b"\n") + 1
+        return hashlib.blake2b(payload[start:], digest_size=16).digest()
+
+    def get(self, index_key: str, ids: List[str]) -> Dict[str, bytes]:
+        """Хеши последних загруженных версий документов (если есть)"""
+        return self._select("document_hashes", "hash", self._pending, index_key, ids)
+
+    def get_sources(self, index_key: str, ids: List[str]) -> Dict[str, dict]:
+        """Последние загруженные версии документов (если сохранены)"""
+        sources = self._select(
+            "document_sources", "source", self._pending_sources, index_key, ids
+        )
+        return {
+            object_id: json.loads(zlib.decompress(source))
+            for object_id, source in sources.items()
+        }
+
+    def _select(
+        self, table: str, column: str, pending: dict, index_key: str, ids: List[str]
+    ) -> Dict[str, bytes]:
+        result = {}
+        with self._lock:
+            for start in range(0, len(ids), _SELECT_CHUNK):
+                end = start + _SELECT_CHUNK
+                chunk = ids[start:end]
+                result.update(
+                    self._conn.execute(
+                        "SELECT id, %s FROM %s WHERE index_key = ? AND id IN (%s)"
+                        % (column, table, ",".join("?" * len(chunk))),
+                        (index_key, *chunk),
+                    ).fetchall()
+                )
+
+            # ещё не записанные значения новее записанных
+            for object_id in ids:
+                if (index_key, object_id) in pending:
+                    result[object_id] = pending[(index_key, object_id)]
+
+        return result
+
+    def stage(
+        self,
+        index_key: str,
+        hashes: Iterable[Tuple[str, bytes]],
+        sources: Iterable[Tuple[str, dict]] = (),
+    ):
+        """
+        Запомнить хеши (и, если переданы, копии) документов, загрузку
+        которых подтвердил ES
+        """
+        # сжатие - вне блокировки: кеш делят Загрузчики разных Пайплайнов
+        sources = [
+            (object_id, zlib.compress(_encode(source).encode("utf-8"), 1))
+            for object_id, source in sources
+        ]
+        with self._lock:
+            for object_id, document_hash in hashes:
+                self._pending[(index_key, object_id)] = document_hash
+            for object_id, source in sources:
+                self._pending_sources[(index_key, object_id)] = source
+
+    def commit(self):
+        """Записать накопленные хеши в файл одной транзакцией"""
+        with self._lock:
+            if not self._pending and not self._pending_sources:
+                return
+
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO document_hashes (index_key, id, hash) "
+                    "VALUES (?, ?, ?)",
+                    [
+                        (key, object_id, h)
+                        for (key, object_id), h in self._pending.items()
+                    ],
+                )
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO document_sources (index_key, id, source) "
+                    "VALUES (?, ?, ?)",
+                    [
+                        (key, object_id, source)
+                        for (key, object_id), source in self._pending_sources.items()
+                    ],
+                )
+            self._pending = {}
+            self._pending_sources = {}
+
+    def prune(self, index_name: str, index_key: str):
+        """Удалить хеши и копии прежних (пересозданных) версий индекса"""
+        prefix = index_name + "/"
+        with self._lock, self._conn:
+            for table in ("document_hashes", "document_sources"):
+                self._conn.execute(
+                    "DELETE FROM %s "
+                    "WHERE substr(index_key, 1, ?) = ? AND index_key != ?" % table,
+                    (len(prefix), prefix, index_key),
+                )
@@ -0,0 +1,269 @@
+import functools
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+import psycopg2
+import psycopg2.extensions
+
+from etl import metrics
+from etl.settings import settings
+
+logger = logging.getLogger()
+
+
+def get_pg_dns() -> dict:
+    """Параметры подключения к PostgreSQL из переменных окружения"""
+    return {
+        "dbname": os.environ.get("POSTGRES_DB"),
+        "user": os.environ.get("POSTGRES_USER"),
+        "password": os.environ.get("POSTGRES_PASSWORD"),
+        "host": os.environ.get("POSTGRES_HOST"),
+        "port": os.environ.get("POSTGRES_PORT"),
+        "options": "-c search_path=content",
+    }
+
+
+class Connection(psycopg2.extensions.connection):
+    """Соединение, которое помнит подготовленные в нём запросы"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+def connect(**dsn) -> Connection:
+    """
+    Соединение пула: каждый запрос Экстрактора идёт в своей короткой
+    транзакции REPEATABLE READ READ ONLY - снимок данных не переживает
+    запрос и не держит VACUUM на первичном сервере
+    """
+    conn = psycopg2.connect(connection_factory=Connection, **dsn)
+    conn.set_session(
+        isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ,
+        readonly=True,
+    )
+    return conn
+
+
+class Query(NamedTuple):
+    """Запрос с параметрами $1, $2... и их типами (см. execute_prepared)"""
+
+    sql: str
+    params: tuple = ()
+    types: tuple = ()
+
+
+@functools.lru_cache(maxsize=None)
+def prepared_statement(sql: str, types: Tuple[Optional[str], ...]) -> Tuple[str, ...]:
+    """
+    Имя подготовленного запроса, текст PREPARE и текст EXECUTE
+    с параметрами psycopg2 (%s)
+    """
+    name = "etl_" + hashlib.md5(sql.encode()).hexdigest()[:16]
+    if not types:
+        return name, f"PREPARE {name} AS {sql}", f"EXECUTE {name}"
+
+    declared = ", ".join(t or "unknown" for t in types)
+    placeholders = ", ".join(f"%s::{t}" if t else "%s" for t in types)
+    return (
+        name,
+        f"PREPARE {name} ({declared}) AS {sql}",
+        f"EXECUTE {name} ({placeholders})",
+    )
+
+
+def execute_prepared(
+    cur, sql: str, params: Sequence = (), types: Sequence[Optional[str]] = ()
+):
+    """
+    Выполнить запрос с параметрами $1, $2... как подготовленный: PREPARE
+    один раз на соединение, дальше только EXECUTE - PostgreSQL не разбирает
+    и не планирует текст запроса на каждой пачке.
+
+    types - типы параметров, None - по контексту запроса. Для списков тип
+    обязателен: psycopg2 передаёт их как ARRAY[...] типа text[]
+    """
+    types = tuple(types) or (None,) * len(params)
+    name, prepare, execute = prepared_statement(sql, types)
+    if name not in cur.connection.prepared:
+        cur.execute(prepare)
+        cur.connection.prepared.add(name)
+
+    cur.execute(execute, params)
+
+
+def execute_inline(
+    cur, sql: str, params: Sequence = (), types: Sequence[Optional[str]] = ()
+):
+    """
+    Выполнить запрос с параметрами $1, $2... без подготовки - для именованных
+    (server-side) курсоров: DECLARE не умеет EXECUTE. Параметры
+    подставляет psycopg2, типы - как у execute_prepared
+    """
+    types = tuple(types) or (None,) * len(params)
+    order = []
+
+    def placeholder(match) -> str:
+        number = int(match.group(1)) - 1
+        order.append(params[number])
+        return f"%s::{types[number]}" if types[number] else "%s"
+
+    cur.execute(re.sub(r"\$(\d+)", placeholder, sql), order)
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    """Все соединения пула заняты дольше таймаута ожидания"""
+
+
+class ConnectionPool:
+    """
+    Ограниченный пул соединений с PostgreSQL, общий для потоков процесса.
+    Соединение берётся на запрос (connection) и возвращается в пул:
+    открытых соединений не больше max_size, сколько бы Экстракторов и
+    Пайплайнов ни работало одновременно. Когда все заняты - ждём
+    освободившееся до timeout секунд, потом PoolTimeout.
+
+    Мёртвые соединения в пуле не задерживаются:
+      - при возврате открытая транзакция откатывается, соединение, которое
+            закрыто или не смогло откатиться, закрывается
+      - при выдаче соединение, простоявшее в пуле дольше check_interval
+            секунд, проверяется запросом SELECT 1. Не ответившее заменяется
+            новым - повтор etl.backoff после обрыва получает живое соединение
+    """
+
+    def __init__(
+        self,
+        dsn: dict,
+        max_size: int = 10,
+        timeout: float = 30,
+        check_interval: float = 30,
+        connect: Callable = connect,
+    ):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self._connect = connect
+        # свободные соединения с моментом возврата: [(<conn>, <monotonic>), ...]
+        self._idle: List[Tuple[object, float]] = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        # пул не переживает fork: соединения родителя нельзя использовать
+        self.pid = os.getpid()
+
+    def _is_alive(self, conn, idle_since: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.check_interval:
+            return True
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+
+        return True
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self):
+        """Взять соединение из пула (или открыть новое, если свободных нет)"""
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(
+                f"No free PostgreSQL connection in {self.timeout} s "
+                f"(pool size {self.max_size})"
+            )
+
+        try:
+            while True:
+                with self._lock:
+                    item = self._idle.pop() if self._idle else None
+                if item is None:
+                    return self._connect(**self.dsn)
+
+                conn, idle_since = item
+                if self._is_alive(conn, idle_since):
+                    return conn
+
+                logger.warning("A dead PostgreSQL connection is replaced")
+                metrics.PG_RECONNECTS.inc()
+                self._discard(conn)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn):
+        """Вернуть соединение в пул. Транзакция соединения откатывается"""
+        try:
+            alive = not conn.closed
+            if alive and (
+                conn.get_transaction_status()
+                != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+            ):
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    alive = False
+
+            if alive:
+                with self._lock:
+                    self._idle.append((conn, time.monotonic()))
+            else:
+                self._discard(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self) -> Iterator:
+        """
+        Соединение из пула на время блока with. Транзакция блока
+        фиксируется сразу после него
+        """
+        conn = self.getconn()
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            self.putconn(conn)
+
+    def close(self):
+        """Закрыть свободные соединения пула"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._discard(conn)
+
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """
+    Общий пул процесса, параметры - из settings. Процессы etl.backfill
+    получают свои пулы: соединения не переживают fork
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = ConnectionPool(
+                # keepalive - чтобы оборванное соединение обнаружилось
+                # за секунды, а не через часы по таймауту TCP
+                dict(get_pg_dns(), keepalives=1, keepalives_idle=30),
+                max_size=settings.pg_pool_size,
+                timeout=settings.pg_pool_timeout,
+                check_interval=settings.pg_pool_check_interval,
+            )
+        return _pool
@@ -2,7 +2,7 @@ import dataclasses
 import json
 import logging
 from dataclasses import dataclass, field
-from typing import Any, Union
+from typing import Any, Dict, Union
 
 # TODO: попытка прокинуть "универсальный" тип в loader.py
 #       Нужно придумать что-то более элегантное для удовлетворения pyright
@@ -16,6 +16,34 @@ class EnhancedJSONEncoder(json.JSONEncoder):
         return super().default(object)
 
 
+class _ColumnNames(dict):
+    """Индексы колонок для строк-словарей: индекс колонки - её имя"""
+
+    def __missing__(self, key: str) -> str:
+        return key
+
+
+# индексы колонок строк, которые читаются по именам (словари, DictRow).
+# Строки etl.extractor.Rows - кортежи, их индексы лежат в Rows.columns
+NAMED_COLUMNS: Dict[str, Any] = _ColumnNames()
+
+
+def slotted(cls):
+    """
+    Пересоздаёт dataclass со __slots__ вместо __dict__ у каждого объекта
+    (dataclass(slots=True) появился только в Python 3.10). Значения
+    по умолчанию уже подставлены в сгенерированный __init__, поэтому
+    атрибуты класса с ними можно убрать - иначе они конфликтуют со слотами
+    """
+    names = tuple(item.name for item in dataclasses.fields(cls))
+    namespace = dict(cls.__dict__)
+    for name in names + ("__dict__", "__weakref__"):
+        namespace.pop(name, None)
+    namespace["__slots__"] = names
+
+    return type(cls)(cls.__name__, cls.__bases__, namespace)
+
+
 @dataclass(frozen=True)
 class BasicStructure:
     __slots__ = ("id", "name")
@@ -33,6 +61,8 @@ class BasicStructure:
 
 @dataclass(frozen=True)
 class Person(BasicStructure):
+    __slots__ = ()
+
     @classmethod
     def _get_unique_by_id(cls, structure: list[Any]) -> list[Any]:
         return super()._get_unique_by_id(structure)
@@ -40,6 +70,8 @@ class Person(BasicStructure):
 
 @dataclass(frozen=True)
 class Actor(Person):
+    __slots__ = ()
+
     @classmethod
     def _get_unique_by_id(cls, structure: list["Actor"]) -> list["Actor"]:
         return super()._get_unique_by_id(structure)
@@ -47,6 +79,8 @@ class Actor(Person):
 
 @dataclass(frozen=True)
 class Director(Person):
+    __slots__ = ()
+
     @classmethod
     def _get_unique_by_id(cls, structure: list["Director"]) -> list["Director"]:
         return super()._get_unique_by_id(structure)
@@ -54,6 +88,8 @@ class Director(Person):
 
 @dataclass(frozen=True)
 class Writer(Person):
+    __slots__ = ()
+
     @classmethod
     def _get_unique_by_id(cls, structure: list["Writer"]) -> list["Writer"]:
         return super()._get_unique_by_id(structure)
@@ -61,9 +97,19 @@ class Writer(Person):
 
 @dataclass(frozen=True)
 class Genre(BasicStructure):
-    pass
+    __slots__ = ()
 
 
+# соответствие ролей персон в БД классам персон фильма
+PERSON_CLASSES_MAP = {
+    "актёр": Actor,
+    "директор": Director,
+    "режисёр": Director,
+    "сценарист": Writer,
+}
+
+
+@slotted
 @dataclass(frozen=False)
 class ElasticSearchMovie:
     id: str
@@ -81,63 +127,122 @@ class ElasticSearchMovie:
     writers_names: list = field(default_factory=list)
 
     @classmethod
-    def init_by_db_rows(cls, db_rows: list) -> "ElasticSearchMovie":
+    def init_by_db_rows(
+        cls, db_rows: list, columns: Dict[str, Any] = NAMED_COLUMNS
+    ) -> "ElasticSearchMovie":
         """
         Инициализирует объект данными из БД
         Данные из БД это строки таблиц фильмов и связанных сущностей,
         сджойненные вмесет. Содержат много дублированной информации.
-        На вход должны приходить списки с одинаковым movie_id
+        На вход должны приходить списки с одинаковым movie_id.
+        columns - индексы колонок в строках (etl.extractor.Rows.columns)
         """
+        first = db_rows[0]
         movie = ElasticSearchMovie(
-            id=db_rows[0]["movie_id"],
-            title=db_rows[0]["title"],
-            description=db_rows[0]["description"],
-            imdb_rating=db_rows[0]["rating"],
-            type=db_rows[0]["type"],
-            modified=db_rows[0]["modified"].strftime("%Y-%m-%d %H:%M:%S.%f"),
+            id=first[columns["movie_id"]],
+            title=first[columns["title"]],
+            description=first[columns["description"]],
+            imdb_rating=first[columns["rating"]],
+            type=first[columns["type"]],
+            modified=first[columns["modified"]].strftime("%Y-%m-%d %H:%M:%S.%f"),
         )
 
-        person_classes_map = {
-            "актёр": Actor,
-            "директор": Director,
-            "режисёр": Director,
-            "сценарист": Writer,
-        }
         persons_map = {
             "Actor": movie.actors,
             "Director": movie.directors,
             "Writer": movie.writers,
         }
 
+        role_index = columns["person_role"]
+        person_id_index = columns["person_id"]
+        person_name_index = columns["person_full_name"]
+        genre_id_index = columns["genre_id"]
+        genre_name_index = columns["genre_name"]
+
         for row in db_rows:
-            person_class = person_classes_map.get(row["person_role"], None)
+            # LEFT JOIN: у фильма без персон или жанров колонки связей пустые
+            if row[genre_id_index] is not None:
+                movie.genres.append(
+                    Genre(id=row[genre_id_index], name=row[genre_name_index])
+                )
+
+            if row[person_id_index] is None:
+                continue
+
+            person_class = PERSON_CLASSES_MAP.get(row[role_index], None)
             if not person_class:
-                logging.error("Can't handle role type '%s'", row["person_role"])
-                next
+                logging.error("Can't handle role type '%s'", row[role_index])
+                continue
 
-            person = person_class(id=row["person_id"], name=row["person_full_name"])
+            persons_map[person_class.__name__].append(
+                person_class(id=row[person_id_index], name=row[person_name_index])
+            )
 
-            persons_container = persons_map.get(person.__class__.__name__, None)
-            if isinstance(persons_container, list):
-                persons_container.append(person)
+        movie._deduplicate_nested()
 
-            movie.genres.append(Genre(id=row["genre_id"], name=row["genre_name"]))
+        return movie
 
-        # убираем дубли у всех сущностей
-        movie.actors = Actor._get_unique_by_id(movie.actors)
-        movie.directors = Director._get_unique_by_id(movie.directors)
-        movie.writers = Writer._get_unique_by_id(movie.writers)
+    @classmethod
+    def init_by_aggregated_row(
+        cls, db_row, columns: Dict[str, Any] = NAMED_COLUMNS
+    ) -> "ElasticSearchMovie":
+        """
+        Инициализирует объект одной строкой из БД, в которой персоны уже
+        сгруппированы по ролям ({<роль>: [{"id": ..., "name": ...}, ...]}),
+        а жанры собраны в список ([{"id": ..., "name": ...}, ...])
+        """
+        movie = ElasticSearchMovie(
+            id=db_row[columns["movie_id"]],
+            title=db_row[columns["title"]],
+            description=db_row[columns["description"]],
+            imdb_rating=db_row[columns["rating"]],
+            type=db_row[columns["type"]],
+            modified=db_row[columns["modified"]].strftime("%Y-%m-%d %H:%M:%S.%f"),
+        )
 
-        movie.genres = Genre._get_unique_by_id(movie.genres)
+        persons_map = {
+            "Actor": movie.actors,
+            "Director": movie.directors,
+            "Writer": movie.writers,
+        }
 
-        # добавляем списки имён актёров, режисёров, сценаристов
-        movie.actors_names = list(map(lambda item: item.name, movie.actors))
-        movie.directors_names = list(map(lambda item: item.name, movie.directors))
-        movie.writers_names = list(map(lambda item: item.name, movie.writers))
+        for role, persons in db_row[columns["persons"]].items():
+            person_class = PERSON_CLASSES_MAP.get(role, None)
+            if not person_class:
+                logging.error("Can't handle role type '%s'", role)
+                continue
+
+            persons_map[person_class.__name__].extend(
+                person_class(id=person["id"], name=person["name"]) for person in persons
+            )
+
+        movie.genres = [
+            Genre(id=genre["id"], name=genre["name"])
+            for genre in db_row[columns["genres"]]
+        ]
+
+        # разные роли БД (директор, режисёр) соответствуют одному классу персон
+        movie._deduplicate_nested()
 
         return movie
 
+    def _deduplicate_nested(self):
+        """
+        Убирает дубли у всех вложенных сущностей и заполняет списки имён
+        """
+        self.actors = Actor._get_unique_by_id(self.actors)
+        self.directors = Director._get_unique_by_id(self.directors)
+        self.writers = Writer._get_unique_by_id(self.writers)
+
+        self.genres = Genre._get_unique_by_id(self.genres)
 
+        # добавляем списки имён актёров, режисёров, сценаристов
+        self.actors_names = list(map(lambda item: item.name, self.actors))
+        self.directors_names = list(map(lambda item: item.name, self.directors))
+        self.writers_names = list(map(lambda item: item.name, self.writers))
+
+
+@slotted
 @dataclass(frozen=True)
 class MovieSmallWithIMDBRating:
     id: str
@@ -145,6 +250,7 @@ class MovieSmallWithIMDBRating:
     imdb_rating: float
 
 
+@slotted
 @dataclass(frozen=False)
 class ElasticSearchGenre:
     id: str
@@ -153,31 +259,74 @@ class ElasticSearchGenre:
     movies: list[MovieSmallWithIMDBRating] = field(default_factory=list)
 
     @classmethod
-    def init_by_db_rows(cls, db_rows: list) -> "ElasticSearchGenre":
+    def init_by_db_rows(
+        cls, db_rows: list, columns: Dict[str, Any] = NAMED_COLUMNS
+    ) -> "ElasticSearchGenre":
         """
         Инициализирует объект данными из БД
         Данные из БД это строки таблиц жанров и связанных сущностей (фильмов),
         сджойненные вмесет. Содержат много дублированной информации.
         На вход должны приходить списки с одинаковым genre_id
         """
+        first = db_rows[0]
         genre = ElasticSearchGenre(
-            id=db_rows[0]["genre_id"],
-            name=db_rows[0]["genre_name"],
-            modified=db_rows[0]["modified"].strftime("%Y-%m-%d %H:%M:%S.%f"),
+            id=first[columns["genre_id"]],
+            name=first[columns["genre_name"]],
+            modified=first[columns["modified"]].strftime("%Y-%m-%d %H:%M:%S.%f"),
         )
 
+        movie_id_index = columns["movie_id"]
+        movie_title_index = columns["movie_title"]
+        movie_rating_index = columns["movie_rating"]
+
         for row in db_rows:
+            # LEFT JOIN: у жанра без фильмов колонки фильма пустые
+            if row[movie_id_index] is None:
+                continue
+
             genre.movies.append(
                 MovieSmallWithIMDBRating(
-                    id=row["movie_id"],
-                    title=row["movie_title"],
-                    imdb_rating=row["movie_rating"],
+                    id=row[movie_id_index],
+                    title=row[movie_title_index],
+                    imdb_rating=row[movie_rating_index],
                 )
             )
 
         return genre
 
+    @classmethod
+    def init_by_aggregated_row(
+        cls, db_row, columns: Dict[str, Any] = NAMED_COLUMNS
+    ) -> "ElasticSearchGenre":
+        """
+        Инициализирует объект одной строкой из БД, в которой фильмы жанра уже
+        собраны в список ([{"id": ..., "title": ..., "imdb_rating": ...}, ...])
+        """
+        return ElasticSearchGenre(
+            id=db_row[columns["genre_id"]],
+            name=db_row[columns["genre_name"]],
+            modified=db_row[columns["modified"]].strftime("%Y-%m-%d %H:%M:%S.%f"),
+            movies=[
+                MovieSmallWithIMDBRating(
+                    id=movie["id"],
+                    title=movie["title"],
+                    imdb_rating=movie["imdb_rating"],
+                )
+                for movie in db_row[columns["movies"]]
+            ],
+        )
+
 
+# соответствие ролей персон в БД ролям в документе Персоны
+PERSON_ROLES_MAP = {
+    "актёр": "actor",
+    "директор": "director",
+    "режисёр": "director",
+    "сценарист": "writer",
+}
+
+
+@slotted
 @dataclass(frozen=True)
 class MovieSmallWithPersonRole:
     id: str
@@ -197,6 +346,7 @@ class MovieSmallWithPersonRole:
         return list(uniq.values())
 
 
+@slotted
 @dataclass(frozen=False)
 class ElasticSearchPerson:
     id: str
@@ -205,35 +355,62 @@ class ElasticSearchPerson:
     movies: list[MovieSmallWithPersonRole] = field(default_factory=list)
 
     @classmethod
-    def init_by_db_rows(cls, db_rows: list) -> "ElasticSearchPerson":
+    def init_by_db_rows(
+        cls, db_rows: list, columns: Dict[str, Any] = NAMED_COLUMNS
+    ) -> "ElasticSearchPerson":
         """
         Инициализирует объект данными из БД
         Данные из БД это строки таблиц Персон и связанных сущностей (фильмов),
         сджойненные вмесет. Содержат много дублированной информации.
         На вход должны приходить списки с одинаковым person_id
         """
+        first = db_rows[0]
         obj = ElasticSearchPerson(
-            id=db_rows[0]["person_id"],
-            full_name=db_rows[0]["person_full_name"],
-            modified=db_rows[0]["modified"].strftime("%Y-%m-%d %H:%M:%S.%f"),
+            id=first[columns["person_id"]],
+            full_name=first[columns["person_full_name"]],
+            modified=first[columns["modified"]].strftime("%Y-%m-%d %H:%M:%S.%f"),
         )
 
-        person_map = {
-            "актёр": "actor",
-            "директор": "director",
-            "режисёр": "director",
-            "сценарист": "writer",
-        }
+        movie_id_index = columns["movie_id"]
+        movie_title_index = columns["movie_title"]
+        role_index = columns["person_role_name"]
 
         for row in db_rows:
+            # LEFT JOIN: у Персоны без фильмов колонки фильма пустые
+            if row[movie_id_index] is None:
+                continue
+
             obj.movies.append(
                 MovieSmallWithPersonRole(
-                    id=row["movie_id"],
-                    title=row["movie_title"],
-                    person_role=str(person_map.get(row["person_role_name"], None)),
+                    id=row[movie_id_index],
+                    title=row[movie_title_index],
+                    person_role=str(PERSON_ROLES_MAP.get(row[role_index], None)),
                 )
             )
 
         obj.movies = MovieSmallWithPersonRole._get_unique_by_id(obj.movies)
 
         return obj
+
+    @classmethod
+    def init_by_aggregated_row(
+        cls, db_row, columns: Dict[str, Any] = NAMED_COLUMNS
+    ) -> "ElasticSearchPerson":
+        """
+        Инициализирует объект одной строкой из БД, в которой фильмы Персоны
+        уже собраны в список без дублей
+        ([{"id": ..., "title": ..., "person_role": ...}, ...])
+        """
+        return ElasticSearchPerson(
+            id=db_row[columns["person_id"]],
+            full_name=db_row[columns["person_full_name"]],
+            modified=db_row[columns["modified"]].strftime("%Y-%m-%d %H:%M:%S.%f"),
+            movies=[
+                MovieSmallWithPersonRole(
+                    id=movie["id"],
+                    title=movie["title"],
+                    person_role=str(PERSON_ROLES_MAP.get(movie["person_role"], None)),
+                )
+                for movie in db_row[columns["movies"]]
+            ],
+        )
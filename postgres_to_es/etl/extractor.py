@@ -1,61 +1,258 @@
+import itertools
 import logging
-import os
-
-import psycopg2
-from psycopg2.extras import DictCursor
+from typing import Dict, Iterator, Optional, Tuple
 
 import etl.backoff
+from etl.db import ConnectionPool, Query, execute_inline, execute_prepared, get_pool
+from etl.settings import settings
+
+# Минимальный UUID. Используется как id "до первой записи", когда постраничное
+# чтение начинается с произвольной даты модификации
+FIRST_ID = "00000000-0000-0000-0000-000000000000"
+
+
+class Rows(list):
+    """
+    Строки результата запроса - обычные кортежи курсора без обёрток вроде
+    DictRow. Индексы колонок по именам определяются один раз на запрос
+    и лежат в columns: row[rows.columns["title"]]
+    """
+
+    __slots__ = ("columns",)
+
+    def __init__(self, rows: list, columns: Dict[str, int]):
+        super().__init__(rows)
+        self.columns = columns
+
+
+class RowsStream:
+    """
+    Строки результата запроса, которые читаются лениво: итератор
+    по кортежам курсора и индексы колонок по именам, как у Rows
+    """
+
+    __slots__ = ("rows", "columns")
+
+    def __init__(self, rows: Iterator[tuple], columns: Dict[str, int]):
+        self.rows = rows
+        self.columns = columns
+
+    def __iter__(self) -> Iterator[tuple]:
+        return self.rows
+
+
+def fetch_rows(cur) -> Rows:
+    """Все строки выполненного запроса с индексами колонок"""
+    return Rows(
+        cur.fetchall(),
+        {column.name: index for index, column in enumerate(cur.description)},
+    )
 
 
 class PgExtractor:
-    def __init__(self):
-        pg_dns = {
-            "dbname": os.environ.get("POSTGRES_DB"),
-            "user": os.environ.get("POSTGRES_USER"),
-            "password": os.environ.get("POSTGRES_PASSWORD"),
-            "host": os.environ.get("POSTGRES_HOST"),
-            "port": os.environ.get("POSTGRES_PORT"),
-            "options": "-c search_path=content",
-        }
-        self.conn = psycopg2.connect(**pg_dns)
+    """
+    Базовый Экстрактор. Идентификаторы модифицированных объектов читаются
+    постранично по ключу (modified, id): каждая следующая страница начинается
+    строго после последней пары предыдущей страницы. В отличие от OFFSET
+    стоимость страницы не зависит от глубины сканирования, а записи с одинаковым
+    modified не теряются и не дублируются на границах страниц.
+
+    Соединения берутся из пула (etl.db) на время запроса: Экстракторы
+    Пайплайнов делят один ограниченный пул, а повтор запроса после обрыва
+    соединения идёт уже через живое соединение. Запросы пачек - с параметрами
+    $1, $2... и выполняются как подготовленные (etl.db.execute_prepared).
+    Запросы строятся методами *_query - их же выполняет асинхронный
+    движок (etl.aio.AsyncPgExtractor)
+    """
 
-    def get_modified_ids(self):
-        pass
+    # таблица, изменения в которой отслеживает Экстрактор
+    source_table = ""
 
-    def get_data_by_ids(self):
-        pass
+    def __init__(self, pool: Optional[ConnectionPool] = None):
+        self._pool = pool
+        self._stream_cursors = itertools.count()
+        # верхняя граница чтения (modified, id) включительно: часть таблицы
+        # при параллельной полной переиндексации (etl.backfill)
+        self.until: Optional[Tuple[str, str]] = None
 
+    # запрос строк объектов по массиву id (единственный параметр запроса, $1)
+    data_by_ids_sql = ""
 
-class PgMovieExtractor(PgExtractor):
-    @etl.backoff.on_exception()
-    def get_modified_ids(self, modified: str, limit: int, offset: int):
-        cur = self.conn.cursor()
+    @property
+    def pool(self) -> ConnectionPool:
+        """Пул соединений, по умолчанию - общий пул процесса"""
+        return self._pool or get_pool()
 
-        sql = """
+    def _until_condition(self, number: int) -> Tuple[str, tuple]:
+        """
+        Условие WHERE и параметры верхней границы until - номер number
+        и следующий
+        """
+        if self.until is None:
+            return "", ()
+
+        return f"AND (modified, id) <= (${number}, ${number + 1})", tuple(self.until)
+
+    def modified_ids_query(
+        self, modified: str, last_id: Optional[str], limit: int
+    ) -> Query:
+        """Запрос get_modified_ids"""
+        until_sql, until_params = self._until_condition(4)
+        sql = f"""
             SELECT
                 id, modified
             FROM
-                content.movies
+                {self.source_table}
             WHERE
-                modified >= %s
-            ORDER BY modified
-            LIMIT %s
-            OFFSET %s
+                (modified, id) > ($1, $2) {until_sql}
+            ORDER BY modified, id
+            LIMIT $3
         """
-        logging.debug(sql % (modified, limit, offset))
+        params = (modified, last_id or FIRST_ID, limit, *until_params)
+        logging.debug("%s %s", sql, params)
 
-        cur.execute(sql, (modified, limit, offset))
-        res = cur.fetchall()
+        return Query(sql, params)
 
-        cur.close()
+    @etl.backoff.on_exception()
+    def get_modified_ids(self, modified: str, last_id: Optional[str], limit: int):
+        """
+        Идентификаторы объектов, модифицированных после пары (modified, id):
+        [(<id>, <modified>), ...], упорядоченные по (modified, id)
+        """
+        query = self.modified_ids_query(modified, last_id, limit)
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            execute_prepared(cur, *query)
+            return cur.fetchall()
+
+    @etl.backoff.on_exception()
+    def get_partition_bounds(
+        self, modified: str, last_id: Optional[str], partitions: int
+    ) -> list:
+        """
+        Делит объекты, модифицированные после пары (modified, id), на
+        partitions частей с равным числом строк. Возвращает верхние границы
+        частей [(<id>, <modified>), ...] по возрастанию: последняя - самая
+        свежая пара таблицы. Строк меньше, чем частей - частей меньше
+        """
 
-        return res
+        sql = f"""
+            SELECT DISTINCT ON (part)
+                id, modified
+            FROM (
+                SELECT
+                    id, modified, ntile(%s) OVER (ORDER BY modified, id) AS part
+                FROM
+                    {self.source_table}
+                WHERE
+                    (modified, id) > (%s, %s)
+            ) AS parts
+            ORDER BY part, modified DESC, id DESC
+        """
+        params = (partitions, modified, last_id or FIRST_ID)
+        logging.debug(sql % params)
+
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(sql, params)
+            return cur.fetchall()
+
+    def data_by_ids_query(self, ids: tuple) -> Query:
+        """Запрос get_data_by_ids"""
+        return Query(self.data_by_ids_sql, (list(ids),), ("uuid[]",))
 
     @etl.backoff.on_exception(border_sleep_time=1)
-    def get_data_by_ids(self, ids: tuple):
-        cur = self.conn.cursor(cursor_factory=DictCursor)
+    def get_data_by_ids(self, ids: tuple) -> Rows:
+        """
+        Строки объектов с данными связанных сущностей по идентификаторам.
+        Форма строк жёстко связана с Трансформером и сущностью ES Пайплайна
+        """
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            execute_prepared(cur, *self.data_by_ids_query(ids))
+            return fetch_rows(cur)
 
-        sql = """
+    @etl.backoff.on_exception(border_sleep_time=1)
+    def iter_data_by_ids(self, ids: tuple) -> RowsStream:
+        """
+        Ленивый вариант get_data_by_ids: строки читаются через именованный
+        (server-side) курсор порциями по settings.pg_itersize, в памяти -
+        не больше одной порции. Строки джойна упорядочены по id объекта, так
+        что Трансформер может отдавать объект, как только закончились его
+        строки (ETLTransformer.iter_transform).
+
+        Курсор занимает соединение пула, пока строки не вычитаны (или
+        итератор не закрыт) - запросы extract идут через другие соединения.
+        Повтор при ошибке возможен только до первой порции строк
+        """
+        conn = self.pool.getconn()
+        try:
+            cur = conn.cursor(name=f"etl_rows_{next(self._stream_cursors)}")
+            cur.itersize = settings.pg_itersize
+            execute_inline(cur, *self.data_by_ids_query(ids))
+            rows = iter(cur)
+            # описание колонок именованного курсора есть только после
+            # первой порции строк
+            first = next(rows, None)
+        except BaseException:
+            self.pool.putconn(conn)
+            raise
+        columns = {column.name: index for index, column in enumerate(cur.description)}
+
+        def generate():
+            try:
+                if first is not None:
+                    yield first
+                    yield from rows
+            finally:
+                cur.close()
+                # транзакция курсора откатывается при возврате в пул
+                self.pool.putconn(conn)
+
+        return RowsStream(generate(), columns)
+
+    def iter_modified_ids(
+        self, modified: str, last_id: Optional[str], batch_size: int
+    ) -> Iterator[list]:
+        """
+        Потоковое чтение идентификаторов модифицированных объектов одним
+        запросом через именованный (server-side) курсор. Строки приходят
+        с сервера порциями по settings.pg_itersize, наружу отдаются пачками
+        по batch_size. Память не зависит от размера таблицы, а на каждую пачку
+        не тратится отдельный запрос get_modified_ids.
+
+        Курсор занимает соединение пула на всё чтение: запросы обогащения
+        данных идут через другие соединения и не мешают долгой транзакции
+        курсора.
+        """
+        until_sql, until_params = self._until_condition(3)
+        sql = f"""
+            SELECT
+                id, modified
+            FROM
+                {self.source_table}
+            WHERE
+                (modified, id) > ($1, $2) {until_sql}
+            ORDER BY modified, id
+        """
+        params = (modified, last_id or FIRST_ID, *until_params)
+        logging.debug("%s %s", sql, params)
+
+        cursor_name = "etl_stream_" + self.source_table.replace(".", "_")
+        with self.pool.connection() as conn, conn.cursor(name=cursor_name) as cur:
+            cur.itersize = settings.pg_itersize
+            execute_inline(cur, sql, params)
+
+            # итерация по именованному курсору забирает с сервера
+            # по itersize строк за раз (в отличие от fetchmany)
+            rows = iter(cur)
+            while batch := list(itertools.islice(rows, batch_size)):
+                yield batch
+
+
+class PgMovieExtractor(PgExtractor):
+    source_table = "content.movies"
+
+    # строки джойна по массиву id, упорядоченные по id объекта.
+    # Форма строк связана с etl.transformer.PGtoESMoviesTransformer
+    data_by_ids_sql = """
             SELECT
                 m.id AS movie_id,
                 m.title,
@@ -76,59 +273,131 @@ class PgMovieExtractor(PgExtractor):
                 LEFT JOIN content.movie_genre mg ON m.id=mg.movie_id
                 LEFT JOIN content.genres g ON mg.genre_id=g.id
                 LEFT JOIN content.movie_types mt ON m.type_id=mt.id
-            WHERE m.id IN %s
+            WHERE m.id = ANY($1)
+            ORDER BY m.id
         """
 
-        cur.execute(sql, (ids,))
-        res = cur.fetchall()
-
-        cur.close()
+    # связанные сущности, изменения которых нужно распространить на фильмы:
+    # <связь>: (<таблица сущности>, <таблица связи>, <поле связи>)
+    related_tables = {
+        "persons": ("content.persons", "content.movie_person_role", "person_id"),
+        "genres": ("content.genres", "content.movie_genre", "genre_id"),
+    }
 
-        return res
+    def last_related_key_query(self, relation: str) -> Query:
+        """Запрос get_last_related_key"""
+        table, _, _ = self.related_tables[relation]
 
+        sql = f"""
+            SELECT
+                id, modified
+            FROM
+                {table}
+            ORDER BY modified DESC, id DESC
+            LIMIT 1
+        """
 
-class PgGenreExtractor(PgExtractor):
-    """
-    Класс Экстрактор для извлечения данных о Жанрах из PostgreSQL
-    """
+        return Query(sql)
 
     @etl.backoff.on_exception()
-    def get_modified_ids(self, modified: str, limit: int, offset: int):
+    def get_last_related_key(self, relation: str) -> Optional[tuple]:
         """
-        Метод для получения идентификаторов недавно модифицированных Жанров
+        Метод для получения последней пары (id, modified) связанной сущности
         """
-        cur = self.conn.cursor()
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            execute_prepared(cur, *self.last_related_key_query(relation))
+            return cur.fetchone()
 
-        sql = """
+    def modified_related_ids_query(
+        self, relation: str, modified: str, last_id: Optional[str], limit: int
+    ) -> Query:
+        """Запрос get_modified_related_ids"""
+        table, _, _ = self.related_tables[relation]
+
+        sql = f"""
             SELECT
                 id, modified
             FROM
-                content.genres
+                {table}
             WHERE
-                modified >= %s
-            ORDER BY modified
-            LIMIT %s
-            OFFSET %s
+                (modified, id) > ($1, $2)
+            ORDER BY modified, id
+            LIMIT $3
         """
-        logging.debug(sql % (modified, limit, offset))
+        params = (modified, last_id or FIRST_ID, limit)
+        logging.debug("%s %s", sql, params)
 
-        cur.execute(sql, (modified, limit, offset))
-        res = cur.fetchall()
+        return Query(sql, params)
 
-        cur.close()
+    @etl.backoff.on_exception()
+    def get_modified_related_ids(
+        self, relation: str, modified: str, last_id: Optional[str], limit: int
+    ):
+        """
+        Метод для получения идентификаторов недавно модифицированных
+        связанных сущностей (персон, жанров). Постранично по (modified, id)
+        """
+        query = self.modified_related_ids_query(relation, modified, last_id, limit)
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            execute_prepared(cur, *query)
+            return cur.fetchall()
+
+    def movie_ids_by_related_ids_query(
+        self,
+        relation: str,
+        related_ids: tuple,
+        last_movie_id: Optional[str],
+        limit: int,
+    ) -> Query:
+        """Запрос get_movie_ids_by_related_ids"""
+        _, link_table, link_field = self.related_tables[relation]
+
+        sql = f"""
+            SELECT DISTINCT
+                movie_id
+            FROM
+                {link_table}
+            WHERE
+                {link_field} = ANY($1)
+                AND movie_id > $2
+            ORDER BY movie_id
+            LIMIT $3
+        """
+        params = (list(related_ids), last_movie_id or FIRST_ID, limit)
 
-        return res
+        return Query(sql, params, ("uuid[]", None, None))
 
-    @etl.backoff.on_exception(border_sleep_time=1)
-    def get_data_by_ids(self, ids: tuple):
+    @etl.backoff.on_exception()
+    def get_movie_ids_by_related_ids(
+        self,
+        relation: str,
+        related_ids: tuple,
+        last_movie_id: Optional[str],
+        limit: int,
+    ) -> list:
         """
-        Метод для получения необходимых данных по идентификаторам.
-        Жёстко связан структурой данных с etl.transformer.PGtoESGenresTransformer
-        и etl.entities.ElasticSearchGenre
+        Метод для получения идентификаторов фильмов, в которые входят указанные
+        связанные сущности. Постранично по id фильма: у популярного жанра
+        могут быть тысячи фильмов
         """
-        cur = self.conn.cursor(cursor_factory=DictCursor)
+        query = self.movie_ids_by_related_ids_query(
+            relation, related_ids, last_movie_id, limit
+        )
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            execute_prepared(cur, *query)
+            return [row[0] for row in cur.fetchall()]
 
-        sql = """
+
+class PgGenreExtractor(PgExtractor):
+    """
+    Класс Экстрактор для извлечения данных о Жанрах из PostgreSQL
+    """
+
+    source_table = "content.genres"
+
+    # строки джойна по массиву id, упорядоченные по id объекта.
+    # Форма строк связана с etl.transformer.PGtoESGenresTransformer
+    data_by_ids_sql = """
             SELECT
                 g.id as genre_id,
                 g.name as genre_name,
@@ -139,59 +408,23 @@ class PgGenreExtractor(PgExtractor):
             FROM content.genres g
                 LEFT JOIN content.movie_genre mg ON mg.genre_id=g.id
                 LEFT JOIN content.movies m ON m.id=mg.movie_id
-            WHERE g.id IN %s
+            WHERE g.id = ANY($1)
+            ORDER BY g.id
         """
 
-        cur.execute(sql, (ids,))
-        res = cur.fetchall()
-
-        cur.close()
-
-        return res
-
 
 class PgPersonExtractor(PgExtractor):
     """
     Класс Экстрактор для извлечения данных о Персонах из PostgreSQL
     """
 
-    @etl.backoff.on_exception()
-    def get_modified_ids(self, modified: str, limit: int, offset: int):
-        """
-        Метод для получения идентификаторов недавно модифицированных Персон
-        """
-        cur = self.conn.cursor()
-
-        sql = """
-            SELECT
-                id, modified
-            FROM
-                content.persons
-            WHERE
-                modified >= %s
-            ORDER BY modified
-            LIMIT %s
-            OFFSET %s
-        """
-        logging.debug(sql % (modified, limit, offset))
-
-        cur.execute(sql, (modified, limit, offset))
-        res = cur.fetchall()
+    source_table = "content.persons"
 
-        cur.close()
-
-        return res
-
-    @etl.backoff.on_exception(border_sleep_time=1)
-    def get_data_by_ids(self, ids: tuple):
-        """
-        Метод для получения необходимых данных по идентификаторам.
-        Жёстко связан структурой данных с etl.transformer.PGtoESPersonsTransformer
-        и etl.entities.ElasticSearchPerson
-        """
-        cur = self.conn.cursor(cursor_factory=DictCursor)
-
-        sql = """
+    # строки джойна по массиву id, упорядоченные по id объекта. Из нескольких
+    # ролей персоны в одном фильме в документ попадает первая по имени роли -
+    # как в PgPersonAggregatedExtractor.
+    # Форма строк связана с etl.transformer.PGtoESPersonsTransformer
+    data_by_ids_sql = """
             SELECT
                 p.id AS person_id,
                 p.full_name AS person_full_name,
@@ -203,12 +436,124 @@ class PgPersonExtractor(PgExtractor):
                 LEFT JOIN content.movie_person_role mpr ON mpr.person_id=p.id
                 LEFT JOIN content.person_roles pr ON pr.id=mpr.person_role_id
                 LEFT JOIN content.movies m ON m.id=mpr.movie_id
-            WHERE p.id IN %s
+            WHERE p.id = ANY($1)
+            ORDER BY p.id, m.id, pr.name
+        """
+
+
+class PgMovieAggregatedExtractor(PgMovieExtractor):
+    """
+    Экстрактор Фильмов, который получает из БД одну строку на фильм.
+    Персоны сгруппированы по ролям, жанры собраны в список - PostgreSQL
+    не размножает строки декартовым произведением персон и жанров.
+    Жёстко связан структурой данных с
+    etl.transformer.PGtoESMoviesAggregatedTransformer
+    """
+
+    # одна строка на объект по массиву id
+    data_by_ids_sql = """
+            SELECT
+                m.id AS movie_id,
+                m.title,
+                m.description,
+                m.rating,
+                mt.name as type,
+                m.created,
+                m.modified,
+                COALESCE(mp.persons, '{}') AS persons,
+                COALESCE(mg.genres, '[]') AS genres
+            FROM content.movies m
+                LEFT JOIN content.movie_types mt ON m.type_id=mt.id
+                LEFT JOIN LATERAL (
+                    SELECT json_object_agg(r.role, r.persons) AS persons
+                    FROM (
+                        SELECT
+                            pr.name AS role,
+                            json_agg(DISTINCT jsonb_build_object(
+                                'id', p.id, 'name', p.full_name
+                            )) AS persons
+                        FROM content.movie_person_role mpr
+                            JOIN content.person_roles pr ON mpr.person_role_id=pr.id
+                            JOIN content.persons p ON mpr.person_id=p.id
+                        WHERE mpr.movie_id=m.id
+                        GROUP BY pr.name
+                    ) r
+                ) mp ON TRUE
+                LEFT JOIN LATERAL (
+                    SELECT
+                        json_agg(DISTINCT jsonb_build_object(
+                            'id', g.id, 'name', g.name
+                        )) AS genres
+                    FROM content.movie_genre mg
+                        JOIN content.genres g ON mg.genre_id=g.id
+                    WHERE mg.movie_id=m.id
+                ) mg ON TRUE
+            WHERE m.id = ANY($1)
         """
 
-        cur.execute(sql, (ids,))
-        res = cur.fetchall()
 
-        cur.close()
+class PgGenreAggregatedExtractor(PgGenreExtractor):
+    """
+    Экстрактор Жанров, который получает из БД одну строку на жанр
+    со списком фильмов жанра.
+    Жёстко связан структурой данных с
+    etl.transformer.PGtoESGenresAggregatedTransformer
+    """
 
-        return res
+    # одна строка на объект по массиву id
+    data_by_ids_sql = """
+            SELECT
+                g.id as genre_id,
+                g.name as genre_name,
+                g.modified,
+                COALESCE(gm.movies, '[]') AS movies
+            FROM content.genres g
+                LEFT JOIN LATERAL (
+                    SELECT
+                        json_agg(json_build_object(
+                            'id', m.id, 'title', m.title, 'imdb_rating', m.rating
+                        )) AS movies
+                    FROM content.movie_genre mg
+                        JOIN content.movies m ON m.id=mg.movie_id
+                    WHERE mg.genre_id=g.id
+                ) gm ON TRUE
+            WHERE g.id = ANY($1)
+        """
+
+
+class PgPersonAggregatedExtractor(PgPersonExtractor):
+    """
+    Экстрактор Персон, который получает из БД одну строку на персону
+    со списком фильмов (по одной роли на фильм - первой по имени).
+    Жёстко связан структурой данных с
+    etl.transformer.PGtoESPersonsAggregatedTransformer
+    """
+
+    # одна строка на объект по массиву id
+    data_by_ids_sql = """
+            SELECT
+                p.id AS person_id,
+                p.full_name AS person_full_name,
+                p.modified,
+                COALESCE(pm.movies, '[]') AS movies
+            FROM content.persons p
+                LEFT JOIN LATERAL (
+                    SELECT
+                        json_agg(json_build_object(
+                            'id', r.id, 'title', r.title, 'person_role', r.role
+                        )) AS movies
+                    FROM (
+                        SELECT DISTINCT ON (m.id)
+                            m.id, m.title, pr.name AS role
+                        FROM content.movie_person_role mpr
+                            JOIN content.movies m ON m.id=mpr.movie_id
+                            LEFT JOIN content.person_roles pr
+                                ON pr.id=mpr.person_role_id
+                        WHERE mpr.person_id=p.id
+                        -- из нескольких ролей в фильме - первая по имени:
+                        -- документ не меняется от запуска к запуску
+                        ORDER BY m.id, pr.name
+                    ) r
+                ) pm ON TRUE
+            WHERE p.id = ANY($1)
+        """
@@ -0,0 +1,287 @@
+import json
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+from urllib.parse import urljoin
+
+import requests
+
+import etl.backoff
+from etl.state import CachedState, MemoryStorage
+
+logger = logging.getLogger()
+
+# настройки индекса на время массовой загрузки: без периодического refresh
+# и без реплик - каждый документ индексируется один раз на первичном шарде
+BULK_LOAD_SETTINGS = {"refresh_interval": "-1", "number_of_replicas": 0}
+
+
+class RebuildInterrupted(Exception):
+    """Пересборка индекса прервана сигналом остановки"""
+
+
+class IndexManager:
+    """
+    Версии индекса ES за алиасом: поиск и Загрузчик обращаются к алиасу
+    (movies), данные лежат в версиях индекса (movies_v1, movies_v2, ...).
+    Пересборка индекса без простоя поиска:
+      1. create_build_index - новая версия по схеме из es_indexes, но без
+            refresh и реплик (BULK_LOAD_SETTINGS)
+      2. массовая загрузка Пайплайном в новую версию
+      3. finish_build - вернуть refresh_interval и реплики схемы, refresh,
+            force merge до одного сегмента, дождаться готовности шардов
+      4. swap - атомарно переключить алиас на новую версию (_aliases):
+            поиск видит либо старый индекс, либо полностью готовый новый
+    Если имя алиаса занято обычным индексом (создан init_es.py), swap
+    удаляет его в том же атомарном запросе
+    """
+
+    def __init__(
+        self,
+        alias: str,
+        schema: dict,
+        timeout: Tuple[float, float] = (5, 60),
+        merge_timeout: float = 3600,
+    ):
+        self.url = os.environ.get("ELASTICSEARCH_URL", "")
+        self.alias = alias
+        self.schema = schema
+        self.timeout = timeout
+        self.merge_timeout = merge_timeout
+        self.session = requests.Session()
+
+    @classmethod
+    def from_schema_file(cls, alias: str, indexes_path: str, **kwargs):
+        """Схема индекса из es_indexes/<alias>.json (как в init_es.py)"""
+        with open(os.path.join(indexes_path, f"{alias}.json")) as file:
+            return cls(alias, json.load(file), **kwargs)
+
+    def _request(self, method: str, path: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, urljoin(self.url, path), **kwargs)
+
+    @etl.backoff.on_exception()
+    def get_versions(self) -> List[str]:
+        """Версии индекса (<alias>_v<N>) по возрастанию N"""
+        response = self._request(
+            "GET",
+            f"_cat/indices/{self.alias}_v*",
+            params={"format": "json", "h": "index"},
+        )
+        response.raise_for_status()
+
+        pattern = re.compile(rf"^{re.escape(self.alias)}_v(\d+)$")
+        versions = []
+        for item in response.json():
+            match = pattern.match(item["index"])
+            if match:
+                versions.append((int(match.group(1)), item["index"]))
+
+        return [name for _, name in sorted(versions)]
+
+    @etl.backoff.on_exception()
+    def get_alias_indexes(self) -> List[str]:
+        """Индексы, на которые сейчас указывает алиас"""
+        response = self._request("GET", f"_alias/{self.alias}")
+        if response.status_code == 404:
+            return []
+        response.raise_for_status()
+
+        return sorted(response.json())
+
+    @etl.backoff.on_exception()
+    def exists(self, name: str) -> bool:
+        """Есть ли индекс или алиас с таким именем"""
+        response = self._request("HEAD", name)
+        if response.status_code == 404:
+            return False
+        response.raise_for_status()
+
+        return True
+
+    def create_build_index(self) -> str:
+        """Создать следующую версию индекса для массовой загрузки"""
+        versions = self.get_versions()
+        version = int(versions[-1].rpartition("_v")[2]) + 1 if versions else 1
+        name = f"{self.alias}_v{version}"
+
+        response = self._request(
+            "PUT",
+            name,
+            json={
+                "settings": {**self.schema.get("settings", {}), **BULK_LOAD_SETTINGS},
+                "mappings": self.schema.get("mappings", {}),
+            },
+        )
+        response.raise_for_status()
+        logger.info('Index "%s" has been created for the rebuild', name)
+
+        return name
+
+    def finish_build(self, name: str):
+        """
+        Вернуть индексу настройки схемы и подготовить его к поиску: refresh
+        делает видимыми все документы, force merge сливает сегменты,
+        созданные массовой загрузкой. Настройки, которых нет в схеме,
+        сбрасываются к значениям ES по умолчанию (null)
+        """
+        schema_settings = self.schema.get("settings", {})
+        response = self._request(
+            "PUT",
+            f"{name}/_settings",
+            json={key: schema_settings.get(key) for key in BULK_LOAD_SETTINGS},
+        )
+        response.raise_for_status()
+
+        self._request("POST", f"{name}/_refresh").raise_for_status()
+        self._request(
+            "POST",
+            f"{name}/_forcemerge",
+            params={"max_num_segments": 1},
+            timeout=(self.timeout[0], self.merge_timeout),
+        ).raise_for_status()
+
+        # первичные шарды должны быть готовы до переключения алиаса
+        # (реплики восстанавливаются уже после)
+        self._request(
+            "GET",
+            f"_cluster/health/{name}",
+            params={"wait_for_status": "yellow", "timeout": f"{self.timeout[1]}s"},
+            timeout=(self.timeout[0], self.timeout[1] + self.timeout[0]),
+        ).raise_for_status()
+        logger.info('Index "%s" is ready for search', name)
+
+    def swap(self, name: str) -> List[str]:
+        """
+        Атомарно переключить алиас на индекс name. Возвращает индексы,
+        на которые алиас указывал раньше
+        """
+        previous = [index for index in self.get_alias_indexes() if index != name]
+
+        actions = [{"add": {"index": name, "alias": self.alias}}]
+        actions.extend(
+            {"remove": {"index": index, "alias": self.alias}} for index in previous
+        )
+        if not previous and self.exists(self.alias):
+            # имя алиаса занято индексом, созданным init_es.py
+            actions.append({"remove_index": {"index": self.alias}})
+            logger.warning('Index "%s" will be replaced by an alias', self.alias)
+
+        self._request("POST", "_aliases", json={"actions": actions}).raise_for_status()
+        logger.info('Alias "%s" now points to "%s"', self.alias, name)
+
+        return previous
+
+    def delete(self, name: str):
+        response = self._request("DELETE", name)
+        if response.status_code != 404:
+            response.raise_for_status()
+        logger.info('Index "%s" has been deleted', name)
+
+    def delete_old_versions(self, keep: int = 1):
+        """
+        Удалить прежние версии индекса, кроме keep последних (для отката
+        переключением алиаса обратно)
+        """
+        current = set(self.get_alias_indexes())
+        old = [name for name in self.get_versions() if name not in current]
+        for name in old[: max(len(old) - keep, 0)]:
+            self.delete(name)
+
+
+def rebuild_index(
+    pipe,
+    manager: IndexManager,
+    keep_old: int = 1,
+    stop_event: Optional[threading.Event] = None,
+) -> str:
+    """
+    Пересобрать индекс Пайплайна с нуля и переключить на него алиас.
+
+    Пайплайн перекачивает все данные в новую версию индекса с чистым
+    состоянием в памяти: рабочие контрольные точки не трогаются, пока алиас
+    не переключён. Изменения, сделанные в PG во время пересборки, попадут
+    в индекс тем же проходом - чтение идёт по возрастанию modified.
+    После переключения рабочее состояние Пайплайна продолжается с позиций
+    пересборки. При ошибке или остановке новая версия удаляется
+    """
+    live_state = pipe.states_keeper
+    loader = pipe.loader
+    partial_updates = getattr(loader, "partial_updates", False)
+
+    name = manager.create_build_index()
+    build_state = CachedState(MemoryStorage(), key_prefix=live_state.key_prefix)
+    pipe.states_keeper = build_state
+    loader.set_index(name)
+    # в пустом индексе сравнивать документы не с чем
+    loader.partial_updates = False
+    try:
+        pipe.pump(from_date=None, stop_event=stop_event)
+        if stop_event is not None and stop_event.is_set():
+            raise RebuildInterrupted(name)
+
+        manager.finish_build(name)
+        manager.swap(name)
+    except BaseException as exception:
+        if isinstance(exception, RebuildInterrupted):
+            logger.info('Rebuild of "%s" has been interrupted', manager.alias)
+        else:
+            logger.exception('Rebuild of "%s" has failed', manager.alias)
+        manager.delete(name)
+        raise
+    finally:
+        pipe.states_keeper = live_state
+        loader.set_index(manager.alias)
+        loader.partial_updates = partial_updates
+
+    # рабочее состояние продолжается с позиций пересборки
+    build_state.checkpoint()
+    prefix = live_state.key_prefix
+    for key, value in build_state.storage.retrieve_state().items():
+        live_state.set_state(key.removeprefix(prefix), value)
+    live_state.checkpoint()
+
+    manager.delete_old_versions(keep=keep_old)
+
+    return name
+
+
+def rebuild_indexes(
+    pipes: list,
+    indexes_path: str,
+    max_parallel: Optional[int] = None,
+    keep_old: int = 1,
+    stop_event: Optional[threading.Event] = None,
+) -> bool:
+    """
+    Пересобрать индексы всех Пайплайнов (параллельно, не больше
+    max_parallel одновременно). Индекс Пайплайна - loader.index_name
+    """
+    managers = [
+        IndexManager.from_schema_file(pipe.loader.index_name, indexes_path)
+        for pipe in pipes
+    ]
+
+    with ThreadPoolExecutor(
+        max_workers=max_parallel or len(pipes), thread_name_prefix="rebuild"
+    ) as executor:
+        futures = [
+            executor.submit(
+                rebuild_index,
+                pipe,
+                manager,
+                keep_old=keep_old,
+                stop_event=stop_event,
+            )
+            for pipe, manager in zip(pipes, managers)
+        ]
+
+    failed = [future.exception() for future in futures if future.exception()]
+    for exception in failed:
+        if not isinstance(exception, RebuildInterrupted):
+            raise exception
+
+    return not failed
@@ -0,0 +1,83 @@
+import logging
+import select
+from collections import defaultdict
+from typing import Callable
+
+import psycopg2
+from psycopg2 import sql
+
+import etl.backoff
+from etl.db import get_pg_dns
+
+
+class PgChangesListener:
+    """
+    Слушатель уведомлений PG об изменениях (LISTEN/NOTIFY). Триггеры
+    (pg_triggers/etl_notify.sql) отправляют в канал channel сообщения
+    "<тема>:<id>", где тема - таблица объекта: movies, persons, genres,
+    или изменившиеся связи объекта: movies.links, persons.links, genres.links.
+    Уведомления, пришедшие вместе, схлопываются в множества id по темам.
+
+    Уведомления, отправленные, пока соединения не было, теряются - поэтому
+    после переподключения вызывается on_reconnect (страховочный проход)
+    """
+
+    def __init__(self, channel: str, poll_timeout: float = 1.0):
+        self.channel = channel
+        self.poll_timeout = poll_timeout
+        # keepalive - чтобы обнаружить оборванное соединение, пока ждём
+        # уведомлений, а не через часы по таймауту TCP
+        self.pg_dns = dict(get_pg_dns(), keepalives=1, keepalives_idle=30)
+
+    @etl.backoff.on_exception()
+    def _connect(self):
+        conn = psycopg2.connect(**self.pg_dns)
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(sql.SQL("LISTEN {}").format(sql.Identifier(self.channel)))
+
+        return conn
+
+    def run(
+        self,
+        stop_event,
+        on_changes: Callable[[str, set], None],
+        on_reconnect: Callable[[], None],
+    ):
+        """Слушать канал, пока не будет выставлен stop_event"""
+        connected_before = False
+        while not stop_event.is_set():
+            try:
+                conn = self._connect()
+            except psycopg2.Error:
+                logging.exception("Can't listen to the '%s' channel", self.channel)
+                stop_event.wait(self.poll_timeout)
+                continue
+
+            logging.info("Listening to the '%s' channel", self.channel)
+            if connected_before:
+                on_reconnect()
+            connected_before = True
+
+            try:
+                self._listen(conn, stop_event, on_changes)
+            except (psycopg2.Error, OSError):
+                logging.exception("The '%s' channel connection is lost", self.channel)
+            finally:
+                conn.close()
+
+    def _listen(self, conn, stop_event, on_changes: Callable[[str, set], None]):
+        while not stop_event.is_set():
+            if select.select([conn], [], [], self.poll_timeout) == ([], [], []):
+                continue
+
+            conn.poll()
+            changes = defaultdict(set)
+            for notify in conn.notifies:
+                topic, _, object_id = notify.payload.partition(":")
+                changes[topic].add(object_id)
+            conn.notifies.clear()
+
+            for topic, ids in changes.items():
+                logging.debug("%d %s have been notified", len(ids), topic)
+                on_changes(topic, ids)
@@ -1,61 +1,500 @@
+import gzip
 import json
 import logging
 import os
-from typing import List
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 from urllib.parse import urljoin
 
 import requests
+from requests.adapters import HTTPAdapter
 
 import etl.backoff
-from etl.entities import ElasticSearchEnityType, EnhancedJSONEncoder
+from etl import metrics
+from etl.cache import DocumentHashCache
+from etl.entities import ElasticSearchEnityType
+from etl.serializers import BulkSerializer
 
 logger = logging.getLogger()
 
+# статусы документов и запросов, которые ES отклонил из-за перегрузки
+# или недоступности шардов - их имеет смысл повторить
+RETRY_STATUSES = (429, 503)
+# в ответе _bulk нужны только ошибки документов
+BULK_PARAMS = {"filter_path": "errors,items.*._id,items.*.status,items.*.error"}
+
+
+class BulkBatch(list):
+    """
+    Пачка объектов для загрузки в ES вместе с уже сериализованными строками
+    bulk-запроса (payloads[i] - действие и документ для i-го объекта)
+    """
+
+    def __init__(self, records=(), payloads: Optional[List[bytes]] = None):
+        super().__init__(records)
+        self.payloads = payloads
+
+
+class DeadLetterFile:
+    """
+    Документы, которые ES отверг окончательно (ошибки маппинга и т.п.).
+    NDJSON, строка на документ: индекс, статус и ошибка ES, действие
+    и тело bulk-запроса - документ можно исправить и загрузить повторно
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write(self, index_name: str, payload: bytes, status: int, error):
+        action, *document = payload.splitlines()
+        line = json.dumps(
+            {
+                "failed_at": datetime.now().isoformat(),
+                "index": index_name,
+                "status": status,
+                "error": error,
+                "action": json.loads(action),
+                "document": json.loads(document[0]) if document else None,
+            },
+            ensure_ascii=False,
+        )
+        with self._lock, open(self.path, "a", encoding="utf-8") as file:
+            file.write(line + "\n")
+
 
 class ESLoader:
-    def __init__(self, index_name: str):
+    """
+    Загрузчик данных в ES через _bulk.
+      - bulk_chunks - на сколько частей разбивается пачка из буфера
+      - max_in_flight - сколько _bulk запросов могут выполняться одновременно.
+            На кластере из нескольких узлов параллельные запросы загружают
+            все индексирующие потоки ES. Пачка считается загруженной,
+            только когда успешно загружены все её части
+      - pool_size - сколько keep-alive соединений с ES держит сессия
+      - timeout - (connect, read) таймауты запросов, сек
+      - compress - сжимать тело _bulk запроса gzip (Content-Encoding: gzip)
+      - partial_updates - вместо полной переиндексации сравнивать объекты
+            с проиндексированными документами и отправлять update только
+            с изменившимися полями и элементами вложенных списков.
+            Неизменившиеся документы не отправляются вовсе. С hash_cache
+            документы сравниваются с копиями, сохранёнными в кеше при
+            загрузке, и из ES (_mget) читаются только отсутствующие в нём
+      - hash_cache - кеш хешей загруженных документов: документы, которые
+            ES уже хранит в точности такими же, отбрасываются до отправки.
+            Хеши фиксируются методом commit вместе с состоянием Пайплайна
+      - retry_attempts, retry_start_sleep, retry_border_sleep - повторы
+            документов, отклонённых ES из-за перегрузки (429, 503)
+      - dead_letters - куда откладывать документы с постоянными ошибками.
+            Без него такая ошибка останавливает загрузку, как раньше
+    """
+
+    def __init__(
+        self,
+        index_name: str,
+        bulk_chunks: int = 1,
+        max_in_flight: int = 1,
+        pool_size: int = 10,
+        timeout: Tuple[float, float] = (5, 60),
+        compress: bool = False,
+        partial_updates: bool = False,
+        hash_cache: Optional[DocumentHashCache] = None,
+        retry_attempts: int = 5,
+        retry_start_sleep: float = 0.5,
+        retry_border_sleep: float = 30,
+        dead_letters: Optional[DeadLetterFile] = None,
+    ):
         self.url = os.environ.get("ELASTICSEARCH_URL", "")
         self.index_name = index_name
+        self.bulk_chunks = max(bulk_chunks, 1)
+        self.max_in_flight = max(max_in_flight, 1)
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.compress = compress
+        self.partial_updates = partial_updates
+        self.hash_cache = hash_cache
+        self.retry_attempts = retry_attempts
+        self.retry_start_sleep = retry_start_sleep
+        self.retry_border_sleep = retry_border_sleep
+        self.dead_letters = dead_letters
+        # id документов текущей пачки, отложенных в dead_letters
+        self._dead_lettered = set()
+        self._dead_lettered_lock = threading.Lock()
+        self._index_key = None
+        self._executor = None
+        self._serializer = BulkSerializer(index_name)
+
+        # одна сессия на Загрузчик: соединения переиспользуются между пачками
+        # вместо TCP-handshake на каждый _bulk запрос
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=max(pool_size, self.max_in_flight)
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def set_index(self, index_name: str):
+        """Переключить Загрузчик на другой индекс или алиас"""
+        self.index_name = index_name
+        self._serializer = BulkSerializer(index_name)
+        self._index_key = None
+
+    def serialize(self, record: ElasticSearchEnityType) -> bytes:
+        """
+        Подготавливает строки bulk-запроса в Elasticsearch (действие и документ)
+        для одного объекта
+        """
+        return self._serializer(record)
 
     @staticmethod
-    def _get_es_bulk_query(
-        rows: List[ElasticSearchEnityType], index_name: str
-    ) -> List[str]:
-        """
-        Подготавливает bulk-запрос в Elasticsearch
-        """
-        prepared_query = []
-        for row in rows:
-            prepared_query.extend(
-                [
-                    json.dumps({"index": {"_index": index_name, "_id": row.id}}),
-                    json.dumps(row, cls=EnhancedJSONEncoder),
-                ]
+    def _split(records: list, chunks: int) -> List[list]:
+        """Разбивает список на chunks частей примерно одинакового размера"""
+        chunk_size = -(-len(records) // chunks)
+
+        result = []
+        for start in range(0, len(records), chunk_size):
+            end = start + chunk_size
+            result.append(records[start:end])
+
+        return result
+
+    def load_to_es(self, records: List[ElasticSearchEnityType]) -> bool:
+        """
+        Загрузка пачки в ES. Пачка разбивается на bulk_chunks частей, которые
+        отправляются параллельно, не больше max_in_flight запросов одновременно.
+        Если пачка пришла уже сериализованной (BulkBatch), объекты повторно
+        не кодируются
+        """
+        if not records:
+            return True
+
+        payloads = self._get_payloads(records)
+
+        index_key, hashes = None, None
+        if self.hash_cache is not None:
+            index_key = self._get_index_key()
+        if index_key is not None:
+            hashes = [self.hash_cache.hash(payload) for payload in payloads]
+            records, payloads, hashes = self._skip_unchanged(
+                index_key, records, payloads, hashes
+            )
+            if not records:
+                return True
+
+        documents = None
+        if self.partial_updates:
+            documents = [self._serializer.to_dict(record) for record in records]
+            sources = self._get_cached_sources(index_key, records)
+            missing = [record.id for record in records if record.id not in sources]
+            if missing:
+                sources.update(self._get_sources(missing))
+            payloads = self._get_update_payloads(records, documents, sources)
+
+        self._dead_lettered = set()
+        if not self._load_payloads(payloads):
+            return False
+
+        if hashes is not None:
+            self._stage_hashes(
+                index_key, records, hashes, documents, self._dead_lettered
+            )
+
+        return True
+
+    def _get_payloads(self, records: List[ElasticSearchEnityType]) -> List[bytes]:
+        """Строки bulk-запроса пачки: готовые (BulkBatch) или сериализованные"""
+        if isinstance(records, BulkBatch) and records.payloads is not None:
+            return records.payloads
+
+        return [self.serialize(record) for record in records]
+
+    def _stage_hashes(
+        self,
+        index_key: str,
+        records: list,
+        hashes: list,
+        documents: Optional[list],
+        dead_lettered: set,
+    ):
+        # отложенных документов в ES нет - их хеши не запоминаются
+        self.hash_cache.stage(
+            index_key,
+            [
+                (record.id, document_hash)
+                for record, document_hash in zip(records, hashes)
+                if record.id not in dead_lettered
+            ],
+            [
+                (record.id, document)
+                for record, document in zip(records, documents or ())
+                if record.id not in dead_lettered
+            ],
+        )
+
+    def _get_cached_sources(
+        self, index_key: Optional[str], records: list
+    ) -> Dict[str, dict]:
+        """Копии документов, сохранённые в кеше при загрузке"""
+        if index_key is None:
+            return {}
+
+        return self.hash_cache.get_sources(index_key, [record.id for record in records])
+
+    def commit(self):
+        """
+        Зафиксировать хеши загруженных документов. Вызывается после
+        контрольной точки состояния Пайплайна
+        """
+        if self.hash_cache is not None:
+            self.hash_cache.commit()
+
+    def _load_payloads(self, payloads: List[bytes]) -> bool:
+        if not payloads:
+            return True
+
+        chunks = self._split(payloads, self.bulk_chunks)
+        if len(chunks) == 1 or self.max_in_flight == 1:
+            return all([self._load_chunk(chunk) for chunk in chunks])
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_in_flight,
+                thread_name_prefix=f"es_bulk_{self.index_name}",
             )
-        return prepared_query
+
+        # ждём все части: даже если одна из них не загрузилась, остальные
+        # не должны остаться висеть в пуле
+        return all(list(self._executor.map(self._load_chunk, chunks)))
+
+    def _skip_unchanged(
+        self, index_key: str, records: list, payloads: list, hashes: list
+    ) -> Tuple[list, list, list]:
+        """Отбросить документы, которые ES уже хранит в точности такими же"""
+        cached = self.hash_cache.get(index_key, [record.id for record in records])
+
+        changed = [
+            i
+            for i, (record, document_hash) in enumerate(zip(records, hashes))
+            if cached.get(record.id) != document_hash
+        ]
+        if len(changed) < len(records):
+            logger.info(
+                "%d of %d documents are unchanged and will be skipped",
+                len(records) - len(changed),
+                len(records),
+            )
+
+        return (
+            [records[i] for i in changed],
+            [payloads[i] for i in changed],
+            [hashes[i] for i in changed],
+        )
+
+    @etl.backoff.on_exception()
+    def _get_index_key(self) -> Optional[str]:
+        """
+        Ключ индекса в кеше хешей: "<имя>/<uuid>". Запрашивается один раз
+        после set_index (пересборка переключает индекс через него), а не на
+        каждую пачку: индекс, пересозданный в обход ETL, требует перезапуска.
+        None - если индекса нет (или имя указывает на несколько индексов).
+        Для алиаса ключ строится по индексу, на который он указывает: хеши,
+        накопленные при пересборке версии индекса, остаются в силе после
+        переключения алиаса
+        """
+        if self._index_key is not None:
+            return self._index_key
+
+        response = self.session.get(
+            urljoin(self.url, f"{self.index_name}/_settings/index.uuid"),
+            params={"flat_settings": "true"},
+            timeout=self.timeout,
+        )
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+
+        return self._remember_index_key(response.json())
+
+    def _remember_index_key(self, indexes: dict) -> Optional[str]:
+        """Ключ индекса по ответу _settings. Смена индекса сбрасывает кеш"""
+        if len(indexes) != 1:
+            return None
+
+        ((index_name, index),) = indexes.items()
+        index_key = f"{index_name}/{index['settings']['index.uuid']}"
+        if index_key != self._index_key:
+            self.hash_cache.prune(index_name, index_key)
+            self._index_key = index_key
+
+        return index_key
+
+    def _get_update_payloads(
+        self,
+        records: List[ElasticSearchEnityType],
+        documents: List[dict],
+        sources: Dict[str, dict],
+    ) -> list:
+        """
+        Строки update-действий для объектов (documents - их словари),
+        изменившихся относительно проиндексированных документов sources
+        """
+        payloads = []
+        for record, document in zip(records, documents):
+            payload = self._serializer.update(
+                record, sources.get(record.id), document=document
+            )
+            if payload is not None:
+                payloads.append(payload)
+
+        logger.debug(
+            "%d of %d documents have been changed", len(payloads), len(records)
+        )
+
+        return payloads
 
     @etl.backoff.on_exception()
-    def load_to_es(self, records: List[ElasticSearchEnityType]):
+    def _get_sources(self, ids: List[str]) -> Dict[str, dict]:
+        """Проиндексированные документы по id (отсутствующих в индексе нет)"""
+        response = self.session.post(
+            urljoin(self.url, f"{self.index_name}/_mget"),
+            params={"filter_path": "docs._id,docs._source"},
+            json={"ids": ids},
+            timeout=self.timeout,
+        )
+        if response.status_code == 404:
+            # индекса ещё нет - все документы будут созданы целиком
+            return {}
+        response.raise_for_status()
+
+        return {
+            doc["_id"]: doc["_source"]
+            for doc in response.json().get("docs", [])
+            if "_source" in doc
+        }
+
+    def _load_chunk(self, payloads: List[bytes]) -> bool:
         """
-        Отправка запроса в ES и разбор ошибок сохранения данных
+        Загрузка части пачки. Документы, которые ES не принял из-за
+        перегрузки (429, 503), отправляются повторно - только они,
+        с ожиданием jittered_sleep_time, не больше retry_attempts раз.
+        Документы с постоянными ошибками (маппинг и т.п.) откладываются
+        в dead_letters и загрузку не останавливают
         """
-        prepared_query = self._get_es_bulk_query(records, self.index_name)
-        str_query = "\n".join(prepared_query) + "\n"
+        for tries in range(self.retry_attempts + 1):
+            if tries:
+                metrics.ES_RETRIES.inc(len(payloads), index=self.index_name)
+                time.sleep(
+                    etl.backoff.jittered_sleep_time(
+                        tries - 1,
+                        start_sleep_time=self.retry_start_sleep,
+                        border_sleep_time=self.retry_border_sleep,
+                    )
+                )
+
+            payloads, success = self._send_bulk(payloads)
+            if not success:
+                return False
+            if not payloads:
+                return True
+
+        logger.error(
+            "%d documents have not been accepted by ES after %d retries",
+            len(payloads),
+            self.retry_attempts,
+        )
+
+        return False
 
-        response = requests.post(
+    @etl.backoff.on_exception()
+    def _send_bulk(self, payloads: List[bytes]) -> Tuple[List[bytes], bool]:
+        """
+        Отправка запроса в ES и разбор ошибок сохранения данных по
+        документам. Возвращает документы для повтора и False, если есть
+        постоянные ошибки, которые некуда отложить (нет dead_letters)
+        """
+        body, headers = self._get_bulk_request(payloads)
+        response = self.session.post(
             urljoin(self.url, "_bulk"),
-            params={"filter_path": "items.*.error"},
-            headers={"Content-Type": "application/x-ndjson"},
-            data=str_query,
+            params=BULK_PARAMS,
+            headers=headers,
+            data=body,
+            timeout=self.timeout,
         )
+        if response.status_code >= 400 and response.status_code not in RETRY_STATUSES:
+            response.raise_for_status()
+
+        retry, success, dead_lettered = self._handle_bulk_response(
+            payloads, response.status_code, response.content
+        )
+        with self._dead_lettered_lock:
+            self._dead_lettered.update(dead_lettered)
+
+        return retry, success
 
-        json_response = json.loads(response.content.decode())
+    def _get_bulk_request(self, payloads: List[bytes]) -> Tuple[bytes, dict]:
+        """Тело и заголовки _bulk запроса"""
+        body = b"".join(payloads)
 
-        success = True
-        for item in json_response.get("items", []):
-            error_message = item["index"].get("error")
-            if error_message:
-                logger.error(error_message)
+        headers = {"Content-Type": "application/x-ndjson"}
+        if self.compress:
+            # JSON документов хорошо сжимается, а минимальный уровень сжатия
+            # почти не тратит CPU
+            body = gzip.compress(body, compresslevel=1)
+            headers["Content-Encoding"] = "gzip"
+
+        return body, headers
+
+    def _handle_bulk_response(
+        self, payloads: List[bytes], status_code: int, content: bytes
+    ) -> Tuple[List[bytes], bool, set]:
+        """
+        Разбор ответа _bulk (кроме ошибок запроса, не связанных с перегрузкой).
+        Возвращает документы для повтора, False, если есть постоянные ошибки,
+        которые некуда отложить, и id документов, отложенных в dead_letters
+        """
+        if status_code in RETRY_STATUSES:
+            # ES перегружен и отклонил запрос целиком
+            if status_code == 429:
+                metrics.ES_REJECTIONS.inc(len(payloads), index=self.index_name)
+            logger.warning(
+                "The _bulk request has been rejected: %s",
+                content.decode(errors="replace"),
+            )
+            return payloads, True, set()
+
+        json_response = json.loads(content.decode())
+        if not json_response.get("errors"):
+            return [], True, set()
+
+        retry, success, rejected, dead_lettered = [], True, 0, set()
+        # элементы ответа идут в порядке действий запроса
+        for payload, item in zip(payloads, json_response.get("items", [])):
+            # {"index": {...}} или {"update": {...}}
+            (result,) = item.values()
+            error_message = result.get("error")
+            if not error_message:
+                continue
+
+            status = result.get("status")
+            if status in RETRY_STATUSES:
+                retry.append(payload)
+                # очередь индексирующих потоков узла ES переполнена
+                rejected += status == 429
+                continue
+
+            logger.error(error_message)
+            if self.dead_letters is None:
                 success = False
+                continue
+
+            self.dead_letters.write(self.index_name, payload, status, error_message)
+            metrics.ES_DEAD_LETTERS.inc(index=self.index_name)
+            dead_lettered.add(result.get("_id"))
+
+        if rejected:
+            metrics.ES_REJECTIONS.inc(rejected, index=self.index_name)
 
-        return success
+        return retry, success, dead_lettered
@@ -0,0 +1,368 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+# границы корзин гистограмм: длительность вызова, размер пачки, размер тела
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1, 10, 50, 100, 500, 1000, 5000, 10000, 50000)
+BYTES_BUCKETS = tuple(2 ** power for power in range(10, 28, 2))
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: dict) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+
+    def escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{%s}" % ",".join(f'{key}="{escape(value)}"' for key, value in pairs)
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    """Монотонно растущий счётчик"""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def values(self) -> Dict[Labels, float]:
+        with self._lock:
+            return dict(self._values)
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(_labels(labels), 0)
+
+    def render(self) -> list:
+        return [
+            f"{self.name}{_format_labels(labels)} {_format_value(value)}"
+            for labels, value in sorted(self.values().items())
+        ]
+
+
+class Gauge(Counter):
+    """Значение, которое может как расти, так и уменьшаться"""
+
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[_labels(labels)] = value
+
+
+class Histogram:
+    """Распределение значений по корзинам (как histogram в Prometheus)"""
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: tuple):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        # по меткам: [счётчики корзин (+Inf последней), сумма, количество]
+        self._values: Dict[Labels, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _labels(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            counts = self._values[key]
+            counts[0][index] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def totals(self) -> Dict[Labels, Tuple[float, int]]:
+        """(сумма, количество) значений по меткам"""
+        with self._lock:
+            return {key: (value[1], value[2]) for key, value in self._values.items()}
+
+    def total(self, **labels) -> Tuple[float, int]:
+        """(сумма, количество) значений с метками labels"""
+        with self._lock:
+            _, total, count = self._values.get(_labels(labels), (None, 0.0, 0))
+            return total, count
+
+    def render(self) -> list:
+        with self._lock:
+            values = {
+                key: (list(counts), total, count)
+                for key, (counts, total, count) in self._values.items()
+            }
+
+        lines = []
+        for labels, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(labels, ('le', le))} "
+                    f"{cumulative}"
+                )
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total!r}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+
+        return lines
+
+
+class MetricsRegistry:
+    """Набор метрик процесса с выводом в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, factory, name: str, *args):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = factory(name, *args)
+            return self._metrics[name]
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self._get_or_create(Counter, name, documentation)
+
+    def gauge(self, name: str, documentation: str) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation)
+
+    def histogram(self, name: str, documentation: str, buckets: tuple) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, buckets)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render())
+
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+STAGE_SECONDS = registry.histogram(
+    "etl_stage_duration_seconds",
+    "Duration of a pipeline stage call (query, transformation, _bulk request)",
+    LATENCY_BUCKETS,
+)
+STAGE_ITEMS = registry.counter(
+    "etl_stage_items_total",
+    "Items passed through a pipeline stage (ids, rows or documents)",
+)
+BATCH_SIZE = registry.histogram(
+    "etl_batch_size", "Items in a batch handled by a pipeline stage", SIZE_BUCKETS
+)
+BULK_BYTES = registry.histogram(
+    "etl_bulk_bytes", "Serialized size of a loaded batch", BYTES_BUCKETS
+)
+BACKOFF_RETRIES = registry.counter(
+    "etl_backoff_retries_total", "Retries of failed calls by etl.backoff"
+)
+ES_REJECTIONS = registry.counter(
+    "etl_es_rejections_total",
+    "Documents rejected by Elasticsearch because of overload (HTTP 429)",
+)
+ES_RETRIES = registry.counter(
+    "etl_es_retries_total", "Documents resent to Elasticsearch after 429/503"
+)
+ES_DEAD_LETTERS = registry.counter(
+    "etl_es_dead_letters_total",
+    "Documents rejected by Elasticsearch permanently (written to the dead letters)",
+)
+PG_RECONNECTS = registry.counter(
+    "etl_pg_reconnects_total", "Dead PostgreSQL connections replaced by the pool"
+)
+TUNED_BATCH_SIZE = registry.gauge(
+    "etl_tuned_batch_size", "Batch size chosen by the auto-tuner (etl.autotune)"
+)
+LAG = registry.gauge(
+    "etl_replication_lag_seconds", "Now minus loader.modified of the pipeline"
+)
+
+
+@contextmanager
+def observe_stage(label: str, stage: str):
+    """Замерить длительность вызова стадии Пайплайна"""
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started_at, pipe=label, stage=stage)
+
+
+def observe_iter(label: str, stage: str, items: Iterable) -> Iterator:
+    """
+    Замерить стадию, которая отдаёт результат лениво: время стадии - время
+    получения её элементов (включая ленивые стадии перед ней), количество
+    учитывается, когда элементы закончились
+    """
+    iterator = iter(items)
+    seconds, amount = 0.0, 0
+    try:
+        while True:
+            started_at = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                seconds += time.perf_counter() - started_at
+            amount += 1
+            yield item
+    finally:
+        STAGE_SECONDS.observe(seconds, pipe=label, stage=stage)
+        count_items(label, stage, amount)
+
+
+def count_items(label: str, stage: str, amount: int):
+    """Учесть пачку, прошедшую через стадию Пайплайна"""
+    STAGE_ITEMS.inc(amount, pipe=label, stage=stage)
+    BATCH_SIZE.observe(amount, pipe=label, stage=stage)
+
+
+def set_lag(label: str, modified: Optional[str]):
+    """
+    Отставание Приёмника от Источника: сейчас минус loader.modified.
+    Дата модификации хранится без часового пояса - считается, что часовой
+    пояс сессии PG совпадает с часовым поясом ETL
+    """
+    if not modified:
+        return
+
+    loaded_at = datetime.strptime(modified, "%Y-%m-%d %H:%M:%S.%f")
+    LAG.set(max(time.time() - loaded_at.timestamp(), 0), pipe=label)
+
+
+class MetricsServer:
+    """HTTP-эндпоинт /metrics для сбора метрик Prometheus (в отдельном потоке)"""
+
+    def __init__(self, host: str, port: int, metrics: MetricsRegistry = registry):
+        metrics_registry = metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+
+                content = metrics_registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+
+    def start(self):
+        threading.Thread(
+            target=self._server.serve_forever, name="metrics", daemon=True
+        ).start()
+        logging.info("Metrics are served on %s:%d", *self._server.server_address[:2])
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class SummaryReporter:
+    """
+    Периодическая строка лога со сводкой по Пайплайнам за интервал: скорость
+    и среднее время вызова каждой стадии, повторы вызовов и отставание.
+    Сводка включается отдельной настройкой и пишется в лог с уровнем INFO
+    при любом --log_level: у логгера "etl.metrics" свой уровень, а записи
+    доходят до обработчиков корневого логгера независимо от его уровня
+    """
+
+    def __init__(self, interval: float):
+        self.logger = logging.getLogger("etl.metrics")
+        self.logger.setLevel(logging.INFO)
+        self.interval = interval
+        self._items = {}
+        self._seconds = {}
+        self._retries = {}
+
+    def run(self, stop_event):
+        while not stop_event.wait(self.interval):
+            for line in self.summary():
+                self.logger.info(line)
+
+    def summary(self) -> list:
+        items, seconds = STAGE_ITEMS.values(), STAGE_SECONDS.totals()
+        retries = BACKOFF_RETRIES.values()
+
+        stages_by_pipe = {}
+        for labels, (total, count) in seconds.items():
+            previous_total, previous_count = self._seconds.get(labels, (0, 0))
+            if count == previous_count:
+                continue
+
+            amount = items.get(labels, 0) - self._items.get(labels, 0)
+            label = dict(labels)
+            stages_by_pipe.setdefault(label["pipe"], []).append(
+                "%s %.0f/s avg %.1fms"
+                % (
+                    label["stage"],
+                    amount / self.interval,
+                    (total - previous_total) / (count - previous_count) * 1000,
+                )
+            )
+
+        lag = LAG.values()
+        lines = []
+        for pipe, stages in sorted(stages_by_pipe.items()):
+            pipe_lag = lag.get((("pipe", pipe),))
+            lines.append(
+                "Metrics: %s: %s; lag %s"
+                % (
+                    pipe,
+                    ", ".join(stages),
+                    "n/a" if pipe_lag is None else "%.0fs" % pipe_lag,
+                )
+            )
+
+        retried = {
+            dict(labels)["function"]: amount - self._retries.get(labels, 0)
+            for labels, amount in retries.items()
+            if amount != self._retries.get(labels, 0)
+        }
+        if retried:
+            lines.append(f"Metrics: backoff retries {retried}")
+
+        self._items, self._seconds, self._retries = items, seconds, retries
+
+        return lines
@@ -1,6 +1,15 @@
 import functools
+import itertools
 import logging
-
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, Optional, Union
+
+from etl import metrics
+from etl.autotune import BatchSizeTuner
+from etl.extractor import RowsStream
+from etl.loader import BulkBatch
 from etl.settings import settings
 from etl.transformer import ETLTransformer
 
@@ -15,80 +24,283 @@ def coroutine(func):
     return inner
 
 
+# размер пачки: число или функция, которая возвращает текущий размер
+# (подобранный etl.autotune.BatchSizeTuner)
+BatchSize = Union[int, Callable[[], int]]
+
+
+def get_batch_size(batch_size: BatchSize) -> int:
+    return batch_size() if callable(batch_size) else batch_size
+
+
+def init_extractor_state(forced_modification_date: str, state=object):
+    """
+    Определяет точку (modified, id), с которой Экстрактор начнёт чтение.
+    Без forced_modification_date чтение продолжается с точки восстановления
+    Загрузчика (loader.*), а не с сохранённой позиции Экстрактора:
+    extractor.* сдвигается, как только пачка прочитана, и после сбоя загрузки
+    или остановки процесса указывает за строки, которых в ES ещё нет
+    """
+    if forced_modification_date:
+        state.set_state("extractor.modified", forced_modification_date)
+        state.set_state("extractor.id", None)
+    elif state.get_state("loader.modified"):
+        state.set_state("extractor.modified", state.get_state("loader.modified"))
+        state.set_state("extractor.id", state.get_state("loader.id"))
+    else:
+        state.set_state("extractor.modified", settings.start_date)
+        state.set_state("extractor.id", None)
+
+
 # генератор, вытаскивает данные пачками, пока данные не закончатся
 def extract(
     target,
     forced_modification_date: str,
-    batch_size=100,
+    batch_size: BatchSize = 100,
     extractor=object,
     state=object,
+    stop_event=None,
+    label="",
 ):
-    if forced_modification_date:
-        state.set_state("extractor.modified", forced_modification_date)
-        state.set_state("offset", 0)
-    if state.get_state("loader.modified") and not state.get_state("extractor.modified"):
-        state.set_state("extractor.modified", state.get_state("loader.modified"))
-    if not state.get_state("extractor.modified"):
-        state.set_state("extractor.modified", settings.start_date)
-    if not state.get_state("offset"):
-        state.set_state("offset", 0)
+    init_extractor_state(forced_modification_date, state=state)
 
     try:
         while True:
+            if stop_event and stop_event.is_set():
+                logging.info("Extraction interrupted by a stop request")
+                # пустая пачка останавливает оставшуюся часть pipe
+                target.send(tuple())
+
             modified = state.get_state("extractor.modified")
-            offset = state.get_state("offset")
+            last_id = state.get_state("extractor.id")
+            limit = get_batch_size(batch_size)
 
             # возвращает [(<movie_id>, <movie_modified>), ...]
-            data = extractor.get_modified_ids(
-                modified=modified, limit=batch_size, offset=offset
-            )
+            # упорядоченные по (modified, id), строго после (modified, last_id)
+            with metrics.observe_stage(label, "extract"):
+                data = extractor.get_modified_ids(
+                    modified=modified, last_id=last_id, limit=limit
+                )
+            metrics.count_items(label, "extract", len(data))
 
             logging.info(
-                "The data has been extracted. Params: modified >= %s "
-                + "LIMIT %d OFFSET %d. Amount %d",
+                "The data has been extracted. Params: (modified, id) > (%s, %s) "
+                + "LIMIT %d. Amount %d",
                 modified,
-                batch_size,
-                offset,
+                last_id,
+                limit,
                 len(data),
             )
 
             if data:
-                last_modified = state.get_state("extractor.modified")
-                if last_modified == str(data[-1][1].strftime("%Y-%m-%d %H:%M:%S.%f")):
-                    offset = int(state.get_state("offset") or 0)
-                    state.set_state("offset", offset + len(data))
-                else:
-                    state.set_state("offset", 0)
-
                 state.set_state(
                     "extractor.modified",
                     str(data[-1][1].strftime("%Y-%m-%d %H:%M:%S.%f")),
                 )
+                state.set_state("extractor.id", str(data[-1][0]))
+
+            target.send(tuple(map(lambda item: item[0], data)))
+    except StopIteration:
+        logging.warning("Extraction stopped")
+
+
+# потоковый вариант extract: все идентификаторы читаются одним запросом
+# через server-side курсор и отправляются дальше пачками по batch_size
+def stream_extract(
+    target,
+    forced_modification_date: str,
+    batch_size: BatchSize = 100,
+    extractor=object,
+    state=object,
+    stop_event=None,
+    label="",
+):
+    init_extractor_state(forced_modification_date, state=state)
+
+    modified = state.get_state("extractor.modified")
+    last_id = state.get_state("extractor.id")
+    stream = extractor.iter_modified_ids(
+        modified=modified, last_id=last_id, batch_size=get_batch_size(batch_size)
+    )
+    # пачки собираются заново: размер может меняться на ходу
+    rows = itertools.chain.from_iterable(stream)
+
+    logging.info(
+        "Streaming extraction started. Params: (modified, id) > (%s, %s)",
+        modified,
+        last_id,
+    )
+
+    try:
+        while True:
+            with metrics.observe_stage(label, "extract"):
+                data = list(itertools.islice(rows, get_batch_size(batch_size)))
+            if not data:
+                break
+            metrics.count_items(label, "extract", len(data))
+
+            if stop_event and stop_event.is_set():
+                logging.info("Extraction interrupted by a stop request")
+                break
+
+            logging.info("The data has been extracted. Amount %d", len(data))
+
+            state.set_state(
+                "extractor.modified",
+                str(data[-1][1].strftime("%Y-%m-%d %H:%M:%S.%f")),
+            )
+            state.set_state("extractor.id", str(data[-1][0]))
 
             target.send(tuple(map(lambda item: item[0], data)))
+
+        # пустая пачка останавливает оставшуюся часть pipe
+        target.send(tuple())
     except StopIteration:
         logging.warning("Extraction stopped")
+    finally:
+        stream.close()
+
+
+def iter_related_target_ids(
+    extractor, relation: str, related_ids: tuple, batch_size: int
+) -> Iterator[tuple]:
+    """
+    Пачки id объектов, в которые вложены связанные сущности related_ids
+    """
+    last_target_id = None
+    while target_ids := extractor.get_movie_ids_by_related_ids(
+        relation, related_ids, last_movie_id=last_target_id, limit=batch_size
+    ):
+        yield tuple(target_ids)
+        last_target_id = target_ids[-1]
+
+
+# генератор, распространяет изменения связанных сущностей (персон, жанров)
+# на документы, в которые они вложены: находит модифицированные связанные
+# сущности и отправляет дальше id затронутых ими объектов
+def fan_out(
+    target,
+    forced_modification_date: str,
+    relations: tuple = (),
+    batch_size=100,
+    extractor=object,
+    state=object,
+    stop_event=None,
+    label="",
+):
+    try:
+        for relation in relations:
+            prefix = f"fan_out.{relation}."
+
+            if forced_modification_date:
+                state.set_state(prefix + "modified", forced_modification_date)
+                state.set_state(prefix + "id", None)
+            if not state.get_state(prefix + "modified"):
+                # первый запуск: все текущие документы и так будут выгружены
+                # основным extract - начинаем с последнего изменения
+                last_key = extractor.get_last_related_key(relation)
+                if not last_key:
+                    continue
+                state.set_state(
+                    prefix + "modified",
+                    str(last_key[1].strftime("%Y-%m-%d %H:%M:%S.%f")),
+                )
+                state.set_state(prefix + "id", str(last_key[0]))
+
+            while not (stop_event and stop_event.is_set()):
+                modified = state.get_state(prefix + "modified")
+                last_id = state.get_state(prefix + "id")
+
+                with metrics.observe_stage(label, "fan_out"):
+                    related = extractor.get_modified_related_ids(
+                        relation, modified=modified, last_id=last_id, limit=batch_size
+                    )
+                if not related:
+                    break
+
+                related_ids = tuple(map(lambda item: item[0], related))
+
+                amount = 0
+                target_batches = iter_related_target_ids(
+                    extractor, relation, related_ids, batch_size
+                )
+                while True:
+                    with metrics.observe_stage(label, "fan_out"):
+                        target_ids = next(target_batches, None)
+                    if target_ids is None:
+                        break
+                    metrics.count_items(label, "fan_out", len(target_ids))
+
+                    target.send(target_ids)
+                    amount += len(target_ids)
+
+                logging.info(
+                    "Changes of %d %s have been fanned out to %d objects",
+                    len(related),
+                    relation,
+                    amount,
+                )
+
+                state.set_state(
+                    prefix + "modified",
+                    str(related[-1][1].strftime("%Y-%m-%d %H:%M:%S.%f")),
+                )
+                state.set_state(prefix + "id", str(related[-1][0]))
+
+        # пустая пачка останавливает оставшуюся часть pipe
+        target.send(tuple())
+    except StopIteration:
+        logging.debug("Fan-out stopped")
 
 
 @coroutine
-def enrich(target, extractor=object):
+def enrich(target, extractor=object, lazy=False, label=""):
     try:
         while ids := (yield):
-            data = extractor.get_data_by_ids(ids)
+            if lazy:
+                # строки читаются по мере того, как их забирает transform
+                data = extractor.iter_data_by_ids(ids)
+                logging.info("The data is streamed for %d ids", len(ids))
+                target.send(
+                    RowsStream(
+                        metrics.observe_iter(label, "enrich", data), data.columns
+                    )
+                )
+                continue
+
+            with metrics.observe_stage(label, "enrich"):
+                data = extractor.get_data_by_ids(ids)
+            metrics.count_items(label, "enrich", len(data))
 
             logging.info(
                 "The data has been enriched. Number of rows received %d", len(data)
             )
 
+            # объекты пачки могли удалить после того, как их id были получены:
+            # пустой список остановил бы корутину transform и весь pipe
+            if not data:
+                continue
+
             target.send(data)
     except StopIteration:
         logging.warning("Extraction stopped")
 
 
 @coroutine
-def transform(target, transformer: ETLTransformer):
+def transform(target, transformer: ETLTransformer, lazy=False, label=""):
     while raw_data := (yield):
-        transformed_objects = transformer.transform(raw_data)
+        if lazy:
+            # объекты создаются по мере того, как их забирает buffer
+            target.send(
+                metrics.observe_iter(
+                    label, "transform", transformer.iter_transform(raw_data)
+                )
+            )
+            continue
+
+        with metrics.observe_stage(label, "transform"):
+            transformed_objects = transformer.transform(raw_data)
+        metrics.count_items(label, "transform", len(transformed_objects))
 
         logging.info(
             "Transformed %d sql rows into %d objects",
@@ -100,53 +312,221 @@ def transform(target, transformer: ETLTransformer):
 
 
 def build_buffer():
-    upload_buffer = []
+    upload_buffer = BulkBatch()
+    upload_size = 0
+    started_at = None
 
     @coroutine
-    def buffer(target, batch_size=1000):
-        nonlocal upload_buffer
+    def buffer(
+        target,
+        batch_size: BatchSize = 1000,
+        max_bytes: Optional[int] = None,
+        max_age: Optional[float] = None,
+        serializer: Optional[Callable[[Any], bytes]] = None,
+        label="",
+    ):
+        """
+        Копит объекты и передаёт их дальше, как только сработает любое из
+        ограничений: batch_size объектов, max_bytes байт сериализованного
+        bulk-запроса или max_age секунд с момента появления первого объекта.
+        Ограничения проверяются при поступлении данных: стадия, которая
+        кормит буфер, при простое посылает ему пустой список, чтобы пачка
+        не ждала следующих данных дольше max_age.
+        Если задан serializer, объекты сериализуются здесь один раз
+        и дальше передаются вместе с готовыми строками bulk-запроса.
+        Объекты приходят списком или ленивым итератором (режим lazy)
+        """
+        nonlocal upload_buffer, upload_size, started_at
+
+        def flush(reason: str):
+            nonlocal upload_buffer, upload_size, started_at
+            logging.info(
+                "The buffer for %d elements (%d bytes, limit: %s) has been "
+                + "successfully formed. "
+                + "The data will be transferred further along the pipeline. ",
+                len(upload_buffer),
+                upload_size,
+                reason,
+            )
+            if upload_size:
+                metrics.BULK_BYTES.observe(upload_size, pipe=label)
+
+            batch = upload_buffer
+            upload_buffer, upload_size, started_at = BulkBatch(), 0, None
+            target.send(batch)
+
         while True:
             data = (yield)
 
-            if data and isinstance(data, list):
-                upload_buffer += data
-
-            if len(upload_buffer) >= batch_size:
-                logging.info(
-                    "The buffer for %d elements has been successfully formed. "
-                    + "The data will be transferred further along the pipeline. ",
-                    len(upload_buffer),
-                )
-                target.send(upload_buffer)
-                upload_buffer = []
+            if data and isinstance(data, (list, Iterator)):
+                if serializer and upload_buffer.payloads is None:
+                    upload_buffer.payloads = []
+
+                # время сериализации пачки - без времени отправки дальше
+                serialize_seconds, serialized = 0.0, 0
+                for item in data:
+                    if serializer:
+                        serialize_started_at = time.perf_counter()
+                        payload = serializer(item)
+                        serialize_seconds += time.perf_counter() - serialize_started_at
+                        # пачка не должна превысить max_bytes - иначе ES
+                        # может отклонить запрос (413 Request Entity Too Large)
+                        if (
+                            max_bytes
+                            and upload_buffer
+                            and upload_size + len(payload) > max_bytes
+                        ):
+                            flush("bytes")
+                            upload_buffer.payloads = []
+
+                        upload_buffer.payloads.append(payload)
+                        upload_size += len(payload)
+                        serialized += 1
+
+                    upload_buffer.append(item)
+                    if started_at is None:
+                        started_at = time.monotonic()
+
+                if serializer:
+                    metrics.STAGE_SECONDS.observe(
+                        serialize_seconds, pipe=label, stage="serialize"
+                    )
+                    metrics.count_items(label, "serialize", serialized)
+
+            if len(upload_buffer) >= get_batch_size(batch_size):
+                flush("count")
+            elif (
+                max_age is not None
+                and started_at is not None
+                and time.monotonic() - started_at >= max_age
+            ):
+                flush("age")
 
     return buffer
 
 
 @coroutine
-def load(loader=object, state=object):
+def load(loader=object, state=object, label="", tuner=None):
     while dataclasses_objects := (yield):
         logging.info(
             "%d records will be uploaded to ElasticSearch", len(dataclasses_objects)
         )
 
-        res = loader.load_to_es(dataclasses_objects)
+        with metrics.observe_stage(label, "load"):
+            res = loader.load_to_es(dataclasses_objects)
+        if tuner is not None:
+            tuner.update()
         if not res:
             raise StopIteration
 
-        state.set_state("loader.modified", dataclasses_objects[-1].modified)
+        save_checkpoint(dataclasses_objects, loader=loader, state=state, label=label)
+
+
+def save_checkpoint(dataclasses_objects: list, loader=object, state=object, label=""):
+    """
+    Сдвинуть точку восстановления после загруженной пачки и зафиксировать
+    состояние (и хеши документов Загрузчика)
+    """
+    # объекты в буфере не упорядочены по (modified, id) - трансформер
+    # группирует строки в произвольном порядке. Точка восстановления -
+    # максимальная пара из загруженной пачки
+    last_loaded = max(dataclasses_objects, key=lambda item: (item.modified, item.id))
+    # пачки из fan_out содержат объекты со старым modified -
+    # точка восстановления не должна сдвигаться назад
+    checkpoint = (
+        state.get_state("loader.modified") or "",
+        state.get_state("loader.id") or "",
+    )
+    if (last_loaded.modified, last_loaded.id) > checkpoint:
+        state.set_state("loader.modified", last_loaded.modified)
+        state.set_state("loader.id", last_loaded.id)
+    metrics.count_items(label, "load", len(dataclasses_objects))
+    metrics.set_lag(label, state.get_state("loader.modified"))
+
+    # данные подтверждены Приёмником - фиксируем состояние
+    state.checkpoint()
+    commit = getattr(loader, "commit", None)
+    if commit is not None:
+        commit()
+
+
+class PipelineAborted(Exception):
+    """Одна из стадий конвейера завершилась с ошибкой"""
+
+
+# маркер конца потока данных в очередях между стадиями
+_END_OF_DATA = object()
+# маркер простоя: в очереди ничего не появилось за IDLE_CHECK_INTERVAL
+_IDLE = object()
+# как часто стадия, ожидающая данных, проверяет возраст пачки в буфере
+IDLE_CHECK_INTERVAL = 0.1  # sec
+
+
+def _put(target_queue: queue.Queue, item, abort: threading.Event):
+    """Положить элемент в ограниченную очередь, ожидая свободного места"""
+    while not abort.is_set():
+        try:
+            target_queue.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+    raise PipelineAborted()
+
+
+def _get(source_queue: queue.Queue, abort: threading.Event, idle: bool = False):
+    """
+    Взять элемент из очереди. При аварийной остановке - конец данных,
+    если idle и очередь пуста IDLE_CHECK_INTERVAL секунд - _IDLE
+    """
+    while not abort.is_set():
+        try:
+            return source_queue.get(timeout=IDLE_CHECK_INTERVAL)
+        except queue.Empty:
+            if idle:
+                return _IDLE
+
+    return _END_OF_DATA
+
+
+@coroutine
+def enqueue(target_queue: queue.Queue, abort: threading.Event):
+    # передаёт данные следующей стадии, работающей в другом потоке.
+    # Если следующая стадия не успевает, очередь заполняется и текущая стадия
+    # ждёт (backpressure)
+    while data := (yield):
+        _put(target_queue, data, abort)
 
 
 class PipeEETBL:
     """
     Класс формурующий конкретныйы Пайплайн.
-      - extract - вытащить список id объектов, которые были модифицированы
+      - extract - вытащить список id объектов, которые были модифицированы.
+            В режиме streaming все id читаются одним запросом через
+            server-side курсор (полная переиндексация)
+      - fan_out - (после extract) вытащить id объектов, в которые вложены
+            модифицированные связанные сущности (fan_out_relations)
       - enrich - обогатить данные, достав всю необходимую информацию по объекту
             и по связанным сущностям
       - transform - переформатировать данные из строк полученных из Источника
-            в объекты пригодные для загрузки в Приёмник
-      - buffer - буферизовать поступающие данные
+            в объекты пригодные для загрузки в Приёмник.
+            В режиме lazy строки читаются server-side курсором, упорядоченными
+            по id объекта, а объекты отдаются в buffer по одному, как только
+            закончились их строки: в памяти - строки одного объекта,
+            а не всей пачки
+      - buffer - буферизовать поступающие данные. Пачка уходит дальше по
+            первому сработавшему ограничению: loader_batch_size объектов,
+            loader_batch_bytes байт или loader_batch_max_age секунд.
+            В режиме pipelined возраст пачки проверяется и при простое,
+            пока extract ждёт PG
       - load - отправить данные в Приёмник
+
+    В режиме autotune размеры пачек extract и buffer подбираются на ходу
+    в границах extractor_batch_bounds и loader_batch_bounds
+    (etl.autotune.BatchSizeTuner)
+
+    Вместо extract + fan_out id объектов могут прийти извне - из уведомлений
+    PG об изменениях (push)
     """
 
     def __init__(
@@ -158,6 +538,16 @@ class PipeEETBL:
         states_keeper: object,
         extractor_batch_size=100,
         loader_batch_size=1000,
+        loader_batch_bytes: Optional[int] = None,
+        loader_batch_max_age: Optional[float] = None,
+        streaming=False,
+        pipelined=False,
+        queue_size=2,
+        fan_out_relations: tuple = (),
+        lazy=False,
+        autotune=False,
+        extractor_batch_bounds: Optional[tuple] = None,
+        loader_batch_bounds: Optional[tuple] = None,
     ):
         self.label = label
         self.extractor = extractor
@@ -166,39 +556,192 @@ class PipeEETBL:
         self.states_keeper = states_keeper
         self.extractor_batch_size = extractor_batch_size
         self.loader_batch_size = loader_batch_size
+        self.loader_batch_bytes = loader_batch_bytes
+        self.loader_batch_max_age = loader_batch_max_age
+        # объекты сериализуются один раз в буфере, если Загрузчик это умеет
+        self.serializer = getattr(loader, "serialize", None)
+        self.streaming = streaming
+        self.pipelined = pipelined
+        self.queue_size = queue_size
+        self.fan_out_relations = fan_out_relations
+        self.lazy = lazy
+        self.tuner = None
+        if autotune:
+            self.tuner = BatchSizeTuner(
+                label,
+                loader,
+                extractor_batch_size,
+                loader_batch_size,
+                extractor_bounds=extractor_batch_bounds,
+                loader_bounds=loader_batch_bounds,
+                enrich_seconds=settings.autotune_enrich_seconds,
+                load_seconds=settings.autotune_load_seconds,
+            )
+        # тема уведомлений PG об изменениях объектов Пайплайна (см. push)
+        self.topic = getattr(extractor, "source_table", "").rpartition(".")[2]
+
+    def get_extractor_batch_size(self) -> int:
+        """Текущий размер пачки extract"""
+        if self.tuner is not None:
+            return self.tuner.extractor_batch_size
+        return self.extractor_batch_size
+
+    def get_loader_batch_size(self) -> int:
+        """Текущий размер пачки buffer"""
+        if self.tuner is not None:
+            return self.tuner.loader_batch_size
+        return self.loader_batch_size
+
+    @property
+    def links_topic(self) -> str:
+        """Тема уведомлений PG об изменениях связей объектов Пайплайна"""
+        return f"{self.topic}.links"
+
+    @property
+    def listen_topics(self) -> tuple:
+        """Темы уведомлений PG, на которые реагирует Пайплайн"""
+        return (self.topic, self.links_topic) + tuple(self.fan_out_relations)
+
+    def pump(self, from_date: str, stop_event=None):
+        """
+        Перекачать все изменившиеся данные. stop_event (threading.Event)
+        позволяет прервать перекачку между пачками: уже извлечённые данные
+        будут догружены, состояние зафиксировано
+        """
+        if self.pipelined:
+            return self._pump_pipelined(from_date, stop_event=stop_event)
 
-    def pump(self, from_date: str):
         buffer = build_buffer()
+        extract_stage = stream_extract if self.streaming else extract
 
         # основной pipe на корутинах - вытаскивает данные из Источника,
         # трансформирует, буферезует и загружает в Приёмник.
         # Останавливается, когда данные закончились.
         try:
-            extract(
-                enrich(
-                    transform(
-                        buffer(
-                            load(
-                                loader=self.loader,
-                                state=self.states_keeper,
-                            ),
-                            batch_size=self.loader_batch_size,
+            extract_stage(
+                self._transform_chain(
+                    self._buffer_stage(
+                        buffer,
+                        load(
+                            loader=self.loader,
+                            state=self.states_keeper,
+                            label=self.label,
+                            tuner=self.tuner,
                         ),
-                        transformer=self.transformer,
-                    ),
-                    extractor=self.extractor,
+                    )
                 ),
                 forced_modification_date=from_date,
                 extractor=self.extractor,
                 state=self.states_keeper,
-                batch_size=self.extractor_batch_size,
+                batch_size=self.get_extractor_batch_size,
+                stop_event=stop_event,
+                label=self.label,
             )
         except StopIteration:
             logging.debug("Done. The pipeline has run out of data.")
 
-        # доборный pipe - проталкивает в ES то что осталось в буфере
+        # pipe связанных сущностей - тот же буфер и загрузка
+        if self.fan_out_relations:
+            fan_out(
+                self._transform_chain(
+                    self._buffer_stage(
+                        buffer,
+                        load(
+                            loader=self.loader,
+                            state=self.states_keeper,
+                            label=self.label,
+                            tuner=self.tuner,
+                        ),
+                    )
+                ),
+                forced_modification_date=from_date,
+                relations=self.fan_out_relations,
+                extractor=self.extractor,
+                state=self.states_keeper,
+                batch_size=self.get_extractor_batch_size(),
+                stop_event=stop_event,
+                label=self.label,
+            )
+
+        self._flush(buffer)
+
+        return True
+
+    def push(self, changes: Dict[str, set], stop_event=None):
+        """
+        Перекачать объекты, об изменении которых сообщили уведомления PG.
+        changes - id изменённых объектов по темам (listen_topics): id объектов
+        Пайплайна (в том числе с изменившимися связями, links_topic)
+        загружаются напрямую, id изменившихся связанных сущностей сначала
+        превращаются в id объектов, в которые они вложены
+        """
+        batches = []
+        batch_size = self.get_extractor_batch_size()
+        ids = tuple(
+            dict.fromkeys(
+                itertools.chain(
+                    changes.get(self.topic, ()), changes.get(self.links_topic, ())
+                )
+            )
+        )
+        for start in range(0, len(ids), batch_size):
+            end = start + batch_size
+            batches.append(ids[start:end])
+
+        for relation in self.fan_out_relations:
+            related_ids = tuple(changes.get(relation, ()))
+            if related_ids:
+                batches.extend(
+                    iter_related_target_ids(
+                        self.extractor,
+                        relation,
+                        related_ids,
+                        batch_size,
+                    )
+                )
+
+        buffer = build_buffer()
+        pipe_head = self._transform_chain(
+            self._buffer_stage(
+                buffer,
+                load(
+                    loader=self.loader,
+                    state=self.states_keeper,
+                    label=self.label,
+                    tuner=self.tuner,
+                ),
+            )
+        )
+        try:
+            for batch in batches:
+                if stop_event and stop_event.is_set():
+                    break
+                pipe_head.send(batch)
+        except StopIteration:
+            logging.debug("Done. The pipeline has run out of data.")
+
+        self._flush(buffer)
+
+        logging.info(
+            "Notified changes have been pushed: %s",
+            {topic: len(ids) for topic, ids in changes.items()},
+        )
+
+        return True
+
+    def _flush(self, buffer):
+        """
+        Доборный pipe - проталкивает в Приёмник то, что осталось в буфере,
+        и фиксирует состояние
+        """
         pipe_tail = buffer(
-            load(loader=self.loader, state=self.states_keeper), batch_size=1
+            load(
+                loader=self.loader,
+                state=self.states_keeper,
+                label=self.label,
+                tuner=self.tuner,
+            ),
+            batch_size=1,
         )
 
         try:
@@ -207,5 +750,135 @@ class PipeEETBL:
             logging.debug("Done. Additional pipeline has run out of data.")
         finally:
             pipe_tail.close()
+            self.states_keeper.checkpoint()
+            metrics.set_lag(self.label, self.states_keeper.get_state("loader.modified"))
+
+    def _buffer_stage(self, buffer, target):
+        """buffer -> target"""
+        return buffer(
+            target,
+            batch_size=self.get_loader_batch_size,
+            max_bytes=self.loader_batch_bytes,
+            max_age=self.loader_batch_max_age,
+            serializer=self.serializer,
+            label=self.label,
+        )
+
+    def _transform_chain(self, buffer_stage):
+        """enrich -> transform -> buffer_stage"""
+        return enrich(
+            transform(
+                buffer_stage,
+                transformer=self.transformer,
+                lazy=self.lazy,
+                label=self.label,
+            ),
+            extractor=self.extractor,
+            lazy=self.lazy,
+            label=self.label,
+        )
+
+    def _pump_pipelined(self, from_date: str, stop_event=None):
+        """
+        Конвейерный вариант pump. Стадии работают в отдельных потоках
+        и связаны ограниченными очередями (queue_size пачек):
+          - extract
+          - enrich -> transform -> buffer
+          - load (в текущем потоке)
+        Пока load ждёт ответа ES, PostgreSQL уже отдаёт следующие пачки.
+        Загрузка идёт в одном потоке в порядке извлечения, поэтому
+        loader.modified продвигается только после подтверждения ES всех
+        предыдущих пачек
+        """
+        ids_queue = queue.Queue(maxsize=self.queue_size)
+        objects_queue = queue.Queue(maxsize=self.queue_size)
+        abort = threading.Event()
+        errors = []
+
+        extract_stage = stream_extract if self.streaming else extract
+
+        def run_extract():
+            try:
+                extract_stage(
+                    enqueue(ids_queue, abort),
+                    forced_modification_date=from_date,
+                    extractor=self.extractor,
+                    state=self.states_keeper,
+                    batch_size=self.get_extractor_batch_size,
+                    stop_event=stop_event,
+                    label=self.label,
+                )
+                if self.fan_out_relations:
+                    fan_out(
+                        enqueue(ids_queue, abort),
+                        forced_modification_date=from_date,
+                        relations=self.fan_out_relations,
+                        extractor=self.extractor,
+                        state=self.states_keeper,
+                        batch_size=self.get_extractor_batch_size(),
+                        stop_event=stop_event,
+                        label=self.label,
+                    )
+                _put(ids_queue, _END_OF_DATA, abort)
+            except PipelineAborted:
+                pass
+            except Exception as exception:
+                errors.append(exception)
+                abort.set()
+
+        def run_transform():
+            buffer = build_buffer()
+            try:
+                buffer_stage = self._buffer_stage(buffer, enqueue(objects_queue, abort))
+                pipe_head = self._transform_chain(buffer_stage)
+                # пока extract ждёт ответа PG, буфер проверяет возраст пачки
+                idle = self.loader_batch_max_age is not None
+                while (ids := _get(ids_queue, abort, idle=idle)) is not _END_OF_DATA:
+                    if ids is _IDLE:
+                        buffer_stage.send([])
+                    else:
+                        pipe_head.send(ids)
+
+                if abort.is_set():
+                    return
+
+                # проталкиваем дальше то, что осталось в буфере
+                buffer(enqueue(objects_queue, abort), batch_size=1).send(None)
+                _put(objects_queue, _END_OF_DATA, abort)
+            except PipelineAborted:
+                pass
+            except Exception as exception:
+                errors.append(exception)
+                abort.set()
+
+        workers = [
+            threading.Thread(target=run_extract, name=f"{self.label} (extract)"),
+            threading.Thread(target=run_transform, name=f"{self.label} (transform)"),
+        ]
+        for worker in workers:
+            worker.start()
+
+        try:
+            pipe_tail = load(
+                loader=self.loader,
+                state=self.states_keeper,
+                label=self.label,
+                tuner=self.tuner,
+            )
+            while (objects := _get(objects_queue, abort)) is not _END_OF_DATA:
+                pipe_tail.send(objects)
+        except BaseException:
+            abort.set()
+            raise
+        finally:
+            for worker in workers:
+                worker.join()
+            self.states_keeper.checkpoint()
+            metrics.set_lag(self.label, self.states_keeper.get_state("loader.modified"))
+
+        if errors:
+            raise errors[0]
+
+        logging.debug("Done. The pipeline has run out of data.")
 
         return True
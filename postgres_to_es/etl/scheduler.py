@@ -0,0 +1,160 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from etl.pipes import PipeEETBL
+
+
+class PipesScheduler:
+    """
+    Планировщик, запускающий Пайплайны параллельно - каждый в своём потоке
+    со своими Экстрактором (соединением с PG), Загрузчиком и состоянием.
+    Пайплайн работает по циклу "перекачать всё, что изменилось -> уснуть на
+    sleep_time", поэтому долгая перекачка фильмов не задерживает жанры и персон,
+    а задержка обновления определяется самым медленным Пайплайном, а не суммой.
+
+      - max_parallel - сколько Пайплайнов может качать данные одновременно
+            (ограничение нагрузки на PG и ES). По умолчанию - все сразу
+      - один и тот же Пайплайн никогда не запускается параллельно сам с собой
+
+    С источником уведомлений (listener) Пайплайн просыпается не по таймеру,
+    а по уведомлению PG: id, накопившиеся за coalesce_time, перекачиваются
+    одной пачкой (PipeEETBL.push). Полная перекачка изменений (pump) остаётся
+    страховочным проходом раз в sleep_time и после переподключения к PG,
+    когда уведомления могли быть потеряны
+    """
+
+    def __init__(
+        self,
+        sleep_time: int,
+        max_parallel: Optional[int] = None,
+        coalesce_time: float = 0.5,
+    ):
+        self.sleep_time = sleep_time
+        self.max_parallel = max_parallel
+        self.coalesce_time = coalesce_time
+        self.stop_event = threading.Event()
+
+        self._pipes: List[PipeEETBL] = []
+        self._lock = threading.Lock()
+        # по метке Пайплайна: накопленные id по темам, событие пробуждения
+        # и время следующего страховочного прохода
+        self._changes: Dict[str, Dict[str, set]] = {}
+        self._wakeups: Dict[str, threading.Event] = {}
+        self._next_sweep: Dict[str, float] = {}
+
+    def stop(self):
+        """
+        Остановить все Пайплайны. Текущие пачки данных будут догружены,
+        состояние зафиксировано
+        """
+        self.stop_event.set()
+        for wakeup in list(self._wakeups.values()):
+            wakeup.set()
+
+    def notify(self, topic: str, ids: set):
+        """Передать id изменённых объектов Пайплайнам, слушающим тему"""
+        with self._lock:
+            for pipe in self._pipes:
+                if topic in pipe.listen_topics:
+                    self._changes[pipe.label][topic].update(ids)
+                    self._wakeups[pipe.label].set()
+
+    def request_sweep(self):
+        """Запустить страховочный проход всех Пайплайнов без ожидания"""
+        with self._lock:
+            for pipe in self._pipes:
+                self._next_sweep[pipe.label] = 0
+                self._wakeups[pipe.label].set()
+
+    def run(
+        self,
+        pipes: List[PipeEETBL],
+        from_date: Optional[str] = None,
+        listener=None,
+    ):
+        """
+        Запустить Пайплайны и ждать, пока планировщик не будет остановлен
+        """
+        slots = threading.BoundedSemaphore(self.max_parallel or len(pipes))
+
+        with self._lock:
+            self._pipes = list(pipes)
+            for pipe in pipes:
+                self._changes[pipe.label] = defaultdict(set)
+                self._wakeups[pipe.label] = threading.Event()
+                self._next_sweep[pipe.label] = 0
+
+        threads = [
+            threading.Thread(
+                target=self._run_pipe,
+                args=(pipe, slots, from_date),
+                name=pipe.label,
+                daemon=True,
+            )
+            for pipe in pipes
+        ]
+        if listener is not None:
+            threads.append(
+                threading.Thread(
+                    target=listener.run,
+                    args=(self.stop_event, self.notify, self.request_sweep),
+                    name="listener",
+                    daemon=True,
+                )
+            )
+        for thread in threads:
+            thread.start()
+
+        # join с таймаутом, чтобы основной поток продолжал получать сигналы
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(timeout=1)
+
+        logging.info("All pipelines have been stopped")
+
+    def _take_changes(self, pipe: PipeEETBL) -> Dict[str, set]:
+        with self._lock:
+            self._wakeups[pipe.label].clear()
+            changes = {
+                topic: ids for topic, ids in self._changes[pipe.label].items() if ids
+            }
+            self._changes[pipe.label] = defaultdict(set)
+
+        return changes
+
+    def _run_pipe(
+        self,
+        pipe: PipeEETBL,
+        slots: threading.BoundedSemaphore,
+        from_date: Optional[str],
+    ):
+        wakeup = self._wakeups[pipe.label]
+
+        while not self.stop_event.is_set():
+            with slots:
+                try:
+                    if time.monotonic() >= self._next_sweep[pipe.label]:
+                        self._next_sweep[pipe.label] = (
+                            time.monotonic() + self.sleep_time
+                        )
+                        logging.info("Launching a new pipeline: %s", pipe.label)
+                        pipe.pump(from_date=from_date, stop_event=self.stop_event)
+                        logging.info("Pipeline data pumping completed")
+
+                    changes = self._take_changes(pipe)
+                    if changes:
+                        pipe.push(changes, stop_event=self.stop_event)
+                except Exception:
+                    logging.exception("Pipeline '%s' has failed", pipe.label)
+
+            # принудительная дата модификации применяется только при первом запуске
+            from_date = None
+
+            timeout = max(self._next_sweep[pipe.label] - time.monotonic(), 0)
+            logging.debug("Fall asleep for %d seconds ", timeout)
+            if wakeup.wait(timeout):
+                # даём уведомлениям накопиться, чтобы забрать их одной пачкой
+                self.stop_event.wait(self.coalesce_time)
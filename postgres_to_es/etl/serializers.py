@@ -0,0 +1,198 @@
+import dataclasses
+import json
+from typing import Callable, Dict, Iterable, Optional
+
+from etl.entities import (
+    ElasticSearchEnityType,
+    ElasticSearchGenre,
+    ElasticSearchMovie,
+    ElasticSearchPerson,
+)
+
+# C-реализация энкодера json без default-хука: сюда приходят только
+# словари, списки и скаляры. ensure_ascii=False - кириллица уходит в UTF-8
+# (2 байта на символ) вместо \uXXXX (6 байт)
+_encode = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+
+def _movie_to_dict(movie: ElasticSearchMovie) -> dict:
+    return {
+        "id": movie.id,
+        "title": movie.title,
+        "type": movie.type,
+        "modified": movie.modified,
+        "description": movie.description,
+        "imdb_rating": movie.imdb_rating,
+        "genres": [{"id": item.id, "name": item.name} for item in movie.genres],
+        "actors": [{"id": item.id, "name": item.name} for item in movie.actors],
+        "directors": [{"id": item.id, "name": item.name} for item in movie.directors],
+        "writers": [{"id": item.id, "name": item.name} for item in movie.writers],
+        "actors_names": movie.actors_names,
+        "directors_names": movie.directors_names,
+        "writers_names": movie.writers_names,
+    }
+
+
+def _genre_to_dict(genre: ElasticSearchGenre) -> dict:
+    return {
+        "id": genre.id,
+        "name": genre.name,
+        "modified": genre.modified,
+        "movies": [
+            {"id": item.id, "title": item.title, "imdb_rating": item.imdb_rating}
+            for item in genre.movies
+        ],
+    }
+
+
+def _person_to_dict(person: ElasticSearchPerson) -> dict:
+    return {
+        "id": person.id,
+        "full_name": person.full_name,
+        "modified": person.modified,
+        "movies": [
+            {"id": item.id, "title": item.title, "person_role": item.person_role}
+            for item in person.movies
+        ],
+    }
+
+
+# отображение документов ES в словари без dataclasses.asdict, который
+# рекурсивно копирует каждый вложенный объект
+TO_DICT: Dict[type, Callable[[ElasticSearchEnityType], dict]] = {
+    ElasticSearchMovie: _movie_to_dict,
+    ElasticSearchGenre: _genre_to_dict,
+    ElasticSearchPerson: _person_to_dict,
+}
+
+
+# painless-скрипт частичного обновления документа: скалярные поля
+# заменяются целиком, во вложенных списках объектов (фильмы жанра, актёры
+# фильма) удаляются и добавляются только изменившиеся элементы по id
+UPDATE_SCRIPT = (
+    "for (entry in params.doc.entrySet()) {"
+    " ctx._source[entry.getKey()] = entry.getValue(); "
+    "}"
+    "for (entry in params.lists.entrySet()) {"
+    " def items = ctx._source[entry.getKey()];"
+    " if (items == null) {"
+    " items = new ArrayList(); ctx._source[entry.getKey()] = items; "
+    "}"
+    " def changed = new HashSet(entry.getValue()['remove']);"
+    " for (item in entry.getValue()['upsert']) { changed.add(item['id']); }"
+    " items.removeIf(item -> changed.contains(item['id']));"
+    " items.addAll(entry.getValue()['upsert']); "
+    "}"
+)
+
+
+def _is_nested_list(value) -> bool:
+    """Список вложенных объектов с id (пустой список тоже подходит)"""
+    return isinstance(value, list) and all(
+        isinstance(item, dict) and "id" in item for item in value
+    )
+
+
+def diff_document(old: dict, new: dict) -> Optional[dict]:
+    """
+    Тело update-действия, превращающее проиндексированный документ old в new,
+    или None, если документ не изменился
+    """
+    doc, lists = {}, {}
+    for field, value in new.items():
+        old_value = old.get(field)
+        if value == old_value:
+            continue
+
+        if _is_nested_list(value) and _is_nested_list(old_value):
+            old_items = {item["id"]: item for item in old_value}
+            new_ids = {item["id"] for item in value}
+            upsert = [item for item in value if old_items.get(item["id"]) != item]
+            remove = [item_id for item_id in old_items if item_id not in new_ids]
+            # те же элементы в другом порядке (UPDATE_SCRIPT дописывает
+            # изменённые в конец) - документ не изменился
+            if upsert or remove:
+                lists[field] = {"upsert": upsert, "remove": remove}
+        else:
+            doc[field] = value
+
+    if not lists:
+        return {"doc": doc} if doc else None
+
+    return {
+        "script": {
+            "source": UPDATE_SCRIPT,
+            "lang": "painless",
+            "params": {"doc": doc, "lists": lists},
+        }
+    }
+
+
+class BulkSerializer:
+    """
+    Сериализатор документов в строки bulk-запроса Elasticsearch (NDJSON).
+    Строка действия собирается из заранее подготовленных байтов, документ
+    кодируется C-энкодером json напрямую из полей объекта
+    """
+
+    def __init__(self, index_name: str):
+        index_name = _encode(index_name).encode("utf-8")
+        self._action_prefix = b'{"index":{"_index":%s,"_id":' % index_name
+        self._update_prefix = b'{"update":{"_index":%s,"_id":' % index_name
+
+    @staticmethod
+    def to_dict(record: ElasticSearchEnityType) -> dict:
+        """Документ ES в виде словаря"""
+        # для остальных типов - медленный путь с глубоким копированием
+        return TO_DICT.get(type(record), dataclasses.asdict)(record)
+
+    def __call__(self, record: ElasticSearchEnityType) -> bytes:
+        """Строки действия и документа для одного объекта"""
+        return b"".join(
+            (
+                self._action_prefix,
+                _encode(record.id).encode("utf-8"),
+                b"}}\n",
+                _encode(self.to_dict(record)).encode("utf-8"),
+                b"\n",
+            )
+        )
+
+    def update(
+        self,
+        record: ElasticSearchEnityType,
+        source: Optional[dict],
+        document: Optional[dict] = None,
+    ) -> Optional[bytes]:
+        """
+        Строки update-действия только с изменениями относительно
+        проиндексированного документа source. Если документа в индексе ещё
+        нет - полный index, если ничего не изменилось - None.
+        document - уже построенный to_dict(record), если есть
+        """
+        if source is None:
+            return self(record)
+
+        if document is None:
+            document = self.to_dict(record)
+        body = diff_document(source, document)
+        if body is None:
+            return None
+
+        return b"".join(
+            (
+                self._update_prefix,
+                _encode(record.id).encode("utf-8"),
+                b"}}\n",
+                _encode(body).encode("utf-8"),
+                b"\n",
+            )
+        )
+
+    def dump(self, records: Iterable[ElasticSearchEnityType]) -> bytes:
+        """Тело bulk-запроса для всех объектов"""
+        body = bytearray()
+        for record in records:
+            body += self(record)
+
+        return bytes(body)
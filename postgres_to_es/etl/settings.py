@@ -1,9 +1,59 @@
+from typing import Optional
+
 import pydantic
 
 
 class Settings(pydantic.BaseSettings):
     start_date: str = "2000-01-01 00:00:00"
     sleep_time: int = 20  # sec
+    pipes_max_parallel: int = 3  # сколько Пайплайнов качают данные одновременно
+    es_bulk_max_bytes: int = 10 * 1024 * 1024  # максимальный размер пачки загрузки
+    es_bulk_max_age: Optional[float] = None  # sec, максимальный возраст пачки
+    es_bulk_chunks: int = 1  # на сколько _bulk запросов делится пачка загрузки
+    es_max_in_flight: int = 1  # сколько _bulk запросов выполняются одновременно
+    es_pool_size: int = 10  # keep-alive соединений с ES на один Загрузчик
+    es_connect_timeout: float = 5  # sec
+    es_read_timeout: float = 60  # sec
+    es_compress: bool = False  # сжимать тело _bulk запросов gzip
+    es_partial_updates: bool = False  # update только изменившихся полей
+    # кеш хешей загруженных документов (SQLite), None - не использовать.
+    # Индекс, пересозданный в обход ETL, требует перезапуска процесса
+    es_hash_cache_path: Optional[str] = None
+    # повторы документов, отклонённых ES из-за перегрузки (429, 503)
+    es_retry_attempts: int = 5
+    es_retry_start_sleep: float = 0.5  # sec
+    es_retry_border_sleep: float = 30  # sec
+    # документы, которые ES отверг окончательно (NDJSON), None - останавливать
+    # загрузку на таких документах
+    es_dead_letters_path: Optional[str] = "./logs/dead_letters.ndjson"
+    pg_itersize: int = 5000  # строк за одно обращение к server-side курсору
+    # общий пул соединений с PG (etl.db): размер, ожидание свободного
+    # соединения и простой, после которого соединение проверяется SELECT 1
+    pg_pool_size: int = 10
+    pg_pool_timeout: float = 30  # sec
+    pg_pool_check_interval: float = 30  # sec
+    # канал уведомлений триггеров pg_triggers/etl_notify.sql (режим --listen)
+    pg_notify_channel: str = "etl_changes"
+    listen_sweep_interval: int = 300  # sec, страховочный полный проход
+    listen_coalesce_time: float = 0.5  # sec, накопление уведомлений в пачку
+    # HTTP-эндпоинт /metrics (Prometheus), None - не поднимать
+    metrics_port: Optional[int] = None
+    metrics_host: str = "127.0.0.1"
+    metrics_log_interval: Optional[int] = 60  # sec, сводка метрик в лог
+    es_indexes_path: str = "./es_indexes"  # схемы индексов (как в init_es.py)
+    # сколько прежних версий индекса оставлять после пересборки (для отката)
+    es_keep_old_indexes: int = 1
+    # процессов полной переиндексации по частям (etl.py --backfill),
+    # None - по числу ядер
+    backfill_processes: Optional[int] = None
+    # подбирать размеры пачек на ходу (etl.autotune): средние времена запроса
+    # строк объектов и _bulk запроса, к которым стремятся размеры пачек
+    autotune: bool = False
+    autotune_enrich_seconds: float = 1.0  # sec
+    autotune_load_seconds: float = 5.0  # sec
+    # сколько пачек Пайплайна загружаются одновременно (etl.py --asyncio)
+    aio_in_flight_batches: int = 2
+    movies_fan_out: bool = True  # обновлять фильмы при изменении персон и жанров
 
 
 settings = Settings()
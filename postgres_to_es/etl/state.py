@@ -1,6 +1,11 @@
 import abc
+import fcntl
 import json
-import os.path
+import os
+import tempfile
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
 from typing import Any, Optional
 
 
@@ -16,15 +21,75 @@ class BaseStorage:
         pass
 
 
+class MemoryStorage(BaseStorage):
+    """Хранилище в памяти процесса (временное состояние, тесты)"""
+
+    def __init__(self):
+        self.data = {}
+
+    def save_state(self, state: dict) -> None:
+        self.data.update(state)
+
+    def retrieve_state(self) -> dict:
+        return dict(self.data)
+
+
+# блокировки файлов состояния: несколько Пайплайнов в разных потоках
+# хранят своё состояние в одном файле и не должны затирать чужие изменения
+_file_locks = defaultdict(threading.Lock)
+_file_locks_guard = threading.Lock()
+
+
+def _get_file_lock(file_path: str) -> threading.Lock:
+    with _file_locks_guard:
+        return _file_locks[os.path.abspath(file_path)]
+
+
+@contextmanager
+def _process_lock(file_path: str):
+    """
+    Блокировка файла состояния между процессами: процессы etl.backfill пишут
+    состояние своих частей в один файл. Сам файл при записи подменяется
+    (rename), поэтому flock берётся на его директорию
+    """
+    fd = os.open(os.path.dirname(os.path.abspath(file_path)), os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
 class JsonFileStorage(BaseStorage):
     def __init__(self, file_path: Optional[str] = "./file_storage.json"):
         self.file_path = file_path
 
     def save_state(self, state: dict) -> None:
+        with _get_file_lock(str(self.file_path)), _process_lock(str(self.file_path)):
+            self._save_state(state)
+
+    def _save_state(self, state: dict) -> None:
         old_state = self.retrieve_state()
         new_state = {**old_state, **state}
-        with open(str(self.file_path), "w") as outfile:
-            json.dump(new_state, outfile)
+
+        # атомарная запись: временный файл в той же директории + fsync + rename.
+        # При падении процесса на диске остаётся либо старый, либо новый файл
+        # целиком, но никогда не обрезанный
+        file_path = str(self.file_path)
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(file_path)),
+            prefix=os.path.basename(file_path) + ".",
+            suffix=".tmp",
+        )
+        try:
+            with os.fdopen(fd, "w") as outfile:
+                json.dump(new_state, outfile)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
 
         return
 
@@ -64,3 +129,65 @@ class State:
             key = self.key_prefix + key
 
         return res.get(key, None)
+
+    def checkpoint(self) -> None:
+        """
+        Зафиксировать состояние в постоянном хранилище. State пишет каждое
+        изменение сразу, поэтому здесь делать нечего
+        """
+        pass
+
+
+class CachedState(State):
+    """
+    State с кешированием в памяти. Хранилище читается один раз при создании
+    объекта, изменения копятся в памяти и сбрасываются в хранилище только
+    в контрольных точках (checkpoint), которые Пайплайн ставит после того,
+    как Приёмник подтвердил загрузку пачки. Записи по таймеру нет: между
+    контрольными точками меняются только позиции прочитанных, но ещё
+    не загруженных данных, и сохранять их раньше времени незачем
+    """
+
+    def __init__(self, storage: BaseStorage, key_prefix: str):
+        super().__init__(storage, key_prefix)
+        self._cache = storage.retrieve_state()
+        self._dirty = {}
+        # стадии конвейерного Пайплайна меняют состояние из разных потоков
+        self._lock = threading.Lock()
+        # запись в хранилище - по одной: иначе снимок, взятый раньше, может
+        # оказаться записанным позже и откатить состояние назад
+        self._flush_lock = threading.Lock()
+
+    def set_state(self, key: str, value: Any) -> None:
+        """Установить состояние для определённого ключа"""
+        if self.key_prefix:
+            key = self.key_prefix + key
+
+        with self._lock:
+            self._cache[key] = value
+            self._dirty[key] = value
+
+    def get_state(self, key: str) -> Any:
+        """Получить состояние по определённому ключу"""
+        if self.key_prefix:
+            key = self.key_prefix + key
+
+        return self._cache.get(key, None)
+
+    def checkpoint(self) -> None:
+        """Сбросить накопленные изменения в постоянное хранилище"""
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, {}
+
+            if not dirty:
+                return
+
+            try:
+                self.storage.save_state(dirty)
+            except Exception:
+                # не теряем изменения - они будут записаны следующей
+                # контрольной точкой
+                with self._lock:
+                    self._dirty = {**dirty, **self._dirty}
+                raise
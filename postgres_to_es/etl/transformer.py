@@ -1,4 +1,13 @@
-from etl.entities import ElasticSearchGenre, ElasticSearchMovie, ElasticSearchPerson
+import itertools
+import operator
+from typing import Iterable, Iterator
+
+from etl.entities import (
+    NAMED_COLUMNS,
+    ElasticSearchGenre,
+    ElasticSearchMovie,
+    ElasticSearchPerson,
+)
 
 
 class ETLTransformer:
@@ -8,47 +17,93 @@ class ETLTransformer:
     def transform(self, db_raw_data: list):
         return db_raw_data
 
+    def iter_transform(self, db_raw_data: Iterable) -> Iterator:
+        """
+        Ленивый вариант transform: объекты отдаются по одному, по мере
+        чтения строк (etl.extractor.RowsStream)
+        """
+        return iter(self.transform(list(db_raw_data)))
 
-class PGtoESMoviesTransformer(ETLTransformer):
-    def transform(self, db_raw_data: list):
-        # схлопываем развёрнутые после джойнов строки sql в объекты dataclasses
-        db_rows_by_movie_ids = {}
-        for item in db_raw_data:
-            db_rows_by_movie_ids.setdefault(item[self.source_unique_key], [])
-            db_rows_by_movie_ids[item[self.source_unique_key]].append(item)
+    @staticmethod
+    def get_columns(db_raw_data: Iterable) -> dict:
+        """
+        Индексы колонок строк: кортежи etl.extractor.Rows читаются по номерам
+        колонок, определённым один раз на запрос, прочие строки - по именам
+        """
+        return getattr(db_raw_data, "columns", NAMED_COLUMNS)
 
-        unique_objects = list()
-        for db_rows in db_rows_by_movie_ids.values():
-            unique_objects.append(ElasticSearchMovie.init_by_db_rows(list(db_rows)))
 
-        return unique_objects
+class JoinedRowsTransformer(ETLTransformer):
+    """
+    Схлопывает развёрнутые после джойнов строки sql в объекты entity:
+    несколько строк с одинаковым source_unique_key - один объект
+    """
 
+    entity = None
 
-class PGtoESGenresTransformer(ETLTransformer):
     def transform(self, db_raw_data: list):
-        # схлопываем развёрнутые после джойнов строки sql в объекты dataclasses
-        db_rows_by_genre_ids = {}
-        for item in db_raw_data:
-            db_rows_by_genre_ids.setdefault(item[self.source_unique_key], [])
-            db_rows_by_genre_ids[item[self.source_unique_key]].append(item)
+        columns = self.get_columns(db_raw_data)
+        key_index = columns[self.source_unique_key]
+
+        db_rows_by_ids = {}
+        for row in db_raw_data:
+            rows = db_rows_by_ids.get(row[key_index])
+            if rows is None:
+                db_rows_by_ids[row[key_index]] = [row]
+            else:
+                rows.append(row)
+
+        return [
+            self.entity.init_by_db_rows(db_rows, columns)
+            for db_rows in db_rows_by_ids.values()
+        ]
+
+    def iter_transform(self, db_raw_data: Iterable) -> Iterator:
+        """
+        Строки должны быть упорядочены по source_unique_key (ORDER BY в
+        data_by_ids_sql Экстрактора): объект отдаётся, как только
+        закончились его строки. В памяти - строки одного объекта
+        """
+        columns = self.get_columns(db_raw_data)
+        key = operator.itemgetter(columns[self.source_unique_key])
 
-        unique_objects = list()
-        for db_rows in db_rows_by_genre_ids.values():
-            unique_objects.append(ElasticSearchGenre.init_by_db_rows(list(db_rows)))
+        for _, db_rows in itertools.groupby(db_raw_data, key=key):
+            yield self.entity.init_by_db_rows(list(db_rows), columns)
 
-        return unique_objects
 
+class AggregatedRowTransformer(ETLTransformer):
+    """Одна строка sql - один объект entity, схлопывать нечего"""
+
+    entity = None
 
-class PGtoESPersonsTransformer(ETLTransformer):
     def transform(self, db_raw_data: list):
-        # схлопываем развёрнутые после джойнов строки sql в объекты dataclasses
-        db_rows_by_genre_ids = {}
-        for item in db_raw_data:
-            db_rows_by_genre_ids.setdefault(item[self.source_unique_key], [])
-            db_rows_by_genre_ids[item[self.source_unique_key]].append(item)
+        return list(self.iter_transform(db_raw_data))
+
+    def iter_transform(self, db_raw_data: Iterable) -> Iterator:
+        columns = self.get_columns(db_raw_data)
+        for row in db_raw_data:
+            yield self.entity.init_by_aggregated_row(row, columns)
+
+
+class PGtoESMoviesTransformer(JoinedRowsTransformer):
+    entity = ElasticSearchMovie
+
+
+class PGtoESGenresTransformer(JoinedRowsTransformer):
+    entity = ElasticSearchGenre
+
+
+class PGtoESPersonsTransformer(JoinedRowsTransformer):
+    entity = ElasticSearchPerson
+
+
+class PGtoESMoviesAggregatedTransformer(AggregatedRowTransformer):
+    entity = ElasticSearchMovie
+
+
+class PGtoESGenresAggregatedTransformer(AggregatedRowTransformer):
+    entity = ElasticSearchGenre
 
-        unique_objects = list()
-        for db_rows in db_rows_by_genre_ids.values():
-            unique_objects.append(ElasticSearchPerson.init_by_db_rows(list(db_rows)))
 
-        return unique_objects
+class PGtoESPersonsAggregatedTransformer(AggregatedRowTransformer):
+    entity = ElasticSearchPerson
@@ -0,0 +1,43 @@
+import argparse
+import logging
+import os
+
+import psycopg2
+
+from etl.db import get_pg_dns
+from etl.settings import settings
+
+parser = argparse.ArgumentParser(
+    prog="init_pg",
+    description="The script creates ETL objects (keyset pagination indexes, "
+    "change notification triggers) in PostgreSQL",
+    allow_abbrev=False,
+)
+parser.add_argument(
+    "--triggers_path",
+    type=str,
+    help="The path to the system folder with SQL scripts. "
+    "Scripts are executed in the order of file names",
+    default="./pg_triggers",
+)
+parser.add_argument(
+    "--channel",
+    type=str,
+    help="The change notification channel (%%(channel)s in the scripts)",
+    default=settings.pg_notify_channel,
+)
+args = parser.parse_args()
+
+logging.basicConfig(filename="logs/init_pg.log", level=logging.INFO)
+
+files = sorted(
+    os.path.join(args.triggers_path, f)
+    for f in os.listdir(args.triggers_path)
+    if f.endswith(".sql")
+)
+with psycopg2.connect(**get_pg_dns()) as conn, conn.cursor() as cursor:
+    for path in files:
+        logging.info('Executing "{}"...'.format(path))
+        with open(path) as file:
+            cursor.execute(file.read(), {"channel": args.channel})
+        logging.info("Done")
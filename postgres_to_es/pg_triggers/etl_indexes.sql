@@ -0,0 +1,14 @@
+-- Индексы постраничного чтения ETL (etl/extractor.py): страница изменённых
+-- объектов и связанных сущностей выбирается условием
+-- (modified, id) > ($1, $2) ORDER BY modified, id LIMIT $3. С составным
+-- индексом это сканирование диапазона индекса с первой строки страницы -
+-- стоимость страницы не зависит от того, сколько строк уже прочитано
+
+CREATE INDEX IF NOT EXISTS movies_modified_id_idx
+    ON content.movies (modified, id);
+
+CREATE INDEX IF NOT EXISTS persons_modified_id_idx
+    ON content.persons (modified, id);
+
+CREATE INDEX IF NOT EXISTS genres_modified_id_idx
+    ON content.genres (modified, id);
@@ -0,0 +1,62 @@
+-- Уведомления ETL об изменениях данных (LISTEN/NOTIFY, см. etl/listener.py).
+-- Сообщение в канал PG_NOTIFY_CHANNEL (init_pg.py подставляет его
+-- в параметр channel): "<тема>:<id>".
+--   - movies, persons, genres - изменилась сама сущность. Её документ
+--     переиндексируется, а изменения персон и жанров ещё и распространяются
+--     на фильмы, в которые они вложены
+--   - movies.links, persons.links, genres.links - изменились связи объекта
+--     (таблицы movie_person_role, movie_genre). Переиндексируется только
+--     документ этого объекта: изменение связи касается одного фильма
+--     и одной персоны (жанра), а не всех фильмов персоны
+
+CREATE OR REPLACE FUNCTION content.etl_notify() RETURNS trigger AS $$
+DECLARE
+    row_data jsonb;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        row_data := to_jsonb(OLD);
+    ELSE
+        row_data := to_jsonb(NEW);
+    END IF;
+
+    -- TG_ARGV[0] - канал, TG_ARGV[1] - тема, TG_ARGV[2] - колонка с id объекта
+    PERFORM pg_notify(TG_ARGV[0], TG_ARGV[1] || ':' || (row_data ->> TG_ARGV[2]));
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS etl_notify ON content.movies;
+CREATE TRIGGER etl_notify
+    AFTER INSERT OR UPDATE ON content.movies
+    FOR EACH ROW EXECUTE FUNCTION content.etl_notify(%(channel)s, 'movies', 'id');
+
+DROP TRIGGER IF EXISTS etl_notify ON content.persons;
+CREATE TRIGGER etl_notify
+    AFTER INSERT OR UPDATE ON content.persons
+    FOR EACH ROW EXECUTE FUNCTION content.etl_notify(%(channel)s, 'persons', 'id');
+
+DROP TRIGGER IF EXISTS etl_notify ON content.genres;
+CREATE TRIGGER etl_notify
+    AFTER INSERT OR UPDATE ON content.genres
+    FOR EACH ROW EXECUTE FUNCTION content.etl_notify(%(channel)s, 'genres', 'id');
+
+DROP TRIGGER IF EXISTS etl_notify_movies ON content.movie_person_role;
+CREATE TRIGGER etl_notify_movies
+    AFTER INSERT OR UPDATE OR DELETE ON content.movie_person_role
+    FOR EACH ROW EXECUTE FUNCTION content.etl_notify(%(channel)s, 'movies.links', 'movie_id');
+
+DROP TRIGGER IF EXISTS etl_notify_persons ON content.movie_person_role;
+CREATE TRIGGER etl_notify_persons
+    AFTER INSERT OR UPDATE OR DELETE ON content.movie_person_role
+    FOR EACH ROW EXECUTE FUNCTION content.etl_notify(%(channel)s, 'persons.links', 'person_id');
+
+DROP TRIGGER IF EXISTS etl_notify_movies ON content.movie_genre;
+CREATE TRIGGER etl_notify_movies
+    AFTER INSERT OR UPDATE OR DELETE ON content.movie_genre
+    FOR EACH ROW EXECUTE FUNCTION content.etl_notify(%(channel)s, 'movies.links', 'movie_id');
+
+DROP TRIGGER IF EXISTS etl_notify_genres ON content.movie_genre;
+CREATE TRIGGER etl_notify_genres
+    AFTER INSERT OR UPDATE OR DELETE ON content.movie_genre
+    FOR EACH ROW EXECUTE FUNCTION content.etl_notify(%(channel)s, 'genres.links', 'genre_id');
@@ -0,0 +1,149 @@
+import asyncio
+import os
+from datetime import datetime
+from types import SimpleNamespace
+
+from benchmarks import fakes
+from etl.aio import AsyncESLoader, AsyncPipeEETBL
+from etl.entities import Genre
+from etl.pipes import PipeEETBL
+from etl.state import MemoryStorage, State
+from etl.transformer import ETLTransformer
+
+FROM_DATE = "2000-01-01 00:00:00.000000"
+ROWS = [("id-%02d" % i, datetime(2021, 1, 1 + i % 4)) for i in range(20)]
+
+
+class AsyncFakeExtractor:
+    def __init__(self, rows):
+        # [(<id>, <modified>), ...]
+        self.rows = sorted(rows, key=lambda row: (row[1], row[0]))
+
+    async def get_modified_ids(self, modified, last_id, limit):
+        await asyncio.sleep(0)
+        key = (datetime.fromisoformat(modified), last_id or "")
+        return [row for row in self.rows if (row[1], row[0]) > key][:limit]
+
+    async def get_data_by_ids(self, ids):
+        await asyncio.sleep(0)
+        return [
+            SimpleNamespace(id=row[0], modified=row[1].strftime("%Y-%m-%d %H:%M:%S.%f"))
+            for row in self.rows
+            if row[0] in ids
+        ]
+
+
+class AsyncFakeLoader:
+    def __init__(self, state, fail_on=None):
+        self.state = state
+        self.fail_on = fail_on
+        self.loaded = []
+        self.started = 0
+        self.loading = 0
+        self.max_loading = 0
+        # точка восстановления на момент каждой фиксации
+        self.checkpoints = []
+
+    async def load_to_es(self, records):
+        self.started += 1
+        self.loading += 1
+        self.max_loading = max(self.max_loading, self.loading)
+        # нечётные пачки загружаются дольше следующих за ними
+        await asyncio.sleep(0.02 if self.started % 2 else 0.001)
+        self.loading -= 1
+        self.loaded.extend(record.id for record in records)
+        return all(record.id != self.fail_on for record in records)
+
+    def commit(self):
+        self.checkpoints.append(
+            (self.state.get_state("loader.modified"), self.state.get_state("loader.id"))
+        )
+
+
+def make_pipe(fail_on=None, in_flight=2):
+    state = State(MemoryStorage(), key_prefix="test.")
+    extractor = AsyncFakeExtractor(ROWS)
+    loader = AsyncFakeLoader(state, fail_on=fail_on)
+    pipe = PipeEETBL(
+        label="test",
+        extractor=extractor,
+        loader=loader,
+        transformer=ETLTransformer(source_unique_key="id"),
+        states_keeper=state,
+        extractor_batch_size=3,
+        loader_batch_size=4,
+    )
+    return (
+        AsyncPipeEETBL(pipe, extractor=extractor, loader=loader, in_flight=in_flight),
+        loader,
+        state,
+    )
+
+
+def test_batches_are_loaded_concurrently_and_checkpointed_in_order():
+    pipe, loader, state = make_pipe()
+
+    assert asyncio.run(pipe.pump(from_date=FROM_DATE))
+
+    assert sorted(loader.loaded) == sorted(row[0] for row in ROWS)
+    assert loader.max_loading == 2
+    # пачки завершаются не по порядку, а точка восстановления - по порядку
+    assert len(loader.checkpoints) == 4
+    assert loader.checkpoints == sorted(loader.checkpoints)
+    assert state.get_state("loader.id") == "id-19"
+
+
+def test_failed_batch_stops_pump_without_moving_checkpoint():
+    pipe, loader, state = make_pipe(fail_on="id-14")
+
+    assert not asyncio.run(pipe.pump(from_date=FROM_DATE))
+
+    # "id-14" - в третьей пачке: точка восстановления - конец второй
+    assert [checkpoint[1] for checkpoint in loader.checkpoints] == ["id-01", "id-06"]
+    assert state.get_state("loader.id") == "id-06"
+
+    # следующий запуск догружает всё после точки восстановления,
+    # в том числе пачки, прочитанные до сбоя
+    loader.fail_on = None
+    assert asyncio.run(pipe.pump(from_date=None))
+
+    assert set(loader.loaded) == {row[0] for row in ROWS}
+    assert state.get_state("loader.id") == "id-19"
+
+
+def test_buffer_flushes_by_age_while_extract_waits():
+    pipe, loader, _ = make_pipe()
+    pipe.pipe.get_loader_batch_size = lambda: 100
+    pipe.pipe.loader_batch_max_age = 0.05
+    get_modified_ids = pipe.extractor.get_modified_ids
+
+    async def slow_get_modified_ids(modified, last_id, limit):
+        # следующий запрос к PG "висит", пока не загрузится неполная пачка
+        while last_id and not loader.loaded:
+            await asyncio.sleep(0.01)
+        return await get_modified_ids(modified, last_id, limit)
+
+    pipe.extractor.get_modified_ids = slow_get_modified_ids
+
+    assert asyncio.run(asyncio.wait_for(pipe.pump(from_date=FROM_DATE), 5))
+
+    assert len(loader.loaded) == len(ROWS)
+    assert loader.checkpoints[0][1] == "id-08"
+
+
+def test_async_loader_sends_chunks_to_bulk(monkeypatch):
+    documents = [Genre(id=f"genre_{i}", name=f"жанр {i}") for i in range(5)]
+
+    async def load():
+        loader = AsyncESLoader(index_name="genres", bulk_chunks=2, compress=True)
+        try:
+            return await loader.load_to_es(documents)
+        finally:
+            await loader.close()
+
+    with fakes.BulkServer() as server:
+        monkeypatch.setitem(os.environ, "ELASTICSEARCH_URL", server.url)
+        assert asyncio.run(load())
+
+    assert server.requests == 2
+    assert server.documents == 5
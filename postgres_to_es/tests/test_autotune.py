@@ -0,0 +1,77 @@
+from types import SimpleNamespace
+
+from etl import metrics
+from etl.autotune import BatchSizeTuner
+
+
+def observe(label, enrich=None, load=None):
+    if enrich is not None:
+        metrics.STAGE_SECONDS.observe(enrich, pipe=label, stage="enrich")
+    if load is not None:
+        metrics.STAGE_SECONDS.observe(load, pipe=label, stage="load")
+
+
+def make_tuner(label):
+    return BatchSizeTuner(
+        label,
+        SimpleNamespace(index_name=f"{label}_index"),
+        extractor_batch_size=100,
+        loader_batch_size=1000,
+        extractor_bounds=(10, 130),
+        loader_bounds=(100, 5000),
+        enrich_seconds=1.0,
+        load_seconds=5.0,
+    )
+
+
+def test_batch_sizes_grow_additively_up_to_bounds():
+    tuner = make_tuner("autotune_grow")
+
+    for _ in range(5):
+        observe("autotune_grow", enrich=0.1, load=0.5)
+        tuner.update()
+
+    assert tuner.extractor_batch_size == 130
+    assert tuner.loader_batch_size == 1500
+    assert metrics.TUNED_BATCH_SIZE.value(pipe="autotune_grow", stage="load") == 1500
+
+
+def test_slow_stage_shrinks_only_its_batch():
+    tuner = make_tuner("autotune_slow")
+
+    observe("autotune_slow", enrich=3, load=1)
+    tuner.update()
+    assert (tuner.extractor_batch_size, tuner.loader_batch_size) == (50, 1100)
+
+    # без новых замеров размеры не меняются
+    tuner.update()
+    assert (tuner.extractor_batch_size, tuner.loader_batch_size) == (50, 1100)
+
+    observe("autotune_slow", enrich=0.5, load=8)
+    tuner.update()
+    assert (tuner.extractor_batch_size, tuner.loader_batch_size) == (60, 550)
+
+
+def test_es_rejections_shrink_loader_batch_down_to_bound():
+    tuner = make_tuner("autotune_rejected")
+
+    for _ in range(5):
+        observe("autotune_rejected", load=0.5)
+        metrics.ES_REJECTIONS.inc(3, index="autotune_rejected_index")
+        tuner.update()
+
+    assert tuner.loader_batch_size == 100
+    assert tuner.extractor_batch_size == 100
+
+
+def test_rejections_are_counted_for_the_index_the_loader_switched_to():
+    tuner = make_tuner("autotune_switched")
+
+    # пересборка переключила Загрузчик на новую версию индекса
+    tuner.loader.index_name = "autotune_switched_v2"
+    metrics.ES_REJECTIONS.inc(1, index="autotune_switched_v2")
+    tuner.update()
+    assert tuner.loader_batch_size == 500
+
+    tuner.update()
+    assert tuner.loader_batch_size == 500
@@ -0,0 +1,178 @@
+import functools
+import multiprocessing
+import os
+from datetime import datetime
+
+import pytest
+
+from etl.backfill import PLAN_KEY, backfill, partition_state, plan_partitions
+from etl.pipes import PipeEETBL
+from etl.state import CachedState, JsonFileStorage
+from etl.transformer import ETLTransformer
+
+# 3 записи с одинаковым modified - границы частей идут по паре (modified, id)
+ROWS = [("id-%02d" % i, datetime(2021, 1, 1 + i // 3)) for i in range(10)]
+
+
+class FakeExtractor:
+    def __init__(self, rows):
+        # [(<id>, <modified>), ...]
+        self.rows = sorted(rows, key=lambda row: (row[1], row[0]))
+        self.until = None
+
+    def _key(self, modified, last_id):
+        return (datetime.fromisoformat(modified), last_id or "")
+
+    def get_modified_ids(self, modified, last_id, limit):
+        rows = [
+            row
+            for row in self.rows
+            if (row[1], row[0]) > self._key(modified, last_id)
+            and (self.until is None or (row[1], row[0]) <= self._key(*self.until))
+        ]
+        return rows[:limit]
+
+    def get_partition_bounds(self, modified, last_id, partitions):
+        rows = self.get_modified_ids(modified, last_id, len(self.rows))
+        # как ntile: первые len(rows) % partitions частей на строку больше
+        bounds, end = [], 0
+        for part in range(min(partitions, len(rows))):
+            end += len(rows) // partitions + (part < len(rows) % partitions)
+            bounds.append(rows[end - 1])
+        return bounds
+
+    def get_data_by_ids(self, ids):
+        return [
+            Document(row[0], row[1].strftime("%Y-%m-%d %H:%M:%S.%f"))
+            for row in self.rows
+            if row[0] in ids
+        ]
+
+
+class Document:
+    def __init__(self, id, modified):
+        self.id = id
+        self.modified = modified
+
+
+class FileLoader:
+    """Загрузчик, который пишет id в файл: части работают в разных процессах"""
+
+    def __init__(self, path, fail_on=None):
+        self.path = path
+        self.fail_on = fail_on
+
+    def load_to_es(self, records):
+        if any(record.id == self.fail_on for record in records):
+            raise RuntimeError("bulk failed")
+        with open(self.path, "a") as file:
+            file.writelines(f"{record.id}\n" for record in records)
+        return True
+
+
+def make_configs(tmp_path, fail_on=None) -> list:
+    # по строке на каждую сборку Пайплайнов, в том числе в исполнителях
+    with open(tmp_path / "factory_calls.txt", "a") as file:
+        file.write(f"{os.getpid()}\n")
+
+    return [
+        {
+            "label": "test",
+            "extractor": FakeExtractor(ROWS),
+            "loader": FileLoader(str(tmp_path / "loaded.txt"), fail_on=fail_on),
+            "transformer": ETLTransformer(source_unique_key="id"),
+            "states_keeper": CachedState(
+                JsonFileStorage(str(tmp_path / "state.json")), key_prefix="test."
+            ),
+            "extractor_batch_size": 2,
+            "loader_batch_size": 2,
+        }
+    ]
+
+
+def loaded_ids(tmp_path) -> list:
+    path = tmp_path / "loaded.txt"
+    return sorted(path.read_text().split()) if path.exists() else []
+
+
+def run_backfill(tmp_path, fail_on=None, processes=2):
+    pipes_factory = functools.partial(make_configs, tmp_path, fail_on=fail_on)
+    pipes = [PipeEETBL(**config) for config in pipes_factory()]
+    finished = backfill(
+        pipes,
+        pipes_factory,
+        partitions=3,
+        processes=processes,
+        mp_context=multiprocessing.get_context("fork"),
+    )
+    return finished, pipes[0]
+
+
+def test_plan_splits_table_by_modified_and_id(tmp_path):
+    pipe = PipeEETBL(**make_configs(tmp_path)[0])
+
+    plan = plan_partitions(pipe, 3)
+
+    assert [part[3] for part in plan] == ["id-03", "id-06", "id-09"]
+    # следующая часть начинается строго после верхней границы предыдущей
+    assert plan[1][:2] == plan[0][2:]
+    assert partition_state(pipe.states_keeper, 2).get_state("extractor.id") == "id-06"
+    # незавершённый план переживает перезапуск
+    assert plan_partitions(PipeEETBL(**make_configs(tmp_path)[0]), 5) == plan
+
+
+@pytest.mark.skipif(
+    "fork" not in multiprocessing.get_all_start_methods(), reason="needs fork"
+)
+def test_backfill_loads_every_partition_and_resumes_unfinished(tmp_path):
+    pipe = PipeEETBL(**make_configs(tmp_path)[0])
+    plan = plan_partitions(pipe, 3)
+    # вторая часть уже перекачана до падения
+    done_partition = partition_state(pipe.states_keeper, 1)
+    done_partition.set_state("done", True)
+    done_partition.checkpoint()
+
+    # один исполнитель перекачивает обе оставшиеся части
+    finished, pipe = run_backfill(tmp_path, processes=1)
+
+    assert finished
+    assert loaded_ids(tmp_path) == [
+        "id-00",
+        "id-01",
+        "id-02",
+        "id-03",
+        "id-07",
+        "id-08",
+        "id-09",
+    ]
+    # обычный Пайплайн продолжает с конца последней части
+    state = CachedState(JsonFileStorage(str(tmp_path / "state.json")), "test.")
+    assert state.get_state("loader.id") == "id-09"
+    assert state.get_state("extractor.modified") == plan[-1][2]
+    assert state.get_state(PLAN_KEY) is None
+    # Пайплайны собираются один раз на процесс, а не на каждую часть
+    pids = (tmp_path / "factory_calls.txt").read_text().split()
+    workers = [pid for pid in pids if pid != str(os.getpid())]
+    assert workers and len(workers) == len(set(workers))
+
+
+@pytest.mark.skipif(
+    "fork" not in multiprocessing.get_all_start_methods(), reason="needs fork"
+)
+def test_failed_backfill_keeps_plan_until_all_partitions_are_loaded(tmp_path):
+    with pytest.raises(RuntimeError):
+        run_backfill(tmp_path, fail_on="id-05")
+
+    state = CachedState(JsonFileStorage(str(tmp_path / "state.json")), "test.")
+    plan = state.get_state(PLAN_KEY)
+    assert len(plan) == 3
+    assert not partition_state(state, 1).get_state("done")
+    assert state.get_state("loader.id") is None
+
+    finished, _ = run_backfill(tmp_path)
+
+    assert finished
+    assert set(loaded_ids(tmp_path)) == {row[0] for row in ROWS}
+    state = CachedState(JsonFileStorage(str(tmp_path / "state.json")), "test.")
+    assert state.get_state("loader.id") == "id-09"
+    assert state.get_state(PLAN_KEY) is None
@@ -1,3 +1,5 @@
+import asyncio
+
 import pytest
 
 import etl.backoff
@@ -37,3 +39,16 @@ def test_on_exception_wait_till_exception():
     # assert str(exception) == "test_func exception"
     assert len(log) > 4
     assert isinstance(log[0], ValueError)
+
+
+def test_on_exception_coroutine():
+    @etl.backoff.on_exception(border_sleep_time=1)
+    async def test_func(log):
+        if len(log) < 2:
+            log.append(ValueError())
+            raise log[-1]
+        return True
+
+    log = []
+    assert asyncio.run(test_func(log))
+    assert len(log) == 2
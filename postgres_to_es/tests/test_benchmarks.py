@@ -0,0 +1,74 @@
+import dataclasses
+import os
+
+from benchmarks import datagen, fakes
+from etl.loader import ESLoader
+from etl.transformer import (
+    PGtoESGenresAggregatedTransformer,
+    PGtoESGenresTransformer,
+    PGtoESMoviesAggregatedTransformer,
+    PGtoESMoviesTransformer,
+    PGtoESPersonsAggregatedTransformer,
+    PGtoESPersonsTransformer,
+)
+
+
+def sort_nested(documents):
+    for document in documents:
+        for item in dataclasses.fields(document):
+            value = getattr(document, item.name)
+            if isinstance(value, list):
+                value.sort(key=lambda item: getattr(item, "id", item))
+    return sorted(documents, key=lambda document: document.id)
+
+
+def test_fake_extractors_return_the_same_documents_as_aggregated():
+    dataset = datagen.generate(movies=50, persons=40, genres=5)
+
+    for extractor, aggregated_extractor, transformer, aggregated_transformer in (
+        (
+            fakes.FakeMovieExtractor,
+            fakes.FakeMovieAggregatedExtractor,
+            PGtoESMoviesTransformer(source_unique_key="movie_id"),
+            PGtoESMoviesAggregatedTransformer(source_unique_key="movie_id"),
+        ),
+        (
+            fakes.FakeGenreExtractor,
+            fakes.FakeGenreAggregatedExtractor,
+            PGtoESGenresTransformer(source_unique_key="genre_id"),
+            PGtoESGenresAggregatedTransformer(source_unique_key="genre_id"),
+        ),
+        (
+            fakes.FakePersonExtractor,
+            fakes.FakePersonAggregatedExtractor,
+            PGtoESPersonsTransformer(source_unique_key="person_id"),
+            PGtoESPersonsAggregatedTransformer(source_unique_key="person_id"),
+        ),
+    ):
+        ids = tuple(
+            row[0]
+            for row in extractor(dataset).get_modified_ids("2000-01-01", None, 1000)
+        )
+
+        documents = transformer.transform(extractor(dataset).get_data_by_ids(ids))
+        aggregated = aggregated_transformer.transform(
+            aggregated_extractor(dataset).get_data_by_ids(ids)
+        )
+
+        assert len(documents) == len(ids)
+        assert sort_nested(documents) == sort_nested(aggregated)
+
+
+def test_bulk_server_counts_loaded_documents(monkeypatch):
+    dataset = datagen.generate(movies=10, persons=10, genres=3)
+    extractor = fakes.FakeGenreAggregatedExtractor(dataset)
+    documents = PGtoESGenresAggregatedTransformer(
+        source_unique_key="genre_id"
+    ).transform(extractor.get_data_by_ids(tuple(dataset.genres)))
+
+    with fakes.BulkServer() as server:
+        monkeypatch.setitem(os.environ, "ELASTICSEARCH_URL", server.url)
+        assert ESLoader(index_name="genres", compress=True).load_to_es(documents)
+
+    assert server.requests == 1
+    assert server.documents == 3
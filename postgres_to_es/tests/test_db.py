@@ -0,0 +1,165 @@
+import threading
+
+import psycopg2
+import psycopg2.extensions
+import pytest
+
+from etl import metrics
+from etl.db import ConnectionPool, PoolTimeout, execute_inline, execute_prepared
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.connection = self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def execute(self, sql, params=None):
+        if self.conn.dead:
+            self.conn.closed = 2
+            raise psycopg2.OperationalError("server closed the connection")
+        self.conn.in_transaction = True
+        self.conn.executed.append(sql if params is None else (sql, params))
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.dead = False
+        self.in_transaction = False
+        self.rollbacks = 0
+        self.commits = 0
+        self.executed = []
+        self.prepared = set()
+
+    def cursor(self, name=None):
+        return FakeCursor(self)
+
+    def get_transaction_status(self):
+        if self.in_transaction:
+            return psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def rollback(self):
+        if self.dead:
+            raise psycopg2.InterfaceError("connection already closed")
+        self.in_transaction = False
+        self.rollbacks += 1
+
+    def commit(self):
+        self.in_transaction = False
+        self.commits += 1
+
+    def close(self):
+        self.closed = 1
+
+
+def make_pool(**kwargs):
+    connections = []
+
+    def connect(**dsn):
+        connections.append(FakeConnection())
+        return connections[-1]
+
+    return ConnectionPool({}, connect=connect, **kwargs), connections
+
+
+def test_connections_are_reused_and_transactions_finished():
+    pool, connections = make_pool(max_size=2)
+
+    with pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT 1")
+    assert conn.commits == 1 and not conn.in_transaction
+
+    with pool.connection() as same_conn:
+        assert same_conn is conn
+        with pool.connection() as other_conn:
+            assert other_conn is not conn
+
+    # соединение, взятое без connection(), возвращается без транзакции
+    conn = pool.getconn()
+    conn.cursor().execute("SELECT 1")
+    pool.putconn(conn)
+
+    assert len(connections) == 2
+    assert conn.rollbacks == 1 and not conn.in_transaction
+
+
+def test_pool_is_bounded():
+    pool, connections = make_pool(max_size=1, timeout=0.05)
+
+    conn = pool.getconn()
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
+
+    # ожидающий получает соединение, как только его вернули в пул
+    pool.timeout = 5
+    waiter = []
+    thread = threading.Thread(target=lambda: waiter.append(pool.getconn()))
+    thread.start()
+    pool.putconn(conn)
+    thread.join()
+
+    assert waiter == [conn]
+    assert len(connections) == 1
+
+
+def test_dead_connections_are_replaced():
+    pool, connections = make_pool(max_size=2, check_interval=0)
+    reconnects = metrics.PG_RECONNECTS.value()
+
+    # соединение оборвалось посреди запроса: при возврате оно закрывается
+    with pytest.raises(psycopg2.OperationalError):
+        with pool.connection() as conn, conn.cursor() as cur:
+            conn.dead = True
+            cur.execute("SELECT 1")
+    assert conn.closed
+
+    # соединение умерло, пока лежало в пуле: при выдаче оно заменяется
+    with pool.connection() as conn:
+        pass
+    conn.dead = True
+    with pool.connection() as new_conn:
+        assert new_conn is not conn and not new_conn.closed
+
+    assert len(connections) == 3
+    assert metrics.PG_RECONNECTS.value() == reconnects + 1
+
+
+def test_statements_are_prepared_once_per_connection():
+    sql = "SELECT id FROM genres WHERE id = ANY($1) AND modified > $2"
+    conn, other_conn = FakeConnection(), FakeConnection()
+
+    for ids in (["a"], ["b", "c"]):
+        execute_prepared(conn.cursor(), sql, (ids, "2021"), ("uuid[]", None))
+    execute_prepared(other_conn.cursor(), sql, (["d"], "2021"), ("uuid[]", None))
+
+    (name,) = conn.prepared
+    assert conn.executed == [
+        f"PREPARE {name} (uuid[], unknown) AS {sql}",
+        (f"EXECUTE {name} (%s::uuid[], %s)", (["a"], "2021")),
+        (f"EXECUTE {name} (%s::uuid[], %s)", (["b", "c"], "2021")),
+    ]
+    assert other_conn.executed[0] == conn.executed[0]
+
+
+def test_inline_parameters_for_server_side_cursors():
+    conn = FakeConnection()
+
+    execute_inline(
+        conn.cursor(),
+        "SELECT $2, $1 WHERE id = ANY($2)",
+        ("x", ["a"]),
+        (None, "uuid[]"),
+    )
+
+    assert conn.executed == [
+        ("SELECT %s::uuid[], %s WHERE id = ANY(%s::uuid[])", [["a"], "x", ["a"]])
+    ]
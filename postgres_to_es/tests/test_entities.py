@@ -1,7 +1,9 @@
 import logging
 from datetime import datetime
 
-from etl.entities import ElasticSearchMovie
+from etl.entities import ElasticSearchGenre, ElasticSearchMovie, ElasticSearchPerson
+from etl.extractor import Rows, RowsStream
+from etl.transformer import PGtoESMoviesTransformer
 
 logger = logging.getLogger()
 
@@ -117,3 +119,116 @@ def test_movies_init_by_db_rows_check_unique_lists():
     assert len(movie.writers_names) == 2
 
     assert len(movie.genres) == 2
+
+
+def test_movies_init_by_db_rows_without_persons_and_genres():
+    # LEFT JOIN фильма без связей: колонки персоны и жанра пустые
+    db_rows = [
+        {
+            **db_rows_movies[0],
+            "person_role": None,
+            "person_id": None,
+            "person_full_name": None,
+            "genre_id": None,
+            "genre_name": None,
+        }
+    ]
+
+    movie = ElasticSearchMovie.init_by_db_rows(db_rows)
+
+    assert movie.actors == movie.directors == movie.writers == []
+    assert movie.genres == []
+
+
+def test_movies_transformer_reads_tuple_rows_by_column_indexes():
+    dict_rows = [
+        {**db_rows_movies[0], **db_rows_actors[0], **db_rows_genres[0]},
+        {**db_rows_movies[0], **db_rows_writers[1], **db_rows_genres[1]},
+    ]
+    columns = {name: index for index, name in enumerate(dict_rows[0])}
+    tuple_rows = Rows([tuple(row.values()) for row in dict_rows], columns)
+    transformer = PGtoESMoviesTransformer(source_unique_key="movie_id")
+
+    assert transformer.transform(tuple_rows) == transformer.transform(dict_rows)
+
+    (movie,) = transformer.transform(tuple_rows)
+    assert not hasattr(movie, "__dict__")
+    assert not hasattr(movie.actors[0], "__dict__")
+
+
+def test_movies_iter_transform_emits_each_movie_when_its_rows_end():
+    second_movie = {**db_rows_movies[0], "movie_id": "test2"}
+    dict_rows = [
+        {**db_rows_movies[0], **db_rows_actors[0], **db_rows_genres[0]},
+        {**db_rows_movies[0], **db_rows_actors[1], **db_rows_genres[1]},
+        {**second_movie, **db_rows_writers[0], **db_rows_genres[0]},
+    ]
+    columns = {name: index for index, name in enumerate(dict_rows[0])}
+    consumed = []
+
+    def rows():
+        for row in dict_rows:
+            consumed.append(row["movie_id"])
+            yield tuple(row.values())
+
+    transformer = PGtoESMoviesTransformer(source_unique_key="movie_id")
+    movies = transformer.iter_transform(RowsStream(rows(), columns))
+
+    # первый фильм готов, как только началась строка второго
+    assert next(movies).id == "test1"
+    assert consumed == ["test1", "test1", "test2"]
+    assert [movie.id for movie in movies] == ["test2"]
+    assert list(
+        transformer.iter_transform(
+            Rows([tuple(row.values()) for row in dict_rows], columns)
+        )
+    ) == transformer.transform(dict_rows)
+
+
+def test_movies_init_by_aggregated_row():
+    db_row = {
+        **db_rows_movies[0],
+        "persons": {
+            "актёр": [
+                {"id": "person_test_1", "name": "Иванов Иван Иванович"},
+                {"id": "person_test_2", "name": "Петров Пётр Петрович"},
+            ],
+            # две роли БД соответствуют режиссёру
+            "режисёр": [{"id": "person_test_10", "name": "Иванов Артём Артёмович"}],
+            "директор": [{"id": "person_test_10", "name": "Иванов Артём Артёмович"}],
+        },
+        "genres": [
+            {"id": "genre_test_1", "name": "комедия"},
+            {"id": "genre_test_2", "name": "экшн"},
+        ],
+    }
+
+    movie = ElasticSearchMovie.init_by_aggregated_row(db_row)
+
+    assert movie.id == "test1"
+    assert movie.actors_names == ["Иванов Иван Иванович", "Петров Пётр Петрович"]
+    assert len(movie.directors) == 1
+    assert len(movie.writers) == 0
+    assert len(movie.genres) == 2
+
+
+def test_genres_and_persons_init_by_aggregated_row():
+    genre = ElasticSearchGenre.init_by_aggregated_row(
+        {
+            "genre_id": "genre_test_1",
+            "genre_name": "комедия",
+            "modified": datetime.now(),
+            "movies": [{"id": "test1", "title": "test", "imdb_rating": 7.7}],
+        }
+    )
+    assert genre.movies[0].imdb_rating == 7.7
+
+    person = ElasticSearchPerson.init_by_aggregated_row(
+        {
+            "person_id": "person_test_1",
+            "person_full_name": "Иванов Иван Иванович",
+            "modified": datetime.now(),
+            "movies": [{"id": "test1", "title": "test", "person_role": "актёр"}],
+        }
+    )
+    assert person.movies[0].person_role == "actor"
@@ -0,0 +1,231 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from etl.cache import DocumentHashCache
+from etl.entities import Genre
+from etl.indexes import IndexManager, RebuildInterrupted, rebuild_index
+from etl.loader import ESLoader
+from etl.state import CachedState, MemoryStorage
+
+SCHEMA = {"settings": {"refresh_interval": "1s"}, "mappings": {"properties": {}}}
+
+
+class FakeElasticsearch:
+    """Индексы и алиасы ES в памяти: ровно те запросы, что делает IndexManager"""
+
+    def __init__(self, indexes=(), aliases=None):
+        self.indexes = {name: {} for name in indexes}
+        self.aliases = dict(aliases or {})
+        self.requests = []
+
+    def request(self, method, url, params=None, json=None, timeout=None):
+        path = url.split("/", 3)[-1] if "://" in url else url
+        self.requests.append((method, path, json))
+        parts = path.split("/")
+
+        if parts[0] == "_cat":
+            prefix = parts[2].rstrip("*")
+            return self._reply(
+                [{"index": name} for name in self.indexes if name.startswith(prefix)]
+            )
+        if parts[0] == "_alias":
+            names = [i for i, alias in self.aliases.items() if alias == parts[1]]
+            return self._reply({name: {} for name in names}, 200 if names else 404)
+        if parts[0] == "_aliases":
+            for action in json["actions"]:
+                ((kind, target),) = action.items()
+                if kind == "add":
+                    self.aliases[target["index"]] = target["alias"]
+                elif kind == "remove":
+                    del self.aliases[target["index"]]
+                else:
+                    del self.indexes[target["index"]]
+            return self._reply({"acknowledged": True})
+        if method == "HEAD":
+            known = parts[0] in self.indexes or parts[0] in self.aliases.values()
+            return self._reply(None, 200 if known else 404)
+        if method == "PUT" and len(parts) == 1:
+            self.indexes[parts[0]] = dict(json["settings"])
+            return self._reply({"acknowledged": True})
+        if method == "PUT" and parts[1] == "_settings":
+            self.indexes[parts[0]].update(json)
+            return self._reply({"acknowledged": True})
+        if method == "DELETE":
+            found = self.indexes.pop(parts[0], None) is not None
+            return self._reply({"acknowledged": True}, 200 if found else 404)
+
+        return self._reply({})
+
+    @staticmethod
+    def _reply(data, status_code=200):
+        def raise_for_status():
+            if status_code >= 400:
+                raise RuntimeError(status_code)
+
+        return SimpleNamespace(
+            status_code=status_code,
+            json=lambda: data,
+            raise_for_status=raise_for_status,
+        )
+
+
+def make_manager(monkeypatch, es: FakeElasticsearch) -> IndexManager:
+    manager = IndexManager("movies", SCHEMA)
+    monkeypatch.setattr(manager.session, "request", es.request)
+    return manager
+
+
+class FakePipe:
+    def __init__(self, pump):
+        self.loader = ESLoader(index_name="movies", partial_updates=True)
+        self.states_keeper = CachedState(MemoryStorage(), key_prefix="movies.")
+        self.states_keeper.set_state("loader.modified", "2021-01-01 00:00:00.0")
+        self._pump = pump
+
+    def pump(self, from_date, stop_event):
+        self._pump(self)
+
+
+def test_build_index_is_next_version_with_bulk_settings(monkeypatch):
+    es = FakeElasticsearch(indexes=["movies_v2", "movies_v10", "movies_draft"])
+    manager = make_manager(monkeypatch, es)
+
+    assert manager.get_versions() == ["movies_v2", "movies_v10"]
+    assert manager.create_build_index() == "movies_v11"
+    assert es.indexes["movies_v11"] == {
+        "refresh_interval": "-1",
+        "number_of_replicas": 0,
+    }
+
+    manager.finish_build("movies_v11")
+    # настройки схемы возвращены, реплики - по умолчанию ES
+    assert es.indexes["movies_v11"] == {
+        "refresh_interval": "1s",
+        "number_of_replicas": None,
+    }
+    assert [path for _, path, _ in es.requests[-3:]] == [
+        "movies_v11/_refresh",
+        "movies_v11/_forcemerge",
+        "_cluster/health/movies_v11",
+    ]
+
+
+def test_swap_moves_alias_and_replaces_legacy_index(monkeypatch):
+    es = FakeElasticsearch(indexes=["movies", "movies_v1", "movies_v2"])
+    manager = make_manager(monkeypatch, es)
+
+    # имя алиаса занято индексом init_es.py - удаляется в том же запросе
+    assert manager.swap("movies_v1") == []
+    assert "movies" not in es.indexes
+    assert es.aliases == {"movies_v1": "movies"}
+
+    assert manager.swap("movies_v2") == ["movies_v1"]
+    assert es.aliases == {"movies_v2": "movies"}
+    _, _, body = es.requests[-1]
+    assert body["actions"] == [
+        {"add": {"index": "movies_v2", "alias": "movies"}},
+        {"remove": {"index": "movies_v1", "alias": "movies"}},
+    ]
+
+
+def test_delete_old_versions_keeps_current_and_latest(monkeypatch):
+    es = FakeElasticsearch(
+        indexes=["movies_v1", "movies_v2", "movies_v3", "movies_v4"],
+        aliases={"movies_v4": "movies"},
+    )
+    manager = make_manager(monkeypatch, es)
+
+    manager.delete_old_versions(keep=1)
+
+    assert sorted(es.indexes) == ["movies_v3", "movies_v4"]
+
+
+def test_rebuild_index_switches_alias_and_continues_from_rebuild_state(monkeypatch):
+    es = FakeElasticsearch(indexes=["movies_v1"], aliases={"movies_v1": "movies"})
+    manager = make_manager(monkeypatch, es)
+    seen = {}
+
+    def pump(pipe):
+        seen["index"] = pipe.loader.index_name
+        seen["partial_updates"] = pipe.loader.partial_updates
+        # пересборка начинается с чистого состояния
+        seen["modified"] = pipe.states_keeper.get_state("loader.modified")
+        pipe.states_keeper.set_state("loader.modified", "2022-02-02 00:00:00.0")
+
+    pipe = FakePipe(pump)
+    live_state = pipe.states_keeper
+
+    assert rebuild_index(pipe, manager) == "movies_v2"
+
+    assert seen == {"index": "movies_v2", "partial_updates": False, "modified": None}
+    assert es.aliases == {"movies_v2": "movies"}
+    assert pipe.states_keeper is live_state
+    assert pipe.loader.index_name == "movies"
+    assert pipe.loader.partial_updates
+    assert live_state.storage.retrieve_state() == {
+        "movies.loader.modified": "2022-02-02 00:00:00.0"
+    }
+
+
+def test_documents_loaded_by_rebuild_are_not_resent_through_alias(
+    monkeypatch, tmp_path
+):
+    es = FakeElasticsearch(indexes=["movies_v1"], aliases={"movies_v1": "movies"})
+    manager = make_manager(monkeypatch, es)
+    documents = [Genre(id="1", name="a"), Genre(id="2", name="b")]
+    bulk_sent = []
+
+    def get(url, params, timeout):
+        # _settings по алиасу отвечает именем индекса, на который он указывает
+        name = url.split("/")[-3]
+        (index,) = [i for i, alias in es.aliases.items() if alias == name] or [name]
+        settings = {index: {"settings": {"index.uuid": f"{index}-uuid"}}}
+        return SimpleNamespace(
+            status_code=200, raise_for_status=lambda: None, json=lambda: settings
+        )
+
+    def post(url, params, headers, data, timeout):
+        bulk_sent.append(data)
+        return SimpleNamespace(status_code=200, content=b'{"items": []}')
+
+    def pump(pipe):
+        assert pipe.loader.load_to_es(documents)
+        pipe.loader.commit()
+
+    pipe = FakePipe(pump)
+    pipe.loader.hash_cache = DocumentHashCache(str(tmp_path / "hashes.db"))
+    monkeypatch.setattr(pipe.loader.session, "get", get)
+    monkeypatch.setattr(pipe.loader.session, "post", post)
+
+    assert rebuild_index(pipe, manager) == "movies_v2"
+    assert len(bulk_sent) == 1
+
+    # те же документы через алиас после переключения - ничего не отправляется
+    assert pipe.loader.load_to_es(documents)
+    assert len(bulk_sent) == 1
+
+
+@pytest.mark.parametrize("interrupted", [False, True])
+def test_failed_rebuild_keeps_alias_and_state(monkeypatch, interrupted):
+    es = FakeElasticsearch(indexes=["movies_v1"], aliases={"movies_v1": "movies"})
+    manager = make_manager(monkeypatch, es)
+    stop_event = threading.Event()
+
+    def pump(pipe):
+        pipe.states_keeper.set_state("loader.modified", "2022-02-02 00:00:00.0")
+        if interrupted:
+            stop_event.set()
+        else:
+            raise ValueError("bulk failed")
+
+    pipe = FakePipe(pump)
+
+    with pytest.raises(RebuildInterrupted if interrupted else ValueError):
+        rebuild_index(pipe, manager, stop_event=stop_event)
+
+    assert sorted(es.indexes) == ["movies_v1"]
+    assert es.aliases == {"movies_v1": "movies"}
+    assert pipe.states_keeper.get_state("loader.modified") == "2021-01-01 00:00:00.0"
+    assert pipe.loader.index_name == "movies"
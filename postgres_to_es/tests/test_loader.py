@@ -0,0 +1,250 @@
+import gzip
+import json
+import threading
+from types import SimpleNamespace
+
+from etl import metrics
+from etl.cache import DocumentHashCache
+from etl.entities import Genre
+from etl.loader import BulkBatch, DeadLetterFile, ESLoader
+from etl.serializers import BulkSerializer
+
+
+def test_load_to_es_splits_batch_into_parallel_chunks(monkeypatch):
+    loader = ESLoader(index_name="movies", bulk_chunks=4, max_in_flight=4)
+    # все 4 части должны оказаться в полёте одновременно
+    barrier = threading.Barrier(4)
+    chunks = []
+
+    def load_chunk(payloads):
+        barrier.wait(timeout=5)
+        chunks.append(payloads)
+        return True
+
+    monkeypatch.setattr(loader, "_load_chunk", load_chunk)
+
+    records = BulkBatch(range(10), payloads=[b"%d" % i for i in range(10)])
+    assert loader.load_to_es(records)
+
+    assert sorted(len(chunk) for chunk in chunks) == [1, 3, 3, 3]
+    assert sorted(sum(chunks, [])) == sorted(records.payloads)
+
+
+def test_load_to_es_fails_if_any_chunk_fails(monkeypatch):
+    loader = ESLoader(index_name="movies", bulk_chunks=3, max_in_flight=2)
+    monkeypatch.setattr(loader, "_load_chunk", lambda payloads: payloads[0] != b"3")
+
+    records = BulkBatch(range(9), payloads=[b"%d" % i for i in range(9)])
+    assert not loader.load_to_es(records)
+
+
+def test_load_chunk_sends_gzipped_body_over_session(monkeypatch):
+    loader = ESLoader(index_name="genres", compress=True)
+    requests_sent = []
+
+    def post(url, params, headers, data, timeout):
+        requests_sent.append((headers, gzip.decompress(data)))
+        return SimpleNamespace(status_code=200, content=b'{"items": []}')
+
+    monkeypatch.setattr(loader.session, "post", post)
+
+    assert loader.load_to_es([Genre(id="genre_test_1", name="комедия")])
+
+    headers, body = requests_sent[0]
+    assert headers["Content-Encoding"] == "gzip"
+    action, document = body.decode("utf-8").splitlines()
+    assert json.loads(action) == {"index": {"_index": "genres", "_id": "genre_test_1"}}
+    assert json.loads(document) == {"id": "genre_test_1", "name": "комедия"}
+
+
+def test_partial_updates_send_only_changed_documents(monkeypatch):
+    loader = ESLoader(index_name="genres", partial_updates=True)
+    requests_sent = []
+
+    def post(url, params=None, headers=None, data=None, json=None, timeout=None):
+        if url.endswith("_mget"):
+            docs = [
+                {"_id": "genre_test_1", "_source": {"id": "genre_test_1", "name": "a"}},
+                {"_id": "genre_test_2", "_source": {"id": "genre_test_2", "name": "b"}},
+            ]
+            return SimpleNamespace(
+                status_code=200,
+                raise_for_status=lambda: None,
+                json=lambda: {"docs": docs},
+            )
+
+        requests_sent.append(data.decode("utf-8").splitlines())
+        return SimpleNamespace(status_code=200, content=b'{"items": [{"update": {}}]}')
+
+    monkeypatch.setattr(loader.session, "post", post)
+
+    records = [
+        Genre(id="genre_test_1", name="a"),
+        Genre(id="genre_test_2", name="c"),
+        Genre(id="genre_test_3", name="d"),
+    ]
+    assert loader.load_to_es(records)
+
+    (lines,) = requests_sent
+    assert [json.loads(line) for line in lines] == [
+        {"update": {"_index": "genres", "_id": "genre_test_2"}},
+        {"doc": {"name": "c"}},
+        {"index": {"_index": "genres", "_id": "genre_test_3"}},
+        {"id": "genre_test_3", "name": "d"},
+    ]
+
+
+def test_partial_updates_diff_against_cached_documents(monkeypatch, tmp_path):
+    hash_cache = DocumentHashCache(str(tmp_path / "hashes.db"))
+    loader = ESLoader(index_name="genres", partial_updates=True, hash_cache=hash_cache)
+    monkeypatch.setattr(loader, "_get_index_key", lambda: "genres/uuid")
+    mget_ids, requests_sent = [], []
+
+    def post(url, **kwargs):
+        if url.endswith("_mget"):
+            mget_ids.append(kwargs["json"]["ids"])
+            return SimpleNamespace(
+                status_code=200, raise_for_status=lambda: None, json=lambda: {}
+            )
+
+        requests_sent.append(kwargs["data"].decode("utf-8").splitlines())
+        return SimpleNamespace(status_code=200, content=b'{"items": []}')
+
+    monkeypatch.setattr(loader.session, "post", post)
+
+    assert loader.load_to_es([Genre(id="1", name="a"), Genre(id="2", name="b")])
+    loader.commit()
+    assert loader.load_to_es([Genre(id="1", name="c"), Genre(id="3", name="d")])
+
+    # из ES читаются только документы, которых нет в кеше
+    assert mget_ids == [["1", "2"], ["3"]]
+    assert [json.loads(line) for line in requests_sent[-1]] == [
+        {"update": {"_index": "genres", "_id": "1"}},
+        {"doc": {"name": "c"}},
+        {"index": {"_index": "genres", "_id": "3"}},
+        {"id": "3", "name": "d"},
+    ]
+
+
+def test_document_hash_does_not_depend_on_index_name():
+    genre = Genre(id="1", name="a")
+
+    assert DocumentHashCache.hash(BulkSerializer("genres_v2")(genre)) == (
+        DocumentHashCache.hash(BulkSerializer("genres")(genre))
+    )
+    assert DocumentHashCache.hash(BulkSerializer("genres")(genre)) != (
+        DocumentHashCache.hash(BulkSerializer("genres")(Genre(id="1", name="b")))
+    )
+
+
+def test_hash_cache_skips_unchanged_documents(monkeypatch, tmp_path):
+    hash_cache = DocumentHashCache(str(tmp_path / "hashes.db"))
+    loader = ESLoader(index_name="genres", hash_cache=hash_cache)
+    index_uuid = "uuid-1"
+    requests_sent, settings_requested = [], []
+
+    def get(url, params, timeout):
+        settings_requested.append(url)
+        settings = {"genres": {"settings": {"index.uuid": index_uuid}}}
+        return SimpleNamespace(
+            status_code=200, raise_for_status=lambda: None, json=lambda: settings
+        )
+
+    def post(url, params, headers, data, timeout):
+        requests_sent.append(
+            [json.loads(line)["id"] for line in data.splitlines()[1::2]]
+        )
+        return SimpleNamespace(status_code=200, content=b'{"items": []}')
+
+    monkeypatch.setattr(loader.session, "get", get)
+    monkeypatch.setattr(loader.session, "post", post)
+
+    assert loader.load_to_es([Genre(id="1", name="a"), Genre(id="2", name="b")])
+    loader.commit()
+    assert loader.load_to_es([Genre(id="1", name="a"), Genre(id="2", name="c")])
+    loader.commit()
+
+    # кеш переживает перезапуск
+    loader.hash_cache = DocumentHashCache(str(tmp_path / "hashes.db"))
+    assert loader.load_to_es([Genre(id="1", name="a"), Genre(id="2", name="c")])
+
+    # uuid индекса запрашивается один раз, а не на каждую пачку
+    assert len(settings_requested) == 1
+
+    # пересозданный индекс (set_index при пересборке) - кеш не действует
+    index_uuid = "uuid-2"
+    loader.set_index("genres")
+    assert loader.load_to_es([Genre(id="1", name="a")])
+
+    assert requests_sent == [["1", "2"], ["2"], ["1"]]
+    assert len(settings_requested) == 2
+
+
+def bulk_response(*items) -> SimpleNamespace:
+    content = {
+        "errors": any("error" in item for item in items),
+        "items": [{"index": item} for item in items],
+    }
+    return SimpleNamespace(status_code=200, content=json.dumps(content).encode())
+
+
+def test_only_overloaded_documents_are_retried(monkeypatch, tmp_path):
+    dead_letters = DeadLetterFile(str(tmp_path / "dead_letters.ndjson"))
+    hash_cache = DocumentHashCache(str(tmp_path / "hashes.db"))
+    loader = ESLoader(
+        index_name="retries_test",
+        retry_start_sleep=0,
+        hash_cache=hash_cache,
+        dead_letters=dead_letters,
+    )
+    monkeypatch.setattr(loader, "_get_index_key", lambda: "retries_test/uuid")
+    rejected = {"type": "es_rejected_execution_exception"}
+    responses = [
+        SimpleNamespace(status_code=429, text="too many requests", content=b""),
+        bulk_response(
+            {"_id": "1", "status": 201},
+            {"_id": "2", "status": 429, "error": rejected},
+            {"_id": "3", "status": 400, "error": {"type": "mapper_parsing_exception"}},
+        ),
+        bulk_response({"_id": "2", "status": 201}),
+    ]
+    requests_sent = []
+
+    def post(url, params, headers, data, timeout):
+        requests_sent.append(
+            [json.loads(line)["id"] for line in data.splitlines()[1::2]]
+        )
+        return responses.pop(0)
+
+    monkeypatch.setattr(loader.session, "post", post)
+
+    records = [Genre(id=str(i), name="a") for i in range(1, 4)]
+    assert loader.load_to_es(records)
+    loader.commit()
+
+    assert requests_sent == [["1", "2", "3"], ["1", "2", "3"], ["2"]]
+    assert metrics.ES_REJECTIONS.value(index="retries_test") == 4
+    assert metrics.ES_RETRIES.value(index="retries_test") == 4
+
+    (line,) = (tmp_path / "dead_letters.ndjson").read_text().splitlines()
+    dead_letter = json.loads(line)
+    assert dead_letter["status"] == 400
+    assert dead_letter["document"] == {"id": "3", "name": "a"}
+    # отложенный документ будет отправлен снова, даже если не изменится
+    assert sorted(hash_cache.get("retries_test/uuid", ["1", "2", "3"])) == ["1", "2"]
+
+
+def test_load_fails_when_retries_are_exhausted_or_errors_are_permanent(monkeypatch):
+    loader = ESLoader(index_name="genres", retry_attempts=1, retry_start_sleep=0)
+    responses = [
+        bulk_response({"_id": "1", "status": 503, "error": {"type": "unavailable"}}),
+        bulk_response({"_id": "1", "status": 503, "error": {"type": "unavailable"}}),
+        bulk_response({"_id": "1", "status": 400, "error": {"type": "mapping"}}),
+    ]
+    monkeypatch.setattr(
+        loader.session, "post", lambda *args, **kwargs: responses.pop(0)
+    )
+
+    assert not loader.load_to_es([Genre(id="1", name="a")])
+    # без dead_letters постоянная ошибка останавливает загрузку
+    assert not loader.load_to_es([Genre(id="1", name="a")])
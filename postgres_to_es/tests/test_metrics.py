@@ -0,0 +1,67 @@
+import logging
+from types import SimpleNamespace
+
+from etl import metrics
+
+
+def test_registry_renders_prometheus_text_format():
+    registry = metrics.MetricsRegistry()
+    counter = registry.counter("test_items_total", "Items")
+    histogram = registry.histogram("test_seconds", "Latency", (0.1, 1))
+
+    counter.inc(3, pipe='a "quoted"')
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value, pipe="a")
+
+    assert registry.render().splitlines() == [
+        "# HELP test_items_total Items",
+        "# TYPE test_items_total counter",
+        'test_items_total{pipe="a \\"quoted\\""} 3',
+        "# HELP test_seconds Latency",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{pipe="a",le="0.1"} 1',
+        'test_seconds_bucket{pipe="a",le="1"} 2',
+        'test_seconds_bucket{pipe="a",le="+Inf"} 3',
+        'test_seconds_sum{pipe="a"} 5.55',
+        'test_seconds_count{pipe="a"} 3',
+    ]
+
+
+def test_summary_reports_stage_rates_and_lag():
+    reporter = metrics.SummaryReporter(interval=10)
+    reporter.summary()
+
+    with metrics.observe_stage("summary_test", "load"):
+        metrics.count_items("summary_test", "load", 500)
+    metrics.set_lag("summary_test", "2000-01-01 00:00:00.000000")
+
+    (line,) = [line for line in reporter.summary() if "summary_test" in line]
+    assert line.startswith("Metrics: summary_test: load 50/s avg ")
+    assert "lag n/a" not in line
+    # за следующий интервал ничего не произошло
+    assert not [line for line in reporter.summary() if "summary_test" in line]
+
+
+def test_summary_is_logged_when_root_logger_is_at_warning(monkeypatch):
+    # как logging.basicConfig(level=WARNING): уровень у логгера, не у обработчика
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    root = logging.getLogger()
+    level = root.level
+    root.setLevel(logging.WARNING)
+    root.addHandler(handler)
+
+    reporter = metrics.SummaryReporter(interval=10)
+    monkeypatch.setattr(reporter, "summary", lambda: ["Metrics: test"])
+    # один интервал, затем остановка
+    stops = [False, True]
+    try:
+        reporter.run(SimpleNamespace(wait=lambda timeout: stops.pop(0)))
+    finally:
+        root.removeHandler(handler)
+        root.setLevel(level)
+
+    assert [(record.levelno, record.getMessage()) for record in records] == [
+        (logging.INFO, "Metrics: test")
+    ]
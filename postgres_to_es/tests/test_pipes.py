@@ -0,0 +1,388 @@
+import json
+import threading
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from etl import metrics
+from etl.extractor import RowsStream
+from etl.loader import ESLoader
+from etl.pipes import PipeEETBL, build_buffer, coroutine
+from etl.state import MemoryStorage, State
+from etl.transformer import ETLTransformer
+
+
+class FakeExtractor:
+    def __init__(self, rows):
+        # [(<id>, <modified>), ...]
+        self.rows = sorted(rows, key=lambda row: (row[1], row[0]))
+
+    def get_modified_ids(self, modified, last_id, limit):
+        modified = datetime.fromisoformat(modified)
+        last_id = last_id or ""
+        return [row for row in self.rows if (row[1], row[0]) > (modified, last_id)][
+            :limit
+        ]
+
+    def iter_modified_ids(self, modified, last_id, batch_size):
+        rows = self.get_modified_ids(modified, last_id, len(self.rows))
+        while rows:
+            yield rows[:batch_size]
+            rows = rows[batch_size:]
+
+    def get_data_by_ids(self, ids):
+        return [
+            SimpleNamespace(id=row[0], modified=row[1].strftime("%Y-%m-%d %H:%M:%S.%f"))
+            for row in self.rows
+            if row[0] in ids
+        ]
+
+    def iter_data_by_ids(self, ids):
+        self.streamed = getattr(self, "streamed", 0) + 1
+        return RowsStream(iter(self.get_data_by_ids(ids)), {})
+
+
+class FakeFanOutExtractor(FakeExtractor):
+    def __init__(self, rows, related_rows, links):
+        super().__init__(rows)
+        # {<relation>: [(<id>, <modified>), ...]}
+        self.related_rows = related_rows
+        # {<relation>: [(<related_id>, <id>), ...]}
+        self.links = links
+
+    def get_last_related_key(self, relation):
+        return max(
+            self.related_rows[relation],
+            key=lambda row: (row[1], row[0]),
+            default=None,
+        )
+
+    def get_modified_related_ids(self, relation, modified, last_id, limit):
+        modified = datetime.fromisoformat(modified)
+        last_id = last_id or ""
+        rows = sorted(self.related_rows[relation], key=lambda row: (row[1], row[0]))
+        return [row for row in rows if (row[1], row[0]) > (modified, last_id)][:limit]
+
+    def get_movie_ids_by_related_ids(self, relation, related_ids, last_movie_id, limit):
+        ids = {
+            movie_id
+            for related_id, movie_id in self.links[relation]
+            if related_id in related_ids and movie_id > (last_movie_id or "")
+        }
+        return sorted(ids)[:limit]
+
+
+class FakeLoader:
+    def __init__(self):
+        self.loaded = []
+
+    def load_to_es(self, records):
+        self.loaded.extend(record.id for record in records)
+        return True
+
+
+def make_pipe(
+    rows,
+    extractor_batch_size=3,
+    loader_batch_size=5,
+    streaming=False,
+    pipelined=False,
+    lazy=False,
+):
+    state = State(MemoryStorage(), key_prefix="test.")
+    loader = FakeLoader()
+    pipe = PipeEETBL(
+        label="test",
+        extractor=FakeExtractor(rows),
+        loader=loader,
+        transformer=ETLTransformer(source_unique_key="id"),
+        states_keeper=state,
+        extractor_batch_size=extractor_batch_size,
+        loader_batch_size=loader_batch_size,
+        streaming=streaming,
+        pipelined=pipelined,
+        lazy=lazy,
+    )
+    return pipe, loader, state
+
+
+def test_keyset_pagination_with_modified_ties():
+    # 10 записей с одинаковым modified - больше, чем размер страницы
+    same_modified = datetime(2021, 1, 1)
+    rows = [("id-%02d" % i, same_modified) for i in range(10)]
+    rows += [("id-%02d" % i, same_modified + timedelta(days=1)) for i in range(10, 14)]
+
+    pipe, loader, state = make_pipe(rows)
+    pipe.pump(from_date="2000-01-01 00:00:00.000000")
+
+    assert sorted(loader.loaded) == sorted(row[0] for row in rows)
+    assert len(loader.loaded) == len(rows)
+    assert state.get_state("loader.id") == "id-13"
+    assert state.get_state("extractor.id") == "id-13"
+
+
+def test_keyset_pagination_resumes_after_last_pair():
+    rows = [("id-%02d" % i, datetime(2021, 1, 1)) for i in range(4)]
+
+    pipe, loader, state = make_pipe(rows)
+    pipe.pump(from_date="2000-01-01 00:00:00.000000")
+    loader.loaded.clear()
+
+    # повторный запуск без принудительной даты не должен ничего выгрузить
+    pipe.pump(from_date=None)
+    assert loader.loaded == []
+
+
+def test_streaming_extract():
+    rows = [("id-%02d" % i, datetime(2021, 1, 1 + i % 3)) for i in range(11)]
+
+    pipe, loader, state = make_pipe(rows, streaming=True)
+    pipe.pump(from_date="2000-01-01 00:00:00.000000")
+
+    assert sorted(loader.loaded) == sorted(row[0] for row in rows)
+    assert state.get_state("extractor.id") == "id-08"
+
+
+def test_pipelined_pump():
+    rows = [("id-%03d" % i, datetime(2021, 1, 1 + i % 5)) for i in range(101)]
+
+    pipe, loader, state = make_pipe(rows, pipelined=True)
+    pipe.pump(from_date="2000-01-01 00:00:00.000000")
+
+    assert sorted(loader.loaded) == sorted(row[0] for row in rows)
+    assert state.get_state("loader.id") == "id-099"
+
+
+@pytest.mark.parametrize("pipelined", [False, True])
+def test_lazy_pump(pipelined):
+    rows = [("id-%02d" % i, datetime(2021, 1, 1 + i % 3)) for i in range(11)]
+
+    pipe, loader, state = make_pipe(rows, pipelined=pipelined, lazy=True)
+    pipe.pump(from_date="2000-01-01 00:00:00.000000")
+
+    assert sorted(loader.loaded) == sorted(row[0] for row in rows)
+    assert pipe.extractor.streamed == 4
+    assert state.get_state("loader.id") == "id-08"
+
+
+def test_pipelined_pump_stops_on_loader_error():
+    class BrokenLoader:
+        def load_to_es(self, records):
+            raise ValueError("ES is down")
+
+    rows = [("id-%03d" % i, datetime(2021, 1, 1)) for i in range(101)]
+
+    pipe, loader, state = make_pipe(rows, pipelined=True)
+    pipe.loader = BrokenLoader()
+
+    with pytest.raises(ValueError, match="ES is down"):
+        pipe.pump(from_date="2000-01-01 00:00:00.000000")
+
+    assert state.get_state("loader.id") is None
+
+
+@pytest.mark.parametrize("pipelined", [False, True])
+def test_pump_after_failed_load_reloads_skipped_rows(pipelined):
+    rows = [("id-%02d" % i, datetime(2021, 1, 1)) for i in range(20)]
+    pipe, loader, state = make_pipe(rows, pipelined=pipelined)
+    load_to_es = loader.load_to_es
+    calls = []
+
+    def fail_second_load(records):
+        calls.append(len(records))
+        return len(calls) != 2 and load_to_es(records)
+
+    loader.load_to_es = fail_second_load
+    # StopIteration из корутины load превращается в RuntimeError (PEP 479)
+    with pytest.raises(RuntimeError):
+        pipe.pump(from_date=None)
+    assert state.get_state("loader.id") == "id-05"
+
+    pipe.pump(from_date=None)
+
+    assert sorted(set(loader.loaded)) == [row[0] for row in rows]
+    assert state.get_state("loader.id") == "id-19"
+
+
+@pytest.mark.parametrize("pipelined", [False, True])
+def test_batch_rejected_after_retries_is_reloaded_by_next_pump(monkeypatch, pipelined):
+    rows = [("id-%02d" % i, datetime(2021, 1, 1)) for i in range(20)]
+    loader = ESLoader(index_name="test", retry_attempts=1, retry_start_sleep=0)
+    monkeypatch.setattr(
+        loader, "serialize", lambda record: b'{"index":{}}\n"%s"\n' % record.id.encode()
+    )
+    state = State(MemoryStorage(), key_prefix="test.")
+    pipe = PipeEETBL(
+        label="test",
+        extractor=FakeExtractor(rows),
+        loader=loader,
+        transformer=ETLTransformer(source_unique_key="id"),
+        states_keeper=state,
+        extractor_batch_size=3,
+        loader_batch_size=5,
+        pipelined=pipelined,
+    )
+    loaded, requests_sent = [], []
+
+    def post(url, params, headers, data, timeout):
+        requests_sent.append(data)
+        # вторая пачка: ES перегружен и на повторе
+        if len(requests_sent) in (2, 3):
+            return SimpleNamespace(status_code=429, text="overloaded", content=b"")
+        loaded.extend(json.loads(line) for line in data.splitlines()[1::2])
+        return SimpleNamespace(status_code=200, content=b'{"items": []}')
+
+    monkeypatch.setattr(loader.session, "post", post)
+
+    with pytest.raises(RuntimeError):
+        pipe.pump(from_date=None)
+    assert state.get_state("loader.id") == "id-05"
+
+    pipe.pump(from_date=None)
+
+    assert sorted(set(loaded)) == [row[0] for row in rows]
+
+
+def test_pipelined_buffer_flushes_by_age_while_extract_waits():
+    rows = [("id-%02d" % i, datetime(2021, 1, 1)) for i in range(6)]
+    pipe, loader, _ = make_pipe(rows, loader_batch_size=100, pipelined=True)
+    pipe.loader_batch_max_age = 0.05
+    first_batch_loaded = threading.Event()
+    get_modified_ids = pipe.extractor.get_modified_ids
+    load_to_es = loader.load_to_es
+
+    def slow_get_modified_ids(modified, last_id, limit):
+        # следующий запрос к PG "висит", пока не загрузится неполная пачка
+        if last_id:
+            assert first_batch_loaded.wait(timeout=5)
+        return get_modified_ids(modified, last_id, limit)
+
+    def signal_load_to_es(records):
+        first_batch_loaded.set()
+        return load_to_es(records)
+
+    pipe.extractor.get_modified_ids = slow_get_modified_ids
+    loader.load_to_es = signal_load_to_es
+
+    assert pipe.pump(from_date=None)
+
+    assert loader.loaded[:3] == ["id-00", "id-01", "id-02"]
+    assert sorted(loader.loaded) == [row[0] for row in rows]
+
+
+def test_buffer_flushes_by_bytes_and_keeps_payloads():
+    batches = []
+
+    @coroutine
+    def collect():
+        while True:
+            batches.append((yield))
+
+    buffer = build_buffer()
+    pipe_head = buffer(
+        collect(),
+        batch_size=100,
+        max_bytes=10,
+        serializer=lambda item: b"x" * item,
+    )
+    pipe_head.send([3, 3, 3, 4])
+    pipe_head.send([6, 1])
+
+    # 3+3+3 = 9 байт, 4-й объект в пачку уже не помещается
+    assert [list(batch) for batch in batches] == [[3, 3, 3], [4, 6]]
+    assert batches[0].payloads == [b"xxx"] * 3
+
+    buffer(collect(), batch_size=1).send(None)
+    assert list(batches[-1]) == [1]
+    assert batches[-1].payloads == [b"x"]
+
+
+def test_fan_out_reloads_movies_of_modified_relations():
+    movies = [("id-%02d" % i, datetime(2021, 1, 1)) for i in range(6)]
+    related_rows = {"persons": [("p-1", datetime(2021, 1, 1))], "genres": []}
+    links = {
+        "persons": [("p-1", "id-01"), ("p-1", "id-04"), ("p-2", "id-05")],
+        "genres": [],
+    }
+
+    pipe, loader, state = make_pipe(movies)
+    pipe.extractor = FakeFanOutExtractor(movies, related_rows, links)
+    pipe.fan_out_relations = ("persons", "genres")
+
+    # первый запуск - позиция fan_out встаёт на последнее изменение
+    pipe.pump(from_date=None)
+    assert sorted(loader.loaded) == [row[0] for row in movies]
+
+    # персона изменилась - перегружаются только её фильмы
+    loader.loaded.clear()
+    related_rows["persons"].append(("p-2", datetime(2021, 2, 1)))
+    related_rows["persons"][0] = ("p-1", datetime(2021, 2, 2))
+    pipe.pump(from_date=None)
+
+    assert sorted(loader.loaded) == ["id-01", "id-04", "id-05"]
+    # точка восстановления основного extract не откатилась назад
+    assert state.get_state("loader.id") == "id-05"
+    assert state.get_state("fan_out.persons.id") == "p-1"
+
+    loader.loaded.clear()
+    pipe.pump(from_date=None)
+    assert loader.loaded == []
+
+
+def test_push_loads_notified_and_related_objects():
+    movies = [("id-%02d" % i, datetime(2021, 1, 1)) for i in range(6)]
+    links = {"persons": [("p-1", "id-01"), ("p-1", "id-04")], "genres": []}
+
+    pipe, loader, state = make_pipe(movies)
+    pipe.extractor = FakeFanOutExtractor(movies, {}, links)
+    pipe.fan_out_relations = ("persons", "genres")
+    pipe.topic = "movies"
+
+    pipe.push({"movies": {"id-02", "id-04"}, "persons": {"p-1"}})
+
+    assert sorted(loader.loaded) == ["id-01", "id-02", "id-04", "id-04"]
+    assert pipe.listen_topics == ("movies", "movies.links", "persons", "genres")
+
+
+def test_push_loads_objects_with_changed_links_without_fan_out():
+    movies = [("id-%02d" % i, datetime(2021, 1, 1)) for i in range(6)]
+    links = {"persons": [("p-1", "id-01"), ("p-1", "id-04")], "genres": []}
+
+    pipe, loader, state = make_pipe(movies)
+    pipe.extractor = FakeFanOutExtractor(movies, {}, links)
+    pipe.fan_out_relations = ("persons", "genres")
+    pipe.topic = "movies"
+
+    # персону p-1 добавили в фильм id-02: остальные её фильмы не затронуты
+    pipe.push({"movies": {"id-02"}, "movies.links": {"id-02", "id-03"}})
+
+    assert sorted(loader.loaded) == ["id-02", "id-03"]
+
+
+def test_push_skips_deleted_objects():
+    movies = [("id-%02d" % i, datetime(2021, 1, 1)) for i in range(3)]
+
+    pipe, loader, state = make_pipe(movies, extractor_batch_size=1)
+    pipe.topic = "movies"
+
+    # строки "gone" удалены: его пачка обогащения пустая
+    pipe.push({"movies": ["gone", "id-01", "id-02"]})
+
+    assert sorted(loader.loaded) == ["id-01", "id-02"]
+
+
+def test_pump_records_stage_metrics():
+    rows = [("id-%02d" % i, datetime(2021, 1, 1)) for i in range(7)]
+    pipe, loader, state = make_pipe(rows)
+    pipe.label = "metrics_test"
+
+    pipe.pump(from_date="2000-01-01 00:00:00.000000")
+
+    items = metrics.STAGE_ITEMS.values()
+    for stage in ("extract", "enrich", "transform", "load"):
+        assert items[(("pipe", "metrics_test"), ("stage", stage))] == 7
+    assert (("pipe", "metrics_test"),) in metrics.LAG.values()
+    assert 'etl_stage_duration_seconds_count{pipe="metrics_test",stage="load"} 2' in (
+        metrics.registry.render()
+    )
@@ -0,0 +1,73 @@
+import threading
+
+from etl.scheduler import PipesScheduler
+
+
+class FakePipe:
+    def __init__(self, label, barrier, scheduler):
+        self.label = label
+        self.barrier = barrier
+        self.scheduler = scheduler
+        self.from_dates = []
+
+    def pump(self, from_date, stop_event=None):
+        self.from_dates.append(from_date)
+        # все Пайплайны должны дойти сюда одновременно
+        self.barrier.wait(timeout=5)
+        if len(self.from_dates) == 2:
+            self.scheduler.stop()
+
+
+def test_pipes_run_in_parallel_until_stopped():
+    scheduler = PipesScheduler(sleep_time=0)
+    barrier = threading.Barrier(3)
+    pipes = [FakePipe(label, barrier, scheduler) for label in ("a", "b", "c")]
+
+    scheduler.run(pipes, from_date="2021-01-01")
+
+    for pipe in pipes:
+        assert pipe.from_dates[0] == "2021-01-01"
+        assert pipe.from_dates[1] is None
+        assert not barrier.broken
+
+
+class ListeningPipe:
+    label = "movies"
+    listen_topics = ("movies", "persons")
+
+    def __init__(self, scheduler, notified):
+        self.scheduler = scheduler
+        self.notified = notified
+        self.pumps = 0
+        self.pushed = []
+
+    def pump(self, from_date, stop_event=None):
+        self.pumps += 1
+        self.notified.wait(timeout=5)
+
+    def push(self, changes, stop_event=None):
+        self.pushed.append(changes)
+        self.scheduler.stop()
+
+
+class FakeListener:
+    def __init__(self):
+        self.notified = threading.Event()
+
+    def run(self, stop_event, on_changes, on_reconnect):
+        on_changes("movies", {"id-1"})
+        on_changes("persons", {"p-1"})
+        on_changes("genres", {"g-1"})
+        self.notified.set()
+
+
+def test_notifications_wake_pipe_before_sweep():
+    scheduler = PipesScheduler(sleep_time=60, coalesce_time=0.1)
+    listener = FakeListener()
+    pipe = ListeningPipe(scheduler, listener.notified)
+
+    scheduler.run([pipe], listener=listener)
+
+    # страховочный проход при запуске, дальше - только уведомления
+    assert pipe.pumps == 1
+    assert pipe.pushed == [{"movies": {"id-1"}, "persons": {"p-1"}}]
@@ -0,0 +1,111 @@
+import dataclasses
+import json
+
+from etl.entities import (
+    Actor,
+    Director,
+    ElasticSearchGenre,
+    ElasticSearchMovie,
+    ElasticSearchPerson,
+    Genre,
+    MovieSmallWithIMDBRating,
+    MovieSmallWithPersonRole,
+)
+from etl.serializers import BulkSerializer, diff_document
+
+movie = ElasticSearchMovie(
+    id="test1",
+    title='Тест "кавычки"',
+    type="movie",
+    modified="2021-01-01 00:00:00.000000",
+    description="description",
+    imdb_rating=7.7,
+    genres=[Genre(id="genre_test_1", name="комедия")],
+    actors=[Actor(id="person_test_1", name="Иванов Иван Иванович")],
+    directors=[Director(id="person_test_10", name="Иванов Артём Артёмович")],
+    actors_names=["Иванов Иван Иванович"],
+    directors_names=["Иванов Артём Артёмович"],
+)
+genre = ElasticSearchGenre(
+    id="genre_test_1",
+    name="комедия",
+    modified="2021-01-01 00:00:00.000000",
+    movies=[MovieSmallWithIMDBRating(id="test1", title="test", imdb_rating=None)],
+)
+person = ElasticSearchPerson(
+    id="person_test_1",
+    full_name="Иванов Иван Иванович",
+    modified="2021-01-01 00:00:00.000000",
+    movies=[MovieSmallWithPersonRole(id="test1", title="test", person_role="actor")],
+)
+
+
+def test_bulk_serializer_matches_dataclasses_asdict():
+    for record in (movie, genre, person):
+        payload = BulkSerializer("index").dump([record])
+
+        action, document = payload.decode("utf-8").splitlines()
+        assert json.loads(action) == {"index": {"_index": "index", "_id": record.id}}
+        assert json.loads(document) == dataclasses.asdict(record)
+        assert payload.endswith(b"\n")
+
+
+def test_bulk_serializer_falls_back_to_asdict():
+    payload = BulkSerializer("genres")(Genre(id="genre_test_1", name="комедия"))
+
+    assert json.loads(payload.splitlines()[1]) == {
+        "id": "genre_test_1",
+        "name": "комедия",
+    }
+
+
+def test_diff_document_updates_changed_fields_and_nested_items():
+    old = BulkSerializer.to_dict(genre)
+    old["movies"].append({"id": "test2", "title": "test", "imdb_rating": 5.0})
+
+    new = BulkSerializer.to_dict(genre)
+    new["name"] = "драма"
+    new["movies"][0]["title"] = "renamed"
+    new["movies"].append({"id": "test3", "title": "test", "imdb_rating": None})
+
+    body = diff_document(old, new)
+    assert body["script"]["params"] == {
+        "doc": {"name": "драма"},
+        "lists": {
+            "movies": {
+                "upsert": [
+                    {"id": "test1", "title": "renamed", "imdb_rating": None},
+                    {"id": "test3", "title": "test", "imdb_rating": None},
+                ],
+                "remove": ["test2"],
+            }
+        },
+    }
+
+
+def test_diff_document_ignores_reordered_nested_items():
+    old = BulkSerializer.to_dict(genre)
+    old["movies"].append({"id": "test2", "title": "test", "imdb_rating": 5.0})
+    new = {**old, "movies": old["movies"][::-1]}
+
+    assert diff_document(old, new) is None
+
+    new["name"] = "renamed"
+    assert diff_document(old, new) == {"doc": {"name": "renamed"}}
+
+
+def test_bulk_serializer_update_actions():
+    serializer = BulkSerializer("persons")
+    source = BulkSerializer.to_dict(person)
+
+    # документа нет в индексе - полный index
+    assert serializer.update(person, None) == serializer(person)
+    # документ не изменился - ничего не отправляется
+    assert serializer.update(person, source) is None
+
+    source["full_name"] = "Петров Пётр Петрович"
+    action, document = serializer.update(person, source).decode().splitlines()
+    assert json.loads(action) == {
+        "update": {"_index": "persons", "_id": "person_test_1"}
+    }
+    assert json.loads(document) == {"doc": {"full_name": "Иванов Иван Иванович"}}
@@ -0,0 +1,74 @@
+import json
+import os
+import threading
+import time
+
+from etl.state import BaseStorage, CachedState, JsonFileStorage, State
+
+
+def test_json_file_storage_merges_and_leaves_no_temp_files(tmp_path):
+    file_path = tmp_path / "state.json"
+    storage = JsonFileStorage(file_path=str(file_path))
+
+    storage.save_state({"a": 1})
+    storage.save_state({"b": 2})
+
+    assert json.loads(file_path.read_text()) == {"a": 1, "b": 2}
+    assert os.listdir(tmp_path) == ["state.json"]
+
+
+def test_cached_state_writes_only_on_checkpoint(tmp_path):
+    file_path = tmp_path / "state.json"
+    State(JsonFileStorage(str(file_path)), key_prefix="other.").set_state("key", 1)
+
+    state = CachedState(JsonFileStorage(str(file_path)), key_prefix="movies.")
+    state.set_state("loader.modified", "2021-01-01")
+
+    assert state.get_state("loader.modified") == "2021-01-01"
+    assert "movies.loader.modified" not in json.loads(file_path.read_text())
+
+    state.checkpoint()
+
+    assert json.loads(file_path.read_text()) == {
+        "other.key": 1,
+        "movies.loader.modified": "2021-01-01",
+    }
+
+
+class SlowStorage(BaseStorage):
+    """Хранилище, первая запись в которое ждёт разрешения"""
+
+    def __init__(self):
+        self.data = {}
+        self.writing = threading.Event()
+        self.release = threading.Event()
+
+    def save_state(self, state: dict) -> None:
+        if not self.writing.is_set():
+            self.writing.set()
+            self.release.wait(timeout=5)
+        self.data.update(state)
+
+    def retrieve_state(self) -> dict:
+        return dict(self.data)
+
+
+def test_concurrent_checkpoints_keep_the_newer_state():
+    storage = SlowStorage()
+    state = CachedState(storage, key_prefix="")
+
+    state.set_state("loader.id", "id-1")
+    older = threading.Thread(target=state.checkpoint)
+    older.start()
+    storage.writing.wait(timeout=5)
+
+    # пока старый снимок пишется, другой поток фиксирует более новый
+    state.set_state("loader.id", "id-2")
+    newer = threading.Thread(target=state.checkpoint)
+    newer.start()
+    time.sleep(0.1)
+    storage.release.set()
+    older.join()
+    newer.join()
+
+    assert storage.data == {"loader.id": "id-2"}